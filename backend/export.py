@@ -0,0 +1,192 @@
+"""
+Codifica degli export in streaming a partire da record batch Arrow.
+Formati: csv, parquet, arrow (IPC stream), xlsx (richiede openpyxl).
+"""
+
+import io
+import os
+import tempfile
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+# Dimensione indicativa dei blocchi inviati al client
+CHUNK_SIZE = 64 * 1024
+
+# Righe per row group negli export parquet
+PARQUET_ROW_GROUP = 128 * 1024
+
+# Limite righe per formato (0 = nessun limite). EXPORT_MAX_ROWS vale per
+# tutti i formati, EXPORT_MAX_ROWS_<FORMATO> lo sovrascrive.
+EXPORT_MAX_ROWS = os.environ.get("EXPORT_MAX_ROWS", "0")
+EXPORT_LIMITS = {
+    "csv": int(os.environ.get("EXPORT_MAX_ROWS_CSV", EXPORT_MAX_ROWS)),
+    "parquet": int(os.environ.get("EXPORT_MAX_ROWS_PARQUET", EXPORT_MAX_ROWS)),
+    "arrow": int(os.environ.get("EXPORT_MAX_ROWS_ARROW", EXPORT_MAX_ROWS)),
+    "xlsx": int(os.environ.get("EXPORT_MAX_ROWS_XLSX", "100000")),
+}
+
+# Un foglio Excel ha al massimo 1.048.576 righe (intestazione compresa)
+XLSX_MAX_ROWS = 1048575
+
+
+def csv_chunks(reader, delimiter=";", chunk_size=CHUNK_SIZE):
+    """
+    Codifica un RecordBatchReader in CSV a blocchi di circa chunk_size byte.
+    La memoria resta costante: un batch alla volta, scritto a fette la cui
+    dimensione si adatta alla lunghezza media delle righe.
+    """
+    sink = io.BytesIO()
+    writer = pacsv.CSVWriter(
+        sink, reader.schema, write_options=pacsv.WriteOptions(delimiter=delimiter)
+    )
+    rows_per_write = 1000
+    try:
+        for batch in reader:
+            offset = 0
+            while offset < batch.num_rows:
+                part = batch.slice(offset, rows_per_write)
+                before = sink.tell()
+                writer.write_batch(part)
+                offset += part.num_rows
+                written = sink.tell() - before
+                if written:
+                    # Righe che servono per riempire lo spazio residuo del blocco
+                    room = max(chunk_size - sink.tell(), chunk_size // 4)
+                    rows_per_write = max(1, room * part.num_rows // written)
+                data = _drain(sink, chunk_size)
+                if data:
+                    yield data
+        writer.close()
+        if sink.tell():
+            yield sink.getvalue()
+    finally:
+        reader.close()
+
+
+def _drain(sink, chunk_size):
+    """Svuota il buffer se ha raggiunto chunk_size; ritorna i byte o None."""
+    if sink.tell() < chunk_size:
+        return None
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def parquet_chunks(reader, chunk_size=CHUNK_SIZE):
+    """
+    Codifica un RecordBatchReader in Parquet (zstd). I batch vengono
+    accumulati fino a PARQUET_ROW_GROUP righe e scritti come un row group:
+    in memoria resta al piu' un row group.
+    """
+    sink = io.BytesIO()
+    writer = pq.ParquetWriter(sink, reader.schema, compression="zstd")
+    pending = []
+    pending_rows = 0
+    try:
+        for batch in reader:
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            if pending_rows >= PARQUET_ROW_GROUP:
+                writer.write_table(pa.Table.from_batches(pending, reader.schema))
+                pending = []
+                pending_rows = 0
+                data = _drain(sink, chunk_size)
+                if data:
+                    yield data
+        if pending:
+            writer.write_table(pa.Table.from_batches(pending, reader.schema))
+        writer.close()
+        if sink.tell():
+            yield sink.getvalue()
+    finally:
+        reader.close()
+
+
+def arrow_chunks(reader, chunk_size=CHUNK_SIZE):
+    """Codifica un RecordBatchReader come Arrow IPC stream (buffer zstd)."""
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(
+        sink, reader.schema, options=pa.ipc.IpcWriteOptions(compression="zstd")
+    )
+    try:
+        for batch in reader:
+            writer.write_batch(batch)
+            data = _drain(sink, chunk_size)
+            if data:
+                yield data
+        writer.close()
+        if sink.tell():
+            yield sink.getvalue()
+    finally:
+        reader.close()
+
+
+def _load_openpyxl():
+    try:
+        import openpyxl
+    except ImportError:
+        raise ValueError("Export xlsx non disponibile: openpyxl non installato")
+    return openpyxl
+
+
+def xlsx_chunks(reader, chunk_size=CHUNK_SIZE):
+    """
+    Codifica un RecordBatchReader in XLSX (openpyxl in modalita' write_only).
+    Lo zip si chiude solo a fine scrittura: il file viene composto in un
+    file temporaneo e poi inviato a blocchi.
+    """
+    openpyxl = _load_openpyxl()
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+    try:
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("export")
+        ws.append(reader.schema.names)
+        for batch in reader:
+            columns = [col.to_pylist() for col in batch.columns]
+            for row in zip(*columns):
+                ws.append([
+                    ILLEGAL_CHARACTERS_RE.sub("", v) if isinstance(v, str) else v
+                    for v in row
+                ])
+        with tempfile.TemporaryFile() as f:
+            wb.save(f)
+            f.seek(0)
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                yield data
+    finally:
+        reader.close()
+
+
+# formato -> (media type, estensione, encoder)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv", csv_chunks),
+    "parquet": ("application/vnd.apache.parquet", "parquet", parquet_chunks),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow", arrow_chunks),
+    "xlsx": (
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "xlsx",
+        xlsx_chunks,
+    ),
+}
+
+
+def export_format(fmt):
+    """
+    Ritorna (media_type, estensione, encoder, limite righe) per un formato.
+    Solleva ValueError se il formato non e' supportato o non disponibile.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Formato export non supportato: {fmt}")
+    media_type, ext, encoder = EXPORT_FORMATS[fmt]
+    limit = EXPORT_LIMITS[fmt]
+    if fmt == "xlsx":
+        _load_openpyxl()
+        limit = min(limit, XLSX_MAX_ROWS) if limit else XLSX_MAX_ROWS
+    return media_type, ext, encoder, limit
@@ -0,0 +1,124 @@
+"""
+Filtri compilati: i parametri di ricerca (q + output di _parse_filters)
+normalizzati in una chiave hashable e tradotti una sola volta in SQL.
+Ricerca, aggregazioni ed export usano lo stesso oggetto, quindi lavorano
+sullo stesso insieme di righe e condividono la stessa chiave di cache.
+"""
+
+# Filtri-flag: solo questi valori cambiano il predicato, gli altri sono ignorati
+FLAG_VALUES = {
+    "HAS_CIG": ("SI", "NO"),
+    "HAS_AGGIUDICATARI": ("SI", "NO"),
+    "ONLY_PNRR": ("SI",),
+    "FLAG_SUBAPPALTO": ("SI", "NO"),
+    "HAS_DETAIL": ("SI",),
+}
+
+# Ricerche per prefisso su codici (maiuscolo) e "contiene" (senza distinzione
+# maiuscole/minuscole)
+CODE_FILTERS = {"SEARCH_CUP", "SEARCH_CIG"}
+CONTAINS_FILTERS = {
+    "SEARCH_SOGGETTO", "SEARCH_DESCRIZIONE",
+    "SEARCH_AGGIUDICATARIO", "SEARCH_CF_AGGIUDICATARIO",
+}
+RANGE_FILTERS = {"costo_min", "costo_max", "importo_min", "importo_max"}
+
+
+def _number(name, val):
+    try:
+        num = float(val)
+    except ValueError:
+        raise ValueError(f"Valore numerico non valido per {name}: {val}")
+    return int(num) if num.is_integer() else num
+
+
+def normalize_filters(filters, allowed_columns, allowed_filters):
+    """
+    Normalizza i filtri di una tabella in una tupla ordinata di (nome, valore):
+    scarta chiavi sconosciute e valori vuoti, ordina le liste, uniforma
+    maiuscole e numeri. Solleva ValueError sui range non numerici.
+    """
+    items = []
+    for name, val in (filters or {}).items():
+        if name in allowed_columns:
+            values = val if isinstance(val, list) else [val]
+            values = sorted({str(v) for v in values if v})
+            if not values:
+                continue
+            items.append((name, values[0] if len(values) == 1 else tuple(values)))
+            continue
+        if name not in allowed_filters or not val:
+            continue
+        if isinstance(val, list):
+            # _parse_filters spezza sulle virgole anche le ricerche testuali
+            val = ",".join(val)
+        if name in FLAG_VALUES:
+            if val in FLAG_VALUES[name]:
+                items.append((name, val))
+        elif name in CODE_FILTERS:
+            items.append((name, val.strip().upper()))
+        elif name in CONTAINS_FILTERS:
+            if val.strip():
+                items.append((name, val.strip().lower()))
+        elif name in RANGE_FILTERS:
+            items.append((name, _number(name, val)))
+    return tuple(sorted(items))
+
+
+class CompiledFilter:
+    """
+    Filtro compilato per una tabella. key identifica l'insieme di righe
+    (uguaglianza e hash si basano solo su key); la ricerca libera resta
+    separata perche' con l'indice full-text diventa anche punteggio.
+    """
+
+    def __init__(self, key, text=None, clauses=None, params=None):
+        self.key = key  # (tabella, q normalizzata, filtri normalizzati)
+        self.text = text  # (sql, params, score_sql) della ricerca libera, o None
+        self.clauses = clauses or []
+        self.params = params or []
+
+    @property
+    def table(self):
+        return self.key[0]
+
+    @property
+    def filters(self):
+        """Filtri normalizzati come dict."""
+        return dict(self.key[2])
+
+    @property
+    def score_sql(self):
+        """Espressione di rilevanza BM25 (stessi parametri di text), o None."""
+        return self.text[2] if self.text else None
+
+    @property
+    def empty(self):
+        return self.text is None and not self.clauses
+
+    def where(self, *extra, ranked=False):
+        """
+        Ritorna (where_sql, params). Con ranked=True la ricerca libera e'
+        gia' calcolata come _score dalla sorgente (vedi score_sql).
+        extra: predicati aggiuntivi senza parametri.
+        """
+        clauses, params = [], []
+        if self.text:
+            sql, text_params, _ = self.text
+            clauses.append("_score IS NOT NULL" if ranked else sql)
+            params.extend(text_params)
+        clauses.extend(self.clauses)
+        params.extend(self.params)
+        clauses.extend(extra)
+        if not clauses:
+            return "", params
+        return "WHERE " + " AND ".join(clauses), params
+
+    def __eq__(self, other):
+        return isinstance(other, CompiledFilter) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"CompiledFilter({self.key!r})"
@@ -0,0 +1,227 @@
+"""
+Indici in memoria:
+- trigrammi per le ricerche "contiene" (SEARCH_SOGGETTO, SEARCH_DESCRIZIONE,
+  SEARCH_AGGIUDICATARIO, SEARCH_CF_AGGIUDICATARIO), costruiti da
+  scripts/convert_to_parquet.py --trigrams in data/trigrams/;
+- adiacenza CUP -> CIG e CIG -> aggiudicatari, costruita all'avvio;
+- prefissi per i suggerimenti (/api/suggest), costruiti all'avvio.
+"""
+
+import os
+from bisect import bisect_left
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Sotto questo numero di candidati smetto di intersecare e verifico direttamente
+VERIFY_THRESHOLD = 2000
+# Oltre questo numero di candidati l'indice non conviene rispetto al LIKE
+MAX_CANDIDATES = 200000
+
+# Suggerimenti: intervalli fino a questa dimensione si ordinano direttamente,
+# per quelli piu' grandi si parte dai valori piu' frequenti
+PREFIX_SCAN_MAX = 100000
+PREFIX_HEAVY_VALUES = 10000
+
+
+class TrigramIndex:
+    def __init__(self, values, postings):
+        self.values = values  # value_id -> valore originale
+        self.postings = postings  # trigramma -> array ordinato di value_id
+
+    @classmethod
+    def load(cls, base):
+        values = pq.read_table(f"{base}.values.parquet", columns=["value"])
+        table = pq.read_table(f"{base}.postings.parquet")
+        value_ids = table.column("value_ids").combine_chunks()
+        offsets = value_ids.offsets.to_pylist()
+        flat = value_ids.values
+        postings = {}
+        for i, trigram in enumerate(table.column("trigram").to_pylist()):
+            postings[trigram] = flat.slice(offsets[i], offsets[i + 1] - offsets[i])
+        return cls(values.column("value").combine_chunks(), postings)
+
+    def lookup(self, needle, max_values):
+        """
+        Valori distinti che contengono needle (senza distinzione maiuscole).
+        Ritorna None se l'indice non restringe abbastanza (needle < 3
+        caratteri o piu' di max_values valori): meglio la scansione LIKE.
+        """
+        needle = needle.lower()
+        if len(needle) < 3:
+            return None
+        trigrams = {needle[i:i + 3] for i in range(len(needle) - 2)}
+        lists = []
+        for trigram in trigrams:
+            ids = self.postings.get(trigram)
+            if ids is None:
+                return []
+            lists.append(ids)
+        lists.sort(key=len)
+
+        # Intersezione dalla lista piu' corta: hash sui candidati, probe sulle altre
+        candidates = lists[0]
+        for ids in lists[1:]:
+            if len(candidates) <= VERIFY_THRESHOLD:
+                break
+            candidates = ids.filter(pc.is_in(ids, value_set=candidates))
+        if len(candidates) > MAX_CANDIDATES:
+            return None
+
+        # Verifica: i trigrammi comuni non garantiscono la sottostringa
+        values = self.values.take(candidates)
+        matched = values.filter(pc.match_substring(pc.utf8_lower(values), needle))
+        if len(matched) > max_values:
+            return None
+        return matched.to_pylist()
+
+
+def load_trigram_indexes(directory, sources=None):
+    """
+    Carica gli indici presenti in directory. Ritorna {nome: TrigramIndex}.
+    sources: {nome: parquet di origine}; un indice piu' vecchio del suo
+    parquet non rispecchia piu' i valori e viene ignorato.
+    """
+    indexes = {}
+    if not os.path.isdir(directory):
+        return indexes
+    for fname in sorted(os.listdir(directory)):
+        if not fname.endswith(".postings.parquet"):
+            continue
+        name = fname[:-len(".postings.parquet")]
+        base = os.path.join(directory, name)
+        files = [f"{base}.values.parquet", f"{base}.postings.parquet"]
+        if not os.path.exists(files[0]):
+            continue
+        source = (sources or {}).get(name)
+        if source and os.path.exists(source) and min(
+            os.path.getmtime(f) for f in files
+        ) < os.path.getmtime(source):
+            continue
+        indexes[name] = TrigramIndex.load(base)
+    return indexes
+
+
+class _SortedKeys:
+    """Vista per bisect su una StringArray ordinata, senza copiarla in una lista."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, i):
+        return self.array[i].as_py()
+
+
+class AdjacencyIndex:
+    """
+    Relazione chiave -> righe su array Arrow: chiavi distinte ordinate,
+    offset e una tabella ordinata per chiave. Lookup O(log n) con bisect,
+    le righe sono slice della tabella (nessuna copia).
+    """
+
+    def __init__(self, table, key_col):
+        # table deve essere gia' ordinata per key_col, senza chiavi nulle
+        self.table = table.combine_chunks()
+        column = self.table.column(key_col).combine_chunks()
+        n = len(column)
+        if n:
+            changes = pc.indices_nonzero(
+                pc.not_equal(column.slice(1), column.slice(0, n - 1))
+            )
+            starts = pa.concat_arrays([
+                pa.array([0], pa.uint64()), pc.add(changes, pa.scalar(1, pa.uint64())),
+            ])
+            self.keys = column.take(starts)
+            self.offsets = pa.concat_arrays([starts, pa.array([n], pa.uint64())])
+        else:
+            self.keys = column
+            self.offsets = pa.array([0], pa.uint64())
+        self._sorted = _SortedKeys(self.keys)
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes + self.keys.nbytes + self.offsets.nbytes
+
+    def _slice(self, lo, hi):
+        start = self.offsets[lo].as_py()
+        return self.table.slice(start, self.offsets[hi].as_py() - start)
+
+    def lookup(self, key):
+        """Righe (tabella Arrow) con chiave uguale a key."""
+        i = bisect_left(self._sorted, key)
+        if i < len(self._sorted) and self._sorted[i] == key:
+            return self._slice(i, i + 1)
+        return self.table.slice(0, 0)
+
+    def lookup_prefix(self, prefix):
+        """Righe con chiave che inizia per prefix."""
+        lo = bisect_left(self._sorted, prefix)
+        hi = bisect_left(self._sorted, prefix + "\U0010ffff", lo)
+        return self._slice(lo, hi)
+
+    def __contains__(self, key):
+        i = bisect_left(self._sorted, key)
+        return i < len(self._sorted) and self._sorted[i] == key
+
+
+class PrefixIndex:
+    """
+    Completamento per prefisso su chiavi normalizzate (maiuscole per i
+    codici, minuscole per i nomi) ordinate, con valore originale e
+    frequenza. I candidati sono un intervallo contiguo trovato con bisect;
+    i primi k per frequenza (a parita', per chiave) vengono da select_k
+    sull'intervallo o, se e' grande, dai valori piu' frequenti.
+    """
+
+    def __init__(self, table, normalize):
+        # table: key, value, count, ordinata per key
+        self.table = table.combine_chunks()
+        self.normalize = normalize
+        self._sorted = _SortedKeys(self.table.column("key").combine_chunks())
+        counts = self.table.column("count")
+        # Frequenze tutte uguali (codici univoci): bastano i primi k dell'intervallo
+        self.uniform = self.table.num_rows == 0 or pc.max(counts).as_py() <= 1
+        top = self._top(self.table, PREFIX_HEAVY_VALUES + 1)
+        self.heavy = top.slice(0, PREFIX_HEAVY_VALUES)
+        # Frequenza massima fuori dai piu' frequenti
+        self.heavy_floor = (
+            top.column("count")[PREFIX_HEAVY_VALUES].as_py()
+            if top.num_rows > PREFIX_HEAVY_VALUES else 0
+        )
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes + self.heavy.nbytes
+
+    @staticmethod
+    def _top(table, k):
+        if not table.num_rows:
+            return table
+        return table.take(pc.select_k_unstable(
+            table, k, sort_keys=[("count", "descending"), ("key", "ascending"),
+                                 ("value", "ascending")],
+        ))
+
+    def lookup(self, prefix, k):
+        """Righe (tabella Arrow: key, value, count) dei primi k valori con il prefisso."""
+        prefix = self.normalize(prefix)
+        if not prefix or k <= 0:
+            return self.table.slice(0, 0)
+        lo = bisect_left(self._sorted, prefix)
+        hi = bisect_left(self._sorted, prefix + "\U0010ffff", lo)
+        candidates = self.table.slice(lo, hi - lo)
+        if self.uniform:
+            return candidates.slice(0, k)
+        if hi - lo > PREFIX_SCAN_MAX:
+            matches = self.heavy.filter(
+                pc.starts_with(self.heavy.column("key"), pattern=prefix)
+            )
+            # Tutti i valori esclusi hanno frequenza <= heavy_floor
+            if (matches.num_rows >= k
+                    and matches.column("count")[k - 1].as_py() >= self.heavy_floor):
+                return matches.slice(0, k)
+        return self._top(candidates, k)
@@ -0,0 +1,164 @@
+"""
+Job di export in background: il file viene scritto da un pool di worker in
+una directory di spool e servito a fine lavoro (con supporto Range).
+Export identici (stesso dataset, formato, ricerca e filtri) riusano il file
+gia' prodotto finche' non scade il TTL.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+
+from .export import export_format
+from .queries import data_version
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXPORT_SPOOL_DIR = os.environ.get(
+    "EXPORT_SPOOL_DIR", os.path.join(BASE_DIR, "data", "exports")
+)
+EXPORT_JOB_WORKERS = int(os.environ.get("EXPORT_JOB_WORKERS", "2"))
+EXPORT_JOB_TTL = int(os.environ.get("EXPORT_JOB_TTL", "3600"))
+
+DATASETS = ("progetti", "cig")
+
+# File prodotti dai job: <id esadecimale>.<estensione>[.part]
+SPOOL_FILE = re.compile(r"[0-9a-f]{24}\.\w+(\.part)?")
+
+
+class ExportJobs:
+    def __init__(self, db, spool_dir=EXPORT_SPOOL_DIR,
+                 workers=EXPORT_JOB_WORKERS, ttl=EXPORT_JOB_TTL):
+        self.db = db
+        self.spool_dir = spool_dir
+        self.ttl = ttl
+        self._jobs = {}  # id -> stato del job
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="export"
+        )
+        # I job vivono in memoria: i file di un processo precedente sono orfani
+        os.makedirs(spool_dir, exist_ok=True)
+        for fname in os.listdir(spool_dir):
+            if SPOOL_FILE.fullmatch(fname):
+                os.remove(os.path.join(spool_dir, fname))
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _job_id(self, dataset, fmt, q, filters):
+        # Con la versione dei dati un refresh non riusa export ormai vecchi
+        key = self.db.compile_filters(dataset, q, filters).key
+        raw = json.dumps([fmt, key, data_version()], default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()[:24]
+
+    def submit(self, dataset, fmt, q="", filters=None):
+        """
+        Accoda un export (o riusa quello identico ancora valido).
+        Ritorna lo stato del job. Solleva ValueError su dataset/formato non validi.
+        """
+        if dataset not in DATASETS:
+            raise ValueError(f"Dataset export non valido: {dataset}")
+        _, ext, encoder, limit = export_format(fmt)
+        self._purge_expired()
+
+        job_id = self._job_id(dataset, fmt, q, filters)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] != "error":
+                return dict(job)
+            job = {
+                "id": job_id,
+                "dataset": dataset,
+                "format": fmt,
+                "status": "queued",
+                "rows": 0,
+                "total": None,
+                "bytes": 0,
+                "error": None,
+                "created": time.time(),
+                "finished": None,
+                "filename": f"{'cig' if dataset == 'cig' else 'opencup'}_export.{ext}",
+            }
+            self._jobs[job_id] = job
+        self._executor.submit(self._run, job, encoder, limit, q, filters)
+        return dict(job)
+
+    def get(self, job_id):
+        """Stato del job, o None se inesistente o scaduto."""
+        self._purge_expired()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def path(self, job_id):
+        """Percorso del file di un job completato, o None."""
+        job = self.get(job_id)
+        if job is None or job["status"] != "done":
+            return None
+        return self._path(job)
+
+    def _path(self, job):
+        ext = job["filename"].rsplit(".", 1)[1]
+        return os.path.join(self.spool_dir, f"{job['id']}.{ext}")
+
+    def _run(self, job, encoder, limit, q, filters):
+        """Worker: conta le righe, scrive il file in .part e lo rinomina a fine lavoro."""
+        path = self._path(job)
+        tmp_path = path + ".part"
+        try:
+            job["status"] = "running"
+            total = self.db.count_filtered(job["dataset"], q, filters)
+            if job["dataset"] == "cig":
+                reader = self.db.export_cigs(q=q, filters=filters, limit=limit)
+            else:
+                reader = self.db.export_query(q=q, filters=filters, limit=limit)
+            job["total"] = min(total, limit) if limit else total
+
+            with open(tmp_path, "wb") as f:
+                for chunk in encoder(_count_rows(reader, job)):
+                    f.write(chunk)
+                    job["bytes"] += len(chunk)
+            os.replace(tmp_path, path)
+            job["status"] = "done"
+        except Exception as e:
+            job["status"] = "error"
+            job["error"] = str(e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            job["finished"] = time.time()
+
+    def _purge_expired(self):
+        """Rimuove i job terminati da piu' di ttl secondi e i relativi file."""
+        now = time.time()
+        with self._lock:
+            expired = [
+                job for job in self._jobs.values()
+                if job["finished"] is not None and job["finished"] + self.ttl < now
+            ]
+            for job in expired:
+                del self._jobs[job["id"]]
+        for job in expired:
+            try:
+                os.remove(self._path(job))
+            except FileNotFoundError:
+                pass
+
+
+def _count_rows(reader, job):
+    """RecordBatchReader che aggiorna job["rows"] man mano che viene letto."""
+    def batches():
+        try:
+            for batch in reader:
+                job["rows"] += batch.num_rows
+                yield batch
+        finally:
+            reader.close()
+
+    return pa.RecordBatchReader.from_batches(reader.schema, batches())
@@ -4,8 +4,6 @@ Serve API REST + file statici del frontend.
 Autenticazione via endpoint AgenTik.
 """
 
-import csv
-import io
 import json
 import os
 import time
@@ -18,7 +16,9 @@ from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, Red
 from fastapi.staticfiles import StaticFiles
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 
-from .queries import Database
+from .export import EXPORT_FORMATS, export_format
+from .jobs import ExportJobs
+from .queries import DETAIL_BULK_MAX, Database
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 FRONTEND_DIR = os.path.join(BASE_DIR, "frontend")
@@ -43,10 +43,18 @@ app.add_middleware(
 )
 
 db = Database()
+jobs = ExportJobs(db)
+
+
+@app.on_event("startup")
+def startup():
+    # Faccette senza filtri: i dropdown si popolano senza scansioni
+    db.warm_facets()
 
 
 @app.on_event("shutdown")
 def shutdown():
+    jobs.close()
     db.close()
 
 
@@ -161,17 +169,59 @@ def get_stats():
     return db.get_stats()
 
 
+@app.get("/api/stats/filtered")
+def get_filtered_stats(request: Request, q: str = ""):
+    """Totali (progetti, CUP unici, costo, finanziamento) per ricerca e filtri attivi."""
+    filters = _parse_filters(request)
+    try:
+        totals, source = db.get_filtered_stats(filters=filters, q=q)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse({"totals": totals}, headers={"X-Stats-Source": source})
+
+
 @app.get("/api/filters/options")
 def get_filter_options():
     """Valori distinti per i filtri dropdown."""
     return db.get_filter_options()
 
 
+@app.get("/api/suggest")
+def suggest(
+    field: str,
+    prefix: str = "",
+    limit: int = Query(default=10, ge=1, le=50),
+):
+    """Suggerimenti per prefisso (CUP, CIG, soggetto, stazione appaltante, aggiudicatario)."""
+    try:
+        data = db.get_suggestions(field, prefix, limit)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return {"field": field, "prefix": prefix, "data": data}
+
+
+@app.get("/api/filters/facets")
+def get_facets(request: Request, q: str = ""):
+    """Conteggi per valore di ogni filtro, sotto la ricerca e gli altri filtri attivi."""
+    filters = _parse_filters(request)
+    try:
+        return db.get_facets("progetti", filters=filters, q=q)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+
+@app.get("/api/cache/stats")
+def get_cache_stats():
+    """Contatori della cache dei result set filtrati e dei prepared statement."""
+    return db.get_cache_stats()
+
+
 def _parse_filters(request: Request) -> dict:
     """Estrae i filtri dai query params."""
     filters = {}
     for key, val in request.query_params.items():
-        if key in ("q", "limit", "offset", "sort", "order"):
+        if key in ("q", "limit", "offset", "sort", "order", "count", "cursor", "format",
+                   "dataset", "fields", "totals"):
             continue
         if val:
             if "," in val:
@@ -189,6 +239,8 @@ def search_projects(
     offset: int = Query(default=0, ge=0),
     sort: Optional[str] = None,
     order: str = "ASC",
+    count: str = Query(default="exact", pattern="^(exact|capped)$"),
+    cursor: Optional[str] = None,
 ):
     """
     Lista progetti paginata con filtri.
@@ -196,22 +248,53 @@ def search_projects(
     Query params:
     - q: testo di ricerca
     - limit/offset: paginazione
+    - cursor: next_cursor della pagina precedente (alternativo a offset,
+      costo costante anche sulle pagine profonde)
     - sort/order: ordinamento
+    - count: exact (default) o capped (totale troncato a "10.000+")
     - qualsiasi colonna filtro = valore (es. STATO_PROGETTO=ATTIVO)
     """
     filters = _parse_filters(request)
-    rows, total = db.search_projects(
-        q=q, filters=filters, sort_col=sort, sort_dir=order,
-        limit=limit, offset=offset,
-    )
+    try:
+        rows, total, capped, next_cursor = db.search_projects(
+            q=q, filters=filters, sort_col=sort, sort_dir=order,
+            limit=limit, offset=offset, count_mode=count, cursor=cursor,
+        )
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
     return {
         "data": rows,
         "total": total,
+        "total_capped": capped,
         "limit": limit,
         "offset": offset,
+        "next_cursor": next_cursor,
     }
 
 
+@app.get("/api/projects/full")
+def get_projects_full(cups: str = ""):
+    """
+    Dettaglio + CIG + aggiudicatari di piu' CUP (cups=CUP1,CUP2,...),
+    per precaricare la pagina visibile della tabella.
+    """
+    cup_list = [c.strip() for c in cups.split(",") if c.strip()]
+    if len(cup_list) > DETAIL_BULK_MAX:
+        return JSONResponse(
+            {"error": f"Massimo {DETAIL_BULK_MAX} CUP per richiesta"}, status_code=400
+        )
+    return {"data": db.get_projects_full(cup_list)}
+
+
+@app.get("/api/projects/{cup}/full")
+def get_project_full(cup: str):
+    """Dettaglio di un progetto con CIG e aggiudicatari in una sola risposta."""
+    result = db.get_project_full(cup)
+    if not result:
+        return {"error": "Progetto non trovato"}
+    return result
+
+
 @app.get("/api/projects/{cup}/cig")
 def get_cig_for_project(cup: str):
     """CIG associati a un CUP."""
@@ -241,6 +324,16 @@ def get_cig_filter_options():
     return db.get_cig_filter_options()
 
 
+@app.get("/api/cig/filters/facets")
+def get_cig_facets(request: Request, q: str = ""):
+    """Conteggi per valore di ogni filtro CIG, sotto la ricerca e gli altri filtri attivi."""
+    filters = _parse_filters(request)
+    try:
+        return db.get_facets("cig", filters=filters, q=q)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+
 @app.get("/api/cig/search")
 def search_cigs(
     request: Request,
@@ -249,44 +342,42 @@ def search_cigs(
     offset: int = Query(default=0, ge=0),
     sort: Optional[str] = None,
     order: str = "ASC",
+    count: str = Query(default="exact", pattern="^(exact|capped)$"),
+    cursor: Optional[str] = None,
 ):
-    """Lista CIG paginata con filtri."""
+    """Lista CIG paginata con filtri (offset o cursor)."""
     filters = _parse_filters(request)
-    rows, total = db.search_cigs(
-        q=q, filters=filters, sort_col=sort, sort_dir=order,
-        limit=limit, offset=offset,
-    )
-    return {"data": rows, "total": total, "limit": limit, "offset": offset}
+    try:
+        rows, total, capped, next_cursor = db.search_cigs(
+            q=q, filters=filters, sort_col=sort, sort_dir=order,
+            limit=limit, offset=offset, count_mode=count, cursor=cursor,
+        )
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return {
+        "data": rows, "total": total, "total_capped": capped,
+        "limit": limit, "offset": offset, "next_cursor": next_cursor,
+    }
 
 
 @app.get("/api/cig/export")
 def export_cig_csv(
     request: Request,
     q: str = "",
+    format: str = "csv",
 ):
-    """Export CSV dei CIG filtrati (max 100k righe)."""
+    """Export dei CIG filtrati in streaming (format: csv, parquet, arrow, xlsx)."""
     filters = _parse_filters(request)
-    columns, rows = db.export_cigs(q=q, filters=filters)
-
-    def generate():
-        output = io.StringIO()
-        writer = csv.writer(output, delimiter=";")
-        writer.writerow(columns)
-        yield output.getvalue()
-        output.seek(0)
-        output.truncate(0)
-
-        for row in rows:
-            writer.writerow(row)
-            yield output.getvalue()
-            output.seek(0)
-            output.truncate(0)
-
+    try:
+        media_type, ext, encoder, limit = export_format(format)
+        reader = db.export_cigs(q=q, filters=filters, limit=limit)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
     return StreamingResponse(
-        generate(),
-        media_type="text/csv",
+        encoder(reader),
+        media_type=media_type,
         headers={
-            "Content-Disposition": "attachment; filename=cig_export.csv"
+            "Content-Disposition": f"attachment; filename=cig_export.{ext}"
         },
     )
 
@@ -307,6 +398,23 @@ def get_cig_detail(cig: str):
     return {"data": results}
 
 
+@app.get("/api/aggregations")
+def get_aggregations(
+    request: Request,
+    fields: str = "",
+    q: str = "",
+    totals: bool = False,
+):
+    """Aggregazioni su piu' campi (fields separati da virgola) in una sola query."""
+    filters = _parse_filters(request)
+    field_list = [f.strip() for f in fields.split(",") if f.strip()]
+    try:
+        data, source = db.get_aggregations(field_list, filters=filters, q=q, totals=totals)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(data, headers={"X-Aggregation-Source": source})
+
+
 @app.get("/api/aggregations/{field}")
 def get_aggregation(
     request: Request,
@@ -315,41 +423,84 @@ def get_aggregation(
 ):
     """Aggregazione dinamica per un campo specifico."""
     filters = _parse_filters(request)
-    return db.get_aggregation(field, filters=filters, q=q)
+    try:
+        rows, source = db.get_aggregation(field, filters=filters, q=q)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(rows, headers={"X-Aggregation-Source": source})
 
 
 @app.get("/api/export")
 def export_csv(
     request: Request,
     q: str = "",
+    format: str = "csv",
 ):
-    """Export CSV dei risultati filtrati (max 100k righe)."""
+    """Export dei risultati filtrati in streaming (format: csv, parquet, arrow, xlsx)."""
     filters = _parse_filters(request)
-    columns, rows = db.export_query(q=q, filters=filters)
-
-    def generate():
-        output = io.StringIO()
-        writer = csv.writer(output, delimiter=";")
-        writer.writerow(columns)
-        yield output.getvalue()
-        output.seek(0)
-        output.truncate(0)
-
-        for row in rows:
-            writer.writerow(row)
-            yield output.getvalue()
-            output.seek(0)
-            output.truncate(0)
-
+    try:
+        media_type, ext, encoder, limit = export_format(format)
+        reader = db.export_query(q=q, filters=filters, limit=limit)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
     return StreamingResponse(
-        generate(),
-        media_type="text/csv",
+        encoder(reader),
+        media_type=media_type,
         headers={
-            "Content-Disposition": "attachment; filename=opencup_export.csv"
+            "Content-Disposition": f"attachment; filename=opencup_export.{ext}"
         },
     )
 
 
+def _export_job_response(job, status_code=200):
+    """Stato di un job di export, con l'URL di download quando e' pronto."""
+    job["download_url"] = (
+        f"/api/exports/{job['id']}/download" if job["status"] == "done" else None
+    )
+    return JSONResponse(job, status_code=status_code)
+
+
+@app.post("/api/exports")
+def create_export(
+    request: Request,
+    dataset: str = "progetti",
+    q: str = "",
+    format: str = "csv",
+):
+    """
+    Accoda un export in background (dataset: progetti o cig).
+    I filtri sono gli stessi di /api/export; un export identico ancora
+    valido viene riusato.
+    """
+    filters = _parse_filters(request)
+    try:
+        job = jobs.submit(dataset, format, q=q, filters=filters)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return _export_job_response(job, status_code=202)
+
+
+@app.get("/api/exports/{job_id}")
+def get_export(job_id: str):
+    """Stato di un job di export: righe scritte, totale, byte."""
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse({"error": "Export non trovato"}, status_code=404)
+    return _export_job_response(job)
+
+
+@app.get("/api/exports/{job_id}/download")
+def download_export(job_id: str):
+    """File di un export completato (supporta richieste Range)."""
+    job = jobs.get(job_id)
+    path = jobs.path(job_id)
+    if job is None or path is None:
+        return JSONResponse({"error": "Export non disponibile"}, status_code=404)
+    return FileResponse(
+        path, media_type=EXPORT_FORMATS[job["format"]][0], filename=job["filename"]
+    )
+
+
 # --- Frontend static files ---
 
 @app.get("/favicon.ico")
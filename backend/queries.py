@@ -3,10 +3,26 @@ Modulo query DuckDB per l'API OpenCUP.
 Gestisce connessione, query filtrate, aggregazioni e cache.
 """
 
+import base64
 import duckdb
 import json
 import os
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
 from functools import lru_cache
+from itertools import groupby
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .cache import ResultCache
+from .filters import CompiledFilter, normalize_filters
+from .indexes import AdjacencyIndex, PrefixIndex, load_trigram_indexes
+from .statements import PreparedCursor, StatementCache
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATA_DIR = os.path.join(BASE_DIR, "data")
@@ -14,6 +30,80 @@ PARQUET_FILE = os.path.join(DATA_DIR, "progetti.parquet").replace(os.sep, "/")
 CIG_PARQUET = os.path.join(DATA_DIR, "cig.parquet").replace(os.sep, "/")
 AGGIUDICATARI_PARQUET = os.path.join(DATA_DIR, "aggiudicatari.parquet").replace(os.sep, "/")
 STATS_FILE = os.path.join(DATA_DIR, "stats.json")
+CUBE_PARQUET = os.path.join(DATA_DIR, "aggregazioni.parquet").replace(os.sep, "/")
+# Database DuckDB persistente (opzionale, creato con convert_to_parquet.py --duckdb)
+DUCKDB_FILE = os.path.join(DATA_DIR, "opencup.duckdb")
+# Indici trigrammi (opzionali, creati con convert_to_parquet.py --trigrams):
+# nome -> parquet da cui sono calcolati
+TRIGRAM_DIR = os.path.join(DATA_DIR, "trigrams")
+TRIGRAM_SOURCES = {
+    "soggetto": PARQUET_FILE,
+    "descrizione": PARQUET_FILE,
+    "aggiudicatario": AGGIUDICATARI_PARQUET,
+    "cf_aggiudicatario": AGGIUDICATARI_PARQUET,
+}
+# Oltre questo numero di valori distinti il filtro "contiene" torna al LIKE
+TRIGRAM_MAX_VALUES = 5000
+# Separatore dei valori passati come unico parametro (string_split)
+VALUE_SEP = "\x1f"
+
+# Adiacenza CUP -> CIG -> aggiudicatari in memoria (0 per disattivarla)
+ADJACENCY_INDEX = os.environ.get("ADJACENCY_INDEX", "1") == "1"
+# SEARCH_CIG: oltre questo numero di CUP meglio la subquery su cig
+CIG_PREFIX_MAX_CUPS = 5000
+
+# Indici per prefisso dei suggerimenti (/api/suggest), costruiti all'avvio
+# e ricostruiti quando il convertitore riscrive i dati
+SUGGEST_INDEX = os.environ.get("SUGGEST_INDEX", "1") == "1"
+SUGGEST_MAX_LIMIT = 50
+# campo -> (tabella, colonna, codice): i codici si confrontano in maiuscolo,
+# i nomi senza distinzione maiuscole/minuscole
+SUGGEST_FIELDS = {
+    "CUP": ("progetti", "CUP", True),
+    "CIG": ("cig", "CIG", True),
+    "SOGGETTO_TITOLARE": ("progetti", "SOGGETTO_TITOLARE", False),
+    "amm_appaltante": ("cig", "amm_appaltante", False),
+    "denominazione": ("aggiudicatari", "denominazione", False),
+}
+
+# Valori restituiti per campo dalle aggregazioni
+AGGREGATION_LIMIT = 30
+
+# Cubo di aggregazione pre-calcolato dal convertitore (0 = sempre scansione)
+AGGREGATION_CUBE = os.environ.get("AGGREGATION_CUBE", "1") == "1"
+CUBE_DIMENSIONS = [
+    "REGIONE", "ANNO_DECISIONE", "STATO_PROGETTO",
+    "SETTORE_INTERVENTO", "NATURA_INTERVENTO", "AREA_INTERVENTO",
+]
+
+# Soglia del conteggio "capped": oltre questo numero il totale e' "10.000+"
+COUNT_CAP = 10000
+
+# Cache dei result set filtrati (paginazione/riordino senza riscansione)
+RESULT_CACHE_MB = int(os.environ.get("RESULT_CACHE_MB", "512"))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", "600"))
+RESULT_CACHE_MAX_ROWS = int(os.environ.get("RESULT_CACHE_MAX_ROWS", "1000000"))
+
+# Totali filtrati memorizzati per chiave di filtro (numero di voci)
+STATS_CACHE_SIZE = int(os.environ.get("STATS_CACHE_SIZE", "1024"))
+STATS_CACHE_TTL = int(os.environ.get("STATS_CACHE_TTL", "86400"))
+# Faccette memorizzate (una voce per colonna e combinazione degli altri filtri)
+FACETS_CACHE_SIZE = int(os.environ.get("FACETS_CACHE_SIZE", "4096"))
+
+# Export in streaming: righe per record batch (limiti per formato in export.py)
+EXPORT_BATCH_ROWS = 10000
+
+# Numero di cursori DuckDB nel pool (uno per thread worker attivo)
+# Dettagli in blocco: massimo CUP per richiesta e, con gli indici ART, fino
+# a quante chiavi conviene un lookup per chiave invece di una scansione
+DETAIL_BULK_MAX = int(os.environ.get("DETAIL_BULK_MAX", "50"))
+POINT_LOOKUP_MAX = 200
+
+POOL_SIZE = int(os.environ.get("DUCKDB_POOL_SIZE", os.cpu_count() or 4))
+
+# Ricaricamento dei dati: secondi senza modifiche ai file prima di costruire
+# il nuovo snapshot (il convertitore riscrive i file uno dopo l'altro)
+DATA_RELOAD_QUIET = float(os.environ.get("DATA_RELOAD_QUIET", "30"))
 
 # Colonne CIG mostrate nella tabella
 CIG_DEFAULT_COLUMNS = [
@@ -32,6 +122,13 @@ CIG_FILTER_COLUMNS = [
     "criterio_aggiudicazione", "prestazioni_comprese",
 ]
 
+# Filtri CIG oltre alle colonne (flag, ricerche aggiudicatario, range importo)
+CIG_EXTRA_FILTERS = {
+    "ONLY_PNRR", "FLAG_SUBAPPALTO", "HAS_DETAIL",
+    "SEARCH_AGGIUDICATARIO", "SEARCH_CF_AGGIUDICATARIO",
+    "importo_min", "importo_max",
+}
+
 # Colonne CIG ricercabili
 CIG_SEARCH_COLUMNS = ["CIG", "CUP", "oggetto_gara", "amm_appaltante"]
 
@@ -88,12 +185,29 @@ FILTER_COLUMNS = [
     "CATEGORIA_SOGGETTO", "SOTTOCATEGORIA_SOGGETTO",
 ]
 
+# Filtri progetti oltre alle colonne (flag CIG, ricerche dedicate, range costo)
+EXTRA_FILTERS = {
+    "HAS_CIG", "HAS_AGGIUDICATARI", "SEARCH_SOGGETTO", "SEARCH_DESCRIZIONE",
+    "SEARCH_CUP", "SEARCH_CIG", "costo_min", "costo_max",
+}
+
 # Colonne ricercabili (full-text)
 SEARCH_COLUMNS = [
     "CUP", "DESCRIZIONE_SINTETICA_CUP", "SOGGETTO_TITOLARE",
     "DENOMINAZIONE_BENEFICIARIO",
 ]
 
+# Colonne numeriche di progetti (VARCHAR nei Parquet non tipizzati)
+NUMERIC_COLUMNS = {
+    "ANNO_DECISIONE", "COSTO_PROGETTO", "FINANZIAMENTO_PROGETTO",
+    "ANNO_DELIBERA",
+}
+INTEGER_TYPES = {"TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT"}
+FLOAT_TYPES = {"FLOAT", "REAL", "DOUBLE"}
+
+# Sintesi dei CIG collegati, denormalizzata in progetti.parquet dal convertitore
+CIG_SUMMARY_COLUMNS = ["HAS_CIG", "HAS_AGGIUDICATARI", "N_CIG", "IMPORTO_CIG_TOTALE"]
+
 # Tutte le colonne del dataset
 ALL_COLUMNS = [
     "CUP", "DESCRIZIONE_SINTETICA_CUP", "ANNO_DECISIONE", "STATO_PROGETTO",
@@ -129,552 +243,1623 @@ ALL_COLUMNS = [
 ]
 
 
-class Database:
-    def __init__(self):
+# Codici completi CUP (15 caratteri) e CIG (10 caratteri, almeno una cifra):
+# la ricerca libera diventa un'uguaglianza risolta dagli indici
+CUP_PATTERN = re.compile(r"[A-Z][0-9]{2}[A-Z][0-9A-Z]{11}")
+CIG_PATTERN = re.compile(r"(?=.*[0-9])[0-9A-Z]{10}")
+
+
+def encode_cursor(sort_col, direction, value, key):
+    """Cursore opaco per la paginazione keyset: ordinamento, ultimo valore e chiave."""
+    raw = json.dumps([sort_col, direction, value, key], default=str)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decodifica un cursore keyset. Solleva ValueError se non valido."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_col, direction, value, key = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError("Cursore non valido")
+    return sort_col, direction, value, key
+
+
+def _keyset_clause(cursor, sort_col, direction, sort_expr, key_col):
+    """
+    Predicato per le righe successive al cursore nell'ordine
+    (sort_expr direction NULLS LAST, key_col). Ritorna (sql, params).
+    """
+    c_sort, c_dir, value, key = decode_cursor(cursor)
+    if c_sort != sort_col or c_dir != direction:
+        raise ValueError("Cursore non valido per l'ordinamento richiesto")
+    if sort_col is None:
+        return f"{key_col} > ?", [key]
+    if value is None:
+        return f"({sort_expr} IS NULL AND {key_col} > ?)", [key]
+    op = "<" if direction == "DESC" else ">"
+    return (
+        f"({sort_expr} {op} ? OR ({sort_expr} = ? AND {key_col} > ?) "
+        f"OR {sort_expr} IS NULL)",
+        [value, value, key],
+    )
+
+
+def _sort_value(row, sort_col, numeric):
+    """Valore di ordinamento dell'ultima riga (come lo vede l'ORDER BY)."""
+    if sort_col is None:
+        return None
+    value = row.get(sort_col)
+    if numeric and isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    return value
+
+
+def duckdb_is_current():
+    """True se il database persistente esiste e non e' piu' vecchio dei parquet."""
+    if not os.path.exists(DUCKDB_FILE):
+        return False
+    mtime = os.path.getmtime(DUCKDB_FILE)
+    return all(
+        not os.path.exists(path) or os.path.getmtime(path) <= mtime
+        for path in (PARQUET_FILE, CIG_PARQUET, AGGIUDICATARI_PARQUET)
+    )
+
+
+def data_version():
+    """
+    Firma (mtime, dimensione) dei file dati: cambia a ogni riscrittura (la
+    cartella dei trigrammi cambia quando il convertitore vi rinomina i file).
+    """
+    version = []
+    for path in (PARQUET_FILE, CIG_PARQUET, AGGIUDICATARI_PARQUET, DUCKDB_FILE,
+                 STATS_FILE, CUBE_PARQUET, TRIGRAM_DIR):
+        try:
+            st = os.stat(path)
+            version.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+class DataSnapshot:
+    """
+    Tutto lo stato derivato dai file dati: connessione, sorgenti, schema,
+    indici in memoria, prepared statement, pool di cursori e cache.
+    Costruito per intero prima di essere pubblicato (vedi
+    Database._check_data_version); sorgenti e indici non cambiano piu'.
+    """
+
+    def __init__(self, pool_size):
+        """
+        Apre la sorgente dati, ne legge lo schema, costruisce gli indici in
+        memoria derivati dai dati e crea il pool di cursori.
+        """
+        self.version = data_version()
+        # Se esiste il database persistente (e non e' piu' vecchio dei parquet)
+        # lo apro in sola lettura: tabelle native con indici ART su CUP/CIG
+        # per i lookup puntuali. Altrimenti leggo direttamente i file Parquet.
         self.con = duckdb.connect()
         self.con.execute("SET memory_limit = '4GB'")
+        tables = set()
+        if duckdb_is_current():
+            # ATTACH su un'istanza nuova invece di connect(DUCKDB_FILE): DuckDB
+            # riusa l'istanza gia' aperta sullo stesso path, che dopo os.replace
+            # legge ancora il file precedente
+            path = DUCKDB_FILE.replace(os.sep, "/")
+            self.con.execute(f"ATTACH '{path}' AS opencup (READ_ONLY)")
+            self.con.execute("USE opencup")
+            tables = {r[0] for r in self.con.execute("SHOW TABLES").fetchall()}
+
+        self.src_progetti = "progetti" if "progetti" in tables else f"'{PARQUET_FILE}'"
+        # Tabelle native: gli indici ART su CUP/CIG rendono economici i lookup puntuali
+        self.indexed = bool(tables)
+        self.src_cig = "cig" if "cig" in tables else f"'{CIG_PARQUET}'"
+        self.src_aggiudicatari = (
+            "aggiudicatari" if "aggiudicatari" in tables
+            else f"'{AGGIUDICATARI_PARQUET}'"
+        )
+
+        # Indici full-text creati dal convertitore (estensione fts)
+        self.fts_tables = set()
+        if tables:
+            schemas = {
+                r[0] for r in
+                self.con.execute("SELECT schema_name FROM duckdb_schemas()").fetchall()
+            }
+            fts = {t for t in ("progetti", "cig") if f"fts_main_{t}" in schemas}
+            if fts:
+                try:
+                    self.con.execute("LOAD fts")
+                    self.fts_tables = fts
+                except duckdb.Error:
+                    pass
+
+        # Schema effettivo di progetti: le colonne di sintesi CIG ci sono
+        # solo se il convertitore le ha denormalizzate
+        try:
+            self.progetti_types = {
+                r[0]: r[1] for r in
+                self.con.execute(f"DESCRIBE SELECT * FROM {self.src_progetti}").fetchall()
+            }
+        except duckdb.Error:
+            self.progetti_types = {}
+        self.cig_summary = all(c in self.progetti_types for c in CIG_SUMMARY_COLUMNS)
+        # Schema di cig: i filtri confrontano valori nel tipo nativo della colonna
+        try:
+            self.cig_types = {
+                r[0]: r[1] for r in
+                self.con.execute(f"DESCRIBE SELECT * FROM {self.src_cig}").fetchall()
+            }
+        except duckdb.Error:
+            self.cig_types = {}
+        self.all_columns = ALL_COLUMNS + [
+            c for c in CIG_SUMMARY_COLUMNS if c in self.progetti_types
+        ]
+
+        # Cubo di aggregazione: tabella nativa o parquet del convertitore
+        self.src_cube = self._load_cube(tables) if AGGREGATION_CUBE else None
+
+        # Indici trigrammi per le ricerche "contiene"
+        self.trigrams = load_trigram_indexes(TRIGRAM_DIR, TRIGRAM_SOURCES)
+
+        # Adiacenza CUP -> CIG -> aggiudicatari: dettagli senza I/O
+        self.cup_cigs, self.cig_cups, self.cig_aggiudicatari = (
+            self._build_adjacency() if ADJACENCY_INDEX else (None, None, None)
+        )
+
+        # Prefissi per i suggerimenti: campo -> PrefixIndex
+        self.suggest = self._build_suggest() if SUGGEST_INDEX else {}
+
+        # Pool di cursori: ogni thread del threadpool di Starlette ne usa uno
+        # proprio, cosi le richieste concorrenti non si serializzano su self.con
+        # (le query con parametri passano dalla cache dei prepared statement).
+        # Statement e pool sono legati alla connessione: nuovi a ogni apertura,
+        # quelli precedenti vengono chiusi quando non sono piu' referenziati
+        self._statements = StatementCache()
+        pool = queue.LifoQueue()
+        self._cursors = [self._new_cursor() for _ in range(pool_size)]
+        for cur in self._cursors:
+            pool.put(PreparedCursor(cur, self._statements))
+        self._pool = pool
+
+        # Cache dei risultati: valgono per questi dati, uno snapshot nuovo
+        # parte da cache vuote
         self._stats_cache = None
-        self._filter_options_cache = None
+        self._result_cache = ResultCache(
+            RESULT_CACHE_MB * 1024 * 1024, RESULT_CACHE_TTL
+        )
+        # Totali esatti dei filtri gia' visti una volta: il result set si
+        # materializza solo al secondo accesso e se entra in RESULT_CACHE_MAX_ROWS
+        self._result_totals = ResultCache(STATS_CACHE_SIZE, RESULT_CACHE_TTL)
+        # Ogni voce conta 1: il limite e' sul numero di filtri memorizzati
+        self._stats_memo = ResultCache(STATS_CACHE_SIZE, STATS_CACHE_TTL)
+        # Faccette senza filtri (calcolate all'avvio, vedi warm_facets) e filtrate
+        self._facets_base = {}
+        self._facets_memo = ResultCache(FACETS_CACHE_SIZE, STATS_CACHE_TTL)
+
+    def _new_cursor(self):
+        """Cursore della connessione corrente (USE non si eredita dalla connessione)."""
+        cur = self.con.cursor()
+        if self.indexed:
+            cur.execute("USE opencup")
+        return cur
+
+    def _build_adjacency(self):
+        """
+        Indici CUP -> CIG, CIG -> CUP e CIG -> aggiudicatari (righe ordinate).
+        Ritorna la terna (None dove la sorgente manca).
+        """
+        try:
+            links = self.con.execute(f"""
+                SELECT DISTINCT CUP, CIG FROM {self.src_cig}
+                WHERE CUP IS NOT NULL AND CIG IS NOT NULL
+                ORDER BY CUP, CIG
+            """).arrow()
+        except duckdb.Error:
+            return None, None, None
+        cup_cigs = AdjacencyIndex(links, "CUP")
+        cig_cups = AdjacencyIndex(
+            links.sort_by([("CIG", "ascending"), ("CUP", "ascending")]), "CIG"
+        )
+        try:
+            aggiudicatari = self.con.execute(f"""
+                SELECT * FROM {self.src_aggiudicatari}
+                WHERE CIG IS NOT NULL
+                ORDER BY CIG, ruolo NULLS LAST, denominazione
+            """).arrow()
+        except duckdb.Error:
+            return cup_cigs, cig_cups, None
+        return cup_cigs, cig_cups, AdjacencyIndex(aggiudicatari, "CIG")
+
+    def _suggest_source(self, field):
+        """(sorgente, colonna, chiave SQL, normalizzazione) di un campo suggeribile."""
+        table, col, code = SUGGEST_FIELDS[field]
+        source = {
+            "progetti": self.src_progetti,
+            "cig": self.src_cig,
+            "aggiudicatari": self.src_aggiudicatari,
+        }[table]
+        if code:
+            return source, col, f'"{col}"', str.upper
+        return source, col, f'lower("{col}")', str.lower
+
+    def _build_suggest(self):
+        """Indici per prefisso dei campi di SUGGEST_FIELDS: valori distinti con frequenza."""
+        indexes = {}
+        for field in SUGGEST_FIELDS:
+            source, col, key_sql, normalize = self._suggest_source(field)
+            try:
+                table = self.con.execute(f"""
+                    SELECT {key_sql} AS key, "{col}" AS value, COUNT(*) AS count
+                    FROM {source}
+                    WHERE "{col}" IS NOT NULL AND "{col}" != ''
+                    GROUP BY ALL
+                    ORDER BY key, value
+                """).arrow()
+            except duckdb.Error:
+                continue
+            indexes[field] = PrefixIndex(table, normalize)
+        return indexes
+
+    def _load_cube(self, tables):
+        """
+        Sorgente del cubo di aggregazione, o None se assente o non allineato
+        a progetti (tipi delle dimensioni o totale righe diversi).
+        """
+        if "aggregazioni" in tables:
+            source = "aggregazioni"
+        elif not tables and os.path.exists(CUBE_PARQUET):
+            source = f"'{CUBE_PARQUET}'"
+        else:
+            return None
+        try:
+            types = {
+                r[0]: r[1] for r in
+                self.con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()
+            }
+            if any(types.get(c) != self.progetti_types.get(c) for c in CUBE_DIMENSIONS):
+                return None
+            n_cube, n_progetti = self.con.execute(f"""
+                SELECT (SELECT SUM(n) FROM {source}),
+                       (SELECT COUNT(*) FROM {self.src_progetti})
+            """).fetchone()
+        except duckdb.Error:
+            return None
+        return source if n_cube == n_progetti else None
 
     def close(self):
+        for cur in self._cursors:
+            cur.close()
         self.con.close()
 
-    def get_stats(self):
-        """Ritorna le statistiche pre-calcolate dal file JSON."""
-        if self._stats_cache is None:
-            with open(STATS_FILE, "r", encoding="utf-8") as f:
-                self._stats_cache = json.load(f)
-        return self._stats_cache
 
-    def get_filter_options(self):
-        """Ritorna i valori distinti per ogni colonna filtro."""
-        if self._filter_options_cache is not None:
-            return self._filter_options_cache
-
-        options = {}
-        for col in FILTER_COLUMNS:
-            rows = self.con.execute(f"""
-                SELECT DISTINCT "{col}"
-                FROM '{PARQUET_FILE}'
-                WHERE "{col}" IS NOT NULL AND "{col}" != ''
-                ORDER BY "{col}"
-            """).fetchall()
-            options[col] = [r[0] for r in rows]
+class Database:
+    def __init__(self, pool_size=POOL_SIZE):
+        self.pool_size = max(1, int(pool_size))
+        # Un solo snapshot in costruzione alla volta (vedi _check_data_version)
+        self._reload_lock = threading.Lock()
+        # Snapshot fissato da ciascun thread all'inizio di un'operazione
+        self._local = threading.local()
+        self._state = DataSnapshot(self.pool_size)
+
+    def __getattr__(self, name):
+        # Sorgenti, schema, indici, cache e pool vengono dallo snapshot fissato
+        # dal thread: un'operazione non mescola lo SQL compilato su un
+        # caricamento dei dati con i cursori di un altro
+        if name in ("_local", "_state"):
+            raise AttributeError(name)
+        return getattr(self._snapshot(), name)
+
+    def _snapshot(self):
+        """Snapshot fissato dal thread corrente (l'ultimo pubblicato se nessuno)."""
+        state = getattr(self._local, "state", None)
+        return state if state is not None else self._state
 
-        self._filter_options_cache = options
-        return options
+    def close(self):
+        self._state.close()
 
-    def search_projects(self, q="", filters=None, sort_col=None,
-                        sort_dir="ASC", limit=50, offset=0):
+    @contextmanager
+    def cursor(self):
         """
-        Ricerca progetti con filtri, ordinamento e paginazione.
-        Ritorna (rows, total_count).
+        Context manager: cursore del pool dello snapshot del thread per la
+        durata del blocco (attende se sono tutti in uso).
         """
-        where_clauses = []
-        params = []
+        pool = self._pool
+        cur = pool.get()
+        try:
+            yield cur
+        finally:
+            pool.put(cur)
 
-        # Ricerca testuale
-        if q:
-            search_parts = []
-            for col in SEARCH_COLUMNS:
-                search_parts.append(f'LOWER("{col}") LIKE ?')
-                params.append(f"%{q.lower()}%")
+    def _text_filter(self, table, q):
+        """
+        Filtro per la ricerca libera q. Ritorna (sql, params, score_sql):
+        - codice CUP completo o CIG esistente: uguaglianza, risolta dagli
+          indici ART (un codice di 10 caratteri che non e' un CIG, ad esempio
+          un prefisso di CUP, resta una ricerca testuale)
+        - indice full-text presente: match BM25 (stemming italiano, accenti
+          rimossi); score_sql e' l'espressione di rilevanza (parametro q)
+        - altrimenti LIKE sulle colonne di ricerca
+        """
+        code = q.strip().upper()
+        if table == "progetti":
+            if CUP_PATTERN.fullmatch(code):
+                return "CUP = ?", [code], None
+            if CIG_PATTERN.fullmatch(code) and self._cig_exists(code):
+                if self.cig_cups is not None:
+                    sql, params = self._in_values("CUP", self.cig_cups.lookup(code).column("CUP"))
+                    return sql, params, None
+                return f"CUP IN (SELECT CUP FROM {self.src_cig} WHERE CIG = ?)", [code], None
+            key_col = "CUP"
+        else:
+            if CIG_PATTERN.fullmatch(code) and self._cig_exists(code):
+                return "CIG = ?", [code], None
+            if CUP_PATTERN.fullmatch(code):
+                return "CUP = ?", [code], None
+            key_col = "CIG"
+
+        if table in self.fts_tables:
+            score_sql = f"fts_main_{table}.match_bm25({key_col}, ?, conjunctive := 1)"
+            return f"{score_sql} IS NOT NULL", [q], score_sql
+
+        like = f"%{q.lower()}%"
+        if table == "progetti":
+            parts = [f'LOWER("{col}") LIKE ?' for col in SEARCH_COLUMNS]
             # Cerca anche per codice CIG
-            search_parts.append(
-                f"CUP IN (SELECT DISTINCT CUP FROM '{CIG_PARQUET}' WHERE LOWER(CIG) LIKE ?)"
+            parts.append(
+                f"CUP IN (SELECT DISTINCT CUP FROM {self.src_cig} WHERE LOWER(CIG) LIKE ?)"
             )
-            params.append(f"%{q.lower()}%")
-            where_clauses.append(f"({' OR '.join(search_parts)})")
-
-        # Filtri
-        if filters:
-            for col, val in filters.items():
-                if col in FILTER_COLUMNS and val:
-                    if isinstance(val, list):
-                        placeholders = ", ".join(["?"] * len(val))
-                        where_clauses.append(f'"{col}" IN ({placeholders})')
-                        params.extend(val)
-                    else:
-                        where_clauses.append(f'"{col}" = ?')
-                        params.append(val)
-
-            # Filtro Ha CIG
-            if filters.get("HAS_CIG") == "SI":
-                where_clauses.append(
-                    f"CUP IN (SELECT DISTINCT CUP FROM '{CIG_PARQUET}')"
-                )
-            elif filters.get("HAS_CIG") == "NO":
-                where_clauses.append(
-                    f"CUP NOT IN (SELECT DISTINCT CUP FROM '{CIG_PARQUET}')"
+        else:
+            parts = [
+                f'LOWER("{col}") LIKE ?'
+                if self.cig_types.get(col, "VARCHAR") == "VARCHAR"
+                else f'LOWER(CAST("{col}" AS VARCHAR)) LIKE ?'
+                for col in CIG_SEARCH_COLUMNS
+            ]
+        return f"({' OR '.join(parts)})", [like] * len(parts), None
+
+    def _cig_exists(self, code):
+        """True se il CIG esiste: dall'indice di adiacenza, altrimenti con un lookup."""
+        if self.cig_cups is not None and code in self.cig_cups:
+            return True
+        with self.cursor() as cur:
+            return cur.execute(
+                f"SELECT 1 FROM {self.src_cig} WHERE CIG = ? LIMIT 1", [code]
+            ).fetchone() is not None
+
+    def _contains_filter(self, index_name, col, needle):
+        """
+        Filtro "contiene" su col. Con l'indice trigrammi i valori distinti
+        che contengono needle diventano un IN sui valori esatti (un solo
+        parametro, separato da VALUE_SEP); altrimenti LIKE. Ritorna (sql, params).
+        """
+        index = self.trigrams.get(index_name)
+        values = index.lookup(needle, TRIGRAM_MAX_VALUES) if index else None
+        if values is None:
+            return f'LOWER("{col}") LIKE ?', [f"%{needle.lower()}%"]
+        if not values:
+            return "FALSE", []
+        return (
+            f'"{col}" IN (SELECT UNNEST(string_split(?, chr(31))))',
+            [VALUE_SEP.join(values)],
+        )
+
+    def _in_values(self, col, values):
+        """col uguale a uno dei valori (array Arrow): = per uno, IN con parametro unico per piu'."""
+        values = pc.unique(values).to_pylist()
+        if not values:
+            return "FALSE", []
+        if len(values) == 1:
+            return f'"{col}" = ?', values
+        return (
+            f'"{col}" IN (SELECT UNNEST(string_split(?, chr(31))))',
+            [VALUE_SEP.join(values)],
+        )
+
+    def _cig_prefix_filter(self, prefix):
+        """
+        CUP con almeno un CIG che inizia per prefix: dall'indice di adiacenza
+        se i CUP sono pochi, altrimenti subquery su cig. Ritorna (sql, params).
+        """
+        if self.cig_cups is not None:
+            cups = self.cig_cups.lookup_prefix(prefix).column("CUP")
+            if len(cups) <= CIG_PREFIX_MAX_CUPS:
+                return self._in_values("CUP", cups)
+        return (
+            f"CUP IN (SELECT DISTINCT CUP FROM {self.src_cig} WHERE CIG LIKE ?)",
+            [f"{prefix}%"],
+        )
+
+    def _cig_link_filters(self, filters):
+        """
+        Filtri HAS_CIG / HAS_AGGIUDICATARI (SI/NO): predicati sulle colonne
+        denormalizzate se presenti, altrimenti subquery su cig/aggiudicatari.
+        Ritorna (clauses, params).
+        """
+        clauses, params = [], []
+        for flag in ("HAS_CIG", "HAS_AGGIUDICATARI"):
+            val = filters.get(flag)
+            if val not in ("SI", "NO"):
+                continue
+            if self.cig_summary:
+                clauses.append(f'"{flag}" = ?')
+                params.append(val)
+                continue
+            if flag == "HAS_CIG":
+                sub = f"SELECT DISTINCT CUP FROM {self.src_cig}"
+            else:
+                # CUP con almeno un CIG che ha aggiudicatari
+                sub = (
+                    f"SELECT DISTINCT c.CUP FROM {self.src_cig} c "
+                    f"WHERE c.CIG IN (SELECT DISTINCT CIG FROM {self.src_aggiudicatari})"
                 )
+            op = "IN" if val == "SI" else "NOT IN"
+            clauses.append(f"CUP {op} ({sub})")
+        return clauses, params
+
+    def _not_empty(self, field, types=None):
+        """Predicato "valore presente" per una colonna (di progetti se types e' None)."""
+        types = self.progetti_types if types is None else types
+        if types.get(field, "VARCHAR") == "VARCHAR":
+            return f'"{field}" IS NOT NULL AND "{field}" != \'\''
+        return f'"{field}" IS NOT NULL'
+
+    def _num(self, col):
+        """Colonna numerica di progetti: nativa se tipizzata, altrimenti TRY_CAST."""
+        if self.progetti_types.get(col, "VARCHAR") == "VARCHAR":
+            return f'TRY_CAST("{col}" AS BIGINT)'
+        return f'"{col}"'
+
+    def _coerce(self, col, val, types=None):
+        """
+        Converte il valore di un filtro (stringa dalla query string) nel tipo
+        della colonna (di progetti se types e' None). Ritorna None se non e'
+        convertibile.
+        """
+        types = self.progetti_types if types is None else types
+        type_ = types.get(col, "VARCHAR")
+        if type_ in INTEGER_TYPES:
+            try:
+                return int(val)
+            except ValueError:
+                return None
+        if type_ in FLOAT_TYPES:
+            try:
+                return float(val)
+            except ValueError:
+                return None
+        if type_ == "DATE":
+            for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
+                try:
+                    return datetime.strptime(val, fmt).date()
+                except ValueError:
+                    pass
+            return None
+        return val
+
+    def _column_filter(self, col, val, types=None):
+        """Filtro di uguaglianza (o IN per liste) con i valori nel tipo della colonna."""
+        values = val if isinstance(val, (list, tuple)) else [val]
+        values = [
+            v for v in (self._coerce(col, x, types) for x in values) if v is not None
+        ]
+        if not values:
+            return "FALSE", []
+        if len(values) == 1:
+            return f'"{col}" = ?', values
+        placeholders = ", ".join(["?"] * len(values))
+        return f'"{col}" IN ({placeholders})', values
+
+    def _paged_query(self, source, cols, where_sql, order_sql, params,
+                     limit, offset, count_mode="exact", keyset=None):
+        """
+        Esegue la query paginata e calcola il totale.
+        Con filtri attivi pagina e totale arrivano da un'unica scansione
+        (COUNT(*) OVER ()); senza filtri il COUNT(*) si risolve dai metadati.
+        Con count_mode="capped" il conteggio si ferma a COUNT_CAP righe.
+        Con keyset=(sql, params) la pagina parte dopo il cursore invece che
+        da offset: un predicato di range al posto dello skip.
+        Ritorna (rows, total, total_capped).
+        """
+        page_where, page_params = where_sql, list(params)
+        if keyset:
+            ks_sql, ks_params = keyset
+            page_where = f"{where_sql} AND {ks_sql}" if where_sql else f"WHERE {ks_sql}"
+            page_params += ks_params
+            offset = 0
+        page_query = f"""
+            SELECT {cols}
+            FROM {source}
+            {page_where}
+            {order_sql}
+            LIMIT ? OFFSET ?
+        """
+        count_query = f"SELECT COUNT(*) FROM {source} {where_sql}"
+
+        with self.cursor() as cur:
+            if count_mode == "capped":
+                total = cur.execute(f"""
+                    SELECT COUNT(*) FROM (
+                        SELECT 1 FROM {source} {where_sql} LIMIT ?
+                    )
+                """, params + [COUNT_CAP + 1]).fetchone()[0]
+                rows = cur.execute(page_query, page_params + [limit, offset]).fetchall()
+                if total > COUNT_CAP:
+                    return rows, COUNT_CAP, True
+                return rows, total, False
+
+            # Senza filtri il conteggio e' dai metadati; con il cursore il
+            # totale non coincide con le righe dopo il cursore: due query
+            if not where_sql or keyset:
+                total = cur.execute(count_query, params).fetchone()[0]
+                rows = cur.execute(page_query, page_params + [limit, offset]).fetchall()
+                return rows, total, False
+
+            rows = cur.execute(f"""
+                SELECT {cols}, COUNT(*) OVER () AS __total
+                FROM {source}
+                {where_sql}
+                {order_sql}
+                LIMIT ? OFFSET ?
+            """, params + [limit, offset]).fetchall()
+            if rows:
+                return [row[:-1] for row in rows], rows[0][-1], False
+
+            # Pagina oltre la fine (o nessun risultato): serve il conteggio
+            total = cur.execute(count_query, params).fetchone()[0] if offset else 0
+            return [], total, False
+
+    def compile_filters(self, table, q="", filters=None):
+        """
+        Compila ricerca libera e filtri di una tabella ("progetti" o "cig")
+        in un CompiledFilter: ricerca, aggregazioni ed export usano la stessa
+        chiave e lo stesso SQL. Solleva ValueError sui valori non validi.
+        """
+        # Prima di consultare le cache per chiave di filtro
+        self._check_data_version()
+        q = (q or "").strip()
+        if table == "progetti":
+            items = normalize_filters(filters, FILTER_COLUMNS, EXTRA_FILTERS)
+            clauses, params = self._progetti_clauses(dict(items))
+        else:
+            items = normalize_filters(filters, CIG_FILTER_COLUMNS, CIG_EXTRA_FILTERS)
+            clauses, params = self._cig_clauses(dict(items))
+        text = self._text_filter(table, q) if q else None
+        return CompiledFilter((table, q.lower(), items), text, clauses, params)
 
-            # Filtro Ha Aggiudicatari (CUP con almeno un CIG che ha aggiudicatari)
-            if filters.get("HAS_AGGIUDICATARI") == "SI":
-                where_clauses.append(
-                    f"CUP IN (SELECT DISTINCT c.CUP FROM '{CIG_PARQUET}' c "
-                    f"WHERE c.CIG IN (SELECT DISTINCT CIG FROM '{AGGIUDICATARI_PARQUET}'))"
-                )
-            elif filters.get("HAS_AGGIUDICATARI") == "NO":
-                where_clauses.append(
-                    f"CUP NOT IN (SELECT DISTINCT c.CUP FROM '{CIG_PARQUET}' c "
-                    f"WHERE c.CIG IN (SELECT DISTINCT CIG FROM '{AGGIUDICATARI_PARQUET}'))"
-                )
+    def _progetti_clauses(self, filters):
+        """Predicati sui filtri normalizzati di progetti. Ritorna (clauses, params)."""
+        clauses, params = [], []
 
-            # Ricerca Soggetto Titolare (contiene)
-            if filters.get("SEARCH_SOGGETTO"):
-                where_clauses.append("LOWER(SOGGETTO_TITOLARE) LIKE ?")
-                params.append(f"%{filters['SEARCH_SOGGETTO'].lower()}%")
-
-            # Ricerca Descrizione Sintetica (contiene)
-            if filters.get("SEARCH_DESCRIZIONE"):
-                where_clauses.append('LOWER("DESCRIZIONE_SINTETICA_CUP") LIKE ?')
-                params.append(f"%{filters['SEARCH_DESCRIZIONE'].lower()}%")
-
-            # Ricerca CUP dedicata (match prefisso)
-            if filters.get("SEARCH_CUP"):
-                where_clauses.append("CUP LIKE ?")
-                params.append(f"{filters['SEARCH_CUP'].upper()}%")
-
-            # Ricerca CIG dedicata (lookup diretto)
-            if filters.get("SEARCH_CIG"):
-                where_clauses.append(
-                    f"CUP IN (SELECT DISTINCT CUP FROM '{CIG_PARQUET}' WHERE CIG LIKE ?)"
-                )
-                params.append(f"{filters['SEARCH_CIG'].upper()}%")
+        for col in FILTER_COLUMNS:
+            if col in filters:
+                sql, p = self._column_filter(col, filters[col])
+                clauses.append(sql)
+                params.extend(p)
+
+        # Filtri Ha CIG / Ha Aggiudicatari
+        sql, p = self._cig_link_filters(filters)
+        clauses.extend(sql)
+        params.extend(p)
+
+        # Ricerca Soggetto Titolare (contiene)
+        if "SEARCH_SOGGETTO" in filters:
+            sql, p = self._contains_filter(
+                "soggetto", "SOGGETTO_TITOLARE", filters["SEARCH_SOGGETTO"]
+            )
+            clauses.append(sql)
+            params.extend(p)
 
-            # Range costo
-            if "costo_min" in filters and filters["costo_min"]:
-                where_clauses.append(
-                    "TRY_CAST(COSTO_PROGETTO AS BIGINT) >= ?"
-                )
-                params.append(int(filters["costo_min"]))
-            if "costo_max" in filters and filters["costo_max"]:
-                where_clauses.append(
-                    "TRY_CAST(COSTO_PROGETTO AS BIGINT) <= ?"
-                )
-                params.append(int(filters["costo_max"]))
+        # Ricerca Descrizione Sintetica (contiene)
+        if "SEARCH_DESCRIZIONE" in filters:
+            sql, p = self._contains_filter(
+                "descrizione", "DESCRIZIONE_SINTETICA_CUP", filters["SEARCH_DESCRIZIONE"]
+            )
+            clauses.append(sql)
+            params.extend(p)
+
+        # Ricerca CUP dedicata (match prefisso)
+        if "SEARCH_CUP" in filters:
+            clauses.append("CUP LIKE ?")
+            params.append(f"{filters['SEARCH_CUP']}%")
+
+        # Ricerca CIG dedicata (match prefisso)
+        if "SEARCH_CIG" in filters:
+            sql, p = self._cig_prefix_filter(filters["SEARCH_CIG"])
+            clauses.append(sql)
+            params.extend(p)
+
+        # Range costo
+        if "costo_min" in filters:
+            clauses.append(f"{self._num('COSTO_PROGETTO')} >= ?")
+            params.append(filters["costo_min"])
+        if "costo_max" in filters:
+            clauses.append(f"{self._num('COSTO_PROGETTO')} <= ?")
+            params.append(filters["costo_max"])
+
+        return clauses, params
+
+    def _cig_clauses(self, filters):
+        """Predicati sui filtri normalizzati dei CIG. Ritorna (clauses, params)."""
+        clauses, params = [], []
+
+        for col in CIG_FILTER_COLUMNS:
+            if col in filters:
+                sql, p = self._column_filter(col, filters[col], self.cig_types)
+                clauses.append(sql)
+                params.extend(p)
+
+        # Flag PNRR
+        if filters.get("ONLY_PNRR") == "SI":
+            clauses.append("flag_pnrr_pnc = 1")
+
+        # Flag subappalto
+        if filters.get("FLAG_SUBAPPALTO") == "SI":
+            clauses.append("flag_subappalto = true")
+        elif filters.get("FLAG_SUBAPPALTO") == "NO":
+            clauses.append("flag_subappalto = false")
+
+        # Solo con dettaglio
+        if filters.get("HAS_DETAIL") == "SI":
+            clauses.append("oggetto_gara IS NOT NULL")
+
+        # Ricerca aggiudicatario per denominazione
+        if "SEARCH_AGGIUDICATARIO" in filters:
+            sql, p = self._contains_filter(
+                "aggiudicatario", "denominazione", filters["SEARCH_AGGIUDICATARIO"]
+            )
+            clauses.append(
+                f"CIG IN (SELECT DISTINCT CIG FROM {self.src_aggiudicatari} WHERE {sql})"
+            )
+            params.extend(p)
+
+        # Ricerca aggiudicatario per codice fiscale
+        if "SEARCH_CF_AGGIUDICATARIO" in filters:
+            sql, p = self._contains_filter(
+                "cf_aggiudicatario", "codice_fiscale", filters["SEARCH_CF_AGGIUDICATARIO"]
+            )
+            clauses.append(
+                f"CIG IN (SELECT DISTINCT CIG FROM {self.src_aggiudicatari} WHERE {sql})"
+            )
+            params.extend(p)
+
+        # Range importo
+        if "importo_min" in filters:
+            clauses.append("importo_complessivo_gara >= ?")
+            params.append(filters["importo_min"])
+        if "importo_max" in filters:
+            clauses.append("importo_complessivo_gara <= ?")
+            params.append(filters["importo_max"])
+
+        return clauses, params
+
+    def _cached_result(self, flt, source, cols, key_col):
+        """
+        Result set filtrato (colonne della tabella) dalla cache, ordinato per
+        key_col. Viene calcolato solo se il filtro e' gia' stato visto (vedi
+        _remember_total) e il suo totale entra in RESULT_CACHE_MAX_ROWS:
+        il primo accesso resta la sola query paginata. Ritorna una tabella
+        Arrow, o None.
+        """
+        table = self._result_cache.get(flt.key)
+        if table is not None:
+            return table
+        total = self._result_totals.get(flt.key)
+        if total is None or total > RESULT_CACHE_MAX_ROWS:
+            return None
+
+        where_sql, params = flt.where()
+        with self.cursor() as cur:
+            table = cur.execute(f"""
+                SELECT {cols} FROM {source} {where_sql} LIMIT ?
+            """, params + [RESULT_CACHE_MAX_ROWS + 1]).arrow()
+        if table.num_rows > RESULT_CACHE_MAX_ROWS:
+            return None
+
+        table = table.sort_by(key_col)
+        self._result_cache.put(flt.key, table, table.nbytes)
+        return table
+
+    def _remember_total(self, flt, total, capped):
+        """Registra il totale esatto di un filtro per _cached_result."""
+        if not capped:
+            self._result_totals.put(flt.key, total, 1)
+
+    def _page_from_result(self, table, order_sql, key_col, limit, offset,
+                          keyset=None):
+        """Pagina di un result set in cache: slice diretto o sort in memoria."""
+        if keyset is None and order_sql == f"ORDER BY {key_col}":
+            return table.slice(offset, limit).to_pylist()
+
+        where_sql, params = "", []
+        if keyset:
+            where_sql, params = f"WHERE {keyset[0]}", list(keyset[1])
+            offset = 0
+        with self.cursor() as cur:
+            cur.register("_rs", table)
+            try:
+                return cur.execute(f"""
+                    SELECT * FROM _rs {where_sql} {order_sql} LIMIT ? OFFSET ?
+                """, params + [limit, offset]).arrow().to_pylist()
+            finally:
+                cur.unregister("_rs")
+
+    def get_cache_stats(self):
+        """Contatori della cache dei result set e dei prepared statement."""
+        self._check_data_version()
+        stats = self._result_cache.stats()
+        stats["statements"] = self._statements.stats()
+        stats["filtered_stats"] = self._stats_memo.stats()
+        stats["adjacency_bytes"] = sum(
+            index.nbytes for index in (self.cup_cigs, self.cig_cups, self.cig_aggiudicatari)
+            if index is not None
+        )
+        stats["suggest_bytes"] = sum(index.nbytes for index in self.suggest.values())
+        return stats
+
+    def _check_data_version(self):
+        """
+        Fissa per il thread l'ultimo snapshot pubblicato (vedi __getattr__).
+        Se il convertitore ha riscritto i file e questi non cambiano da
+        DATA_RELOAD_QUIET secondi, avvia in background la costruzione di uno
+        snapshot nuovo: fino alla pubblicazione le richieste usano il precedente.
+        """
+        state = self._state
+        self._local.state = state
+        version = data_version()
+        if version == state.version:
+            return
+        changed = max((v[0] for v in version if v is not None), default=0)
+        if time.time_ns() - changed < DATA_RELOAD_QUIET * 1e9:
+            return
+        if self._reload_lock.acquire(blocking=False):
+            threading.Thread(target=self._reload, name="data-reload", daemon=True).start()
+
+    def _reload(self):
+        """Costruisce lo snapshot sui file correnti e lo pubblica con un solo assegnamento."""
+        try:
+            if data_version() != self._state.version:
+                self._state = DataSnapshot(self.pool_size)
+        finally:
+            self._reload_lock.release()
+
+    def get_stats(self):
+        """Ritorna le statistiche pre-calcolate dal file JSON."""
+        self._check_data_version()
+        state = self._snapshot()
+        if state._stats_cache is None:
+            with open(STATS_FILE, "r", encoding="utf-8") as f:
+                state._stats_cache = json.load(f)
+        return state._stats_cache
+
+    def get_filtered_stats(self, filters=None, q=""):
+        """
+        Totali di progetti (chiavi di stats.json) per ricerca e filtri.
+        Ritorna (totali, sorgente): "rollup" da stats.json senza filtri,
+        "memo" gia' calcolati, "cache" dal result set in cache, "scan".
+        """
+        self._check_data_version()
+        flt = self.compile_filters("progetti", q, filters)
+        return self._stats_for(flt)
+
+    def _stats_for(self, flt):
+        if flt.empty:
+            totals = self._rollup_totals()
+            if totals is not None:
+                return totals, "rollup"
+        totals = self._stats_memo.get(flt.key)
+        if totals is not None:
+            return totals, "memo"
+
+        table = self._result_cache.get(flt.key)
+        with self.cursor() as cur:
+            if table is not None:
+                source = "cache"
+                cur.register("_rs", table)
+                try:
+                    totals = self._totals(cur, "_rs", "", [])
+                finally:
+                    cur.unregister("_rs")
+            else:
+                source = "scan"
+                where_sql, params = flt.where()
+                totals = self._totals(cur, self.src_progetti, where_sql, params)
+        self._stats_memo.put(flt.key, totals, 1)
+        return totals, source
+
+    def _rollup_totals(self):
+        """
+        Totali senza filtri da stats.json, o None se mancano o sono piu'
+        vecchi di progetti.parquet (riscritto senza rigenerare le statistiche).
+        """
+        if not os.path.exists(STATS_FILE):
+            return None
+        if (os.path.exists(PARQUET_FILE)
+                and os.path.getmtime(STATS_FILE) < os.path.getmtime(PARQUET_FILE)):
+            return None
+        try:
+            return self.get_stats()["totals"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def get_suggestions(self, field, prefix, limit=10):
+        """
+        Primi limit valori di field che iniziano per prefix, per frequenza:
+        [{"value", "count"}]. Dall'indice in memoria se presente, altrimenti
+        con una query. Solleva ValueError se il campo non e' suggeribile.
+        """
+        if field not in SUGGEST_FIELDS:
+            raise ValueError(f"Campo non valido per i suggerimenti: {field}")
+        self._check_data_version()
+        limit = max(1, min(int(limit), SUGGEST_MAX_LIMIT))
+        prefix = prefix.strip()
+        if not prefix:
+            return []
 
-        where_sql = ""
-        if where_clauses:
-            where_sql = "WHERE " + " AND ".join(where_clauses)
+        index = self.suggest.get(field)
+        if index is not None:
+            rows = index.lookup(prefix, limit)
+            return [
+                {"value": v, "count": n}
+                for v, n in zip(rows.column("value").to_pylist(),
+                                rows.column("count").to_pylist())
+            ]
+
+        source, col, key_sql, normalize = self._suggest_source(field)
+        with self.cursor() as cur:
+            rows = cur.execute(f"""
+                SELECT "{col}", COUNT(*) AS n
+                FROM {source}
+                WHERE starts_with({key_sql}, ?) AND "{col}" != ''
+                GROUP BY "{col}"
+                ORDER BY n DESC, {key_sql}, "{col}"
+                LIMIT ?
+            """, [normalize(prefix), limit]).fetchall()
+        return [{"value": r[0], "count": r[1]} for r in rows]
 
-        # Ordinamento (cast numerico per colonne numeriche)
-        NUMERIC_COLUMNS = {
-            "ANNO_DECISIONE", "COSTO_PROGETTO", "FINANZIAMENTO_PROGETTO",
-            "ANNO_DELIBERA",
+    def get_filter_options(self):
+        """Ritorna i valori distinti per ogni colonna filtro."""
+        return {
+            col: [f["value"] for f in values]
+            for col, values in self.get_facets("progetti").items()
         }
+
+    def warm_facets(self):
+        """Calcola le faccette senza filtri di progetti e CIG (all'avvio)."""
+        for table in ("progetti", "cig"):
+            try:
+                self.get_facets(table)
+            except duckdb.Error:
+                pass
+
+    def get_facets(self, table, filters=None, q=""):
+        """
+        Conteggi per valore di ogni colonna filtro di table ("progetti" o
+        "cig"), ciascuna sotto la ricerca e gli altri filtri attivi ma non il
+        proprio: {colonna: [{"value", "count"}]} in ordine di valore.
+        Una faccetta dipende solo dagli altri filtri: quelle gia' calcolate
+        per la stessa combinazione si riusano, le mancanti arrivano da
+        un'unica query.
+        """
+        self._check_data_version()
+        flt = self.compile_filters(table, q, filters)
+        _, q_key, items = flt.key
+        columns = FILTER_COLUMNS if table == "progetti" else CIG_FILTER_COLUMNS
+
+        facets, missing = {}, []
+        for col in columns:
+            key = (table, q_key, tuple(i for i in items if i[0] != col), col)
+            if not q_key and not key[2]:
+                values = self._facets_base.get(key)
+            else:
+                values = self._facets_memo.get(key)
+            if values is None:
+                missing.append(col)
+            else:
+                facets[col] = values
+
+        if missing:
+            for col, values in self._facet_counts(table, flt, q, missing).items():
+                key = (table, q_key, tuple(i for i in items if i[0] != col), col)
+                if not q_key and not key[2]:
+                    self._facets_base[key] = values
+                else:
+                    self._facets_memo.put(key, values, 1)
+                facets[col] = values
+        return {col: facets[col] for col in columns}
+
+    def _facet_counts(self, table, flt, q, columns):
+        """
+        Faccette di columns in una query: un grouping set per colonna, con un
+        COUNT(*) FILTER per ogni diversa combinazione degli altri filtri di colonna.
+        """
+        all_columns = FILTER_COLUMNS if table == "progetti" else CIG_FILTER_COLUMNS
+        source = self.src_progetti if table == "progetti" else self.src_cig
+        filters = flt.filters
+        active = [c for c in all_columns if c in filters]
+
+        # Ricerca e filtri non di colonna valgono per tutte le faccette
+        common = self.compile_filters(
+            table, q, {k: v for k, v in filters.items() if k not in active}
+        )
+        where_sql, where_params = common.where()
+        predicates = {}
+        for col in active:
+            val = filters[col]
+            single = self.compile_filters(
+                table, "", {col: list(val) if isinstance(val, tuple) else val}
+            )
+            predicates[col] = (" AND ".join(single.clauses), single.params)
+
+        counts, params, count_of = [], [], {}
+        for col in columns:
+            others = tuple(c for c in active if c != col)
+            if others not in count_of:
+                count_of[others] = f"n_{len(counts)}"
+                if others:
+                    cond = " AND ".join(predicates[c][0] for c in others)
+                    counts.append(f"COUNT(*) FILTER (WHERE {cond}) AS {count_of[others]}")
+                    for c in others:
+                        params.extend(predicates[c][1])
+                else:
+                    counts.append(f"COUNT(*) AS {count_of[others]}")
+
+        cols = ", ".join(f'"{c}"' for c in columns)
+        sets = ", ".join(f'("{c}")' for c in columns)
+        set_id = " ".join(
+            f'WHEN GROUPING("{c}") = 0 THEN {i}' for i, c in enumerate(columns)
+        )
+        n_sql = " ".join(
+            f"WHEN {i} THEN {count_of[tuple(a for a in active if a != c)]}"
+            for i, c in enumerate(columns)
+        )
+        present = " OR ".join(
+            f"(_set = {i} AND {self._present(table, c)})" for i, c in enumerate(columns)
+        )
+        with self.cursor() as cur:
+            rows = cur.execute(f"""
+                SELECT _set, {cols}, n
+                FROM (
+                    SELECT _set, {cols}, CASE _set {n_sql} END AS n
+                    FROM (
+                        SELECT CASE {set_id} END AS _set, {cols}, {", ".join(counts)}
+                        FROM {source}
+                        {where_sql}
+                        GROUP BY GROUPING SETS ({sets})
+                    )
+                )
+                WHERE n > 0 AND ({present})
+                ORDER BY _set, {cols}
+            """, params + where_params).fetchall()
+
+        facets = {col: [] for col in columns}
+        for r in rows:
+            facets[columns[r[0]]].append({"value": r[1 + r[0]], "count": r[-1]})
+        return facets
+
+    def _present(self, table, col):
+        """Predicato "valore presente" per una colonna filtro di table."""
+        types = self.progetti_types if table == "progetti" else self.cig_types
+        return self._not_empty(col, types)
+
+    def search_projects(self, q="", filters=None, sort_col=None,
+                        sort_dir="ASC", limit=50, offset=0, count_mode="exact",
+                        cursor=None):
+        """
+        Ricerca progetti con filtri, ordinamento e paginazione
+        (offset oppure cursore keyset).
+        Ritorna (rows, total_count, total_capped, next_cursor).
+        """
+        flt = self.compile_filters("progetti", q, filters)
+
+        # Ricerca testuale: senza ordinamento esplicito i risultati seguono
+        # la rilevanza BM25
+        source = self.src_progetti
+        ranked = bool(flt.score_sql) and not (sort_col and sort_col in self.all_columns)
+        if ranked:
+            source = f"(SELECT *, {flt.score_sql} AS _score FROM {self.src_progetti})"
+        where_sql, params = flt.where(ranked=ranked)
+
+        # Ordinamento (cast numerico per colonne numeriche non tipizzate)
+        # (CUP come chiave secondaria: ordine stabile per il cursore keyset)
         order_sql = ""
-        if sort_col and sort_col in ALL_COLUMNS:
+        sort_expr = None
+        direction = "ASC"
+        if sort_col and sort_col in self.all_columns:
             direction = "DESC" if sort_dir.upper() == "DESC" else "ASC"
             if sort_col in NUMERIC_COLUMNS:
-                order_sql = f'ORDER BY TRY_CAST("{sort_col}" AS BIGINT) {direction} NULLS LAST'
+                sort_expr = self._num(sort_col)
             else:
-                order_sql = f'ORDER BY "{sort_col}" {direction} NULLS LAST'
+                sort_expr = f'"{sort_col}"'
+            order_sql = f"ORDER BY {sort_expr} {direction} NULLS LAST, CUP"
+        elif ranked:
+            sort_col, sort_expr, direction = "_score", "_score", "DESC"
+            order_sql = "ORDER BY _score DESC, CUP"
         else:
+            sort_col = None
             order_sql = "ORDER BY CUP"
 
-        cols = ", ".join(f'"{c}"' for c in DEFAULT_COLUMNS)
-
-        # Count totale
-        count_query = f"""
-            SELECT COUNT(*) FROM '{PARQUET_FILE}' {where_sql}
-        """
-        total = self.con.execute(count_query, params).fetchone()[0]
-
-        # Dati paginati
-        data_query = f"""
-            SELECT {cols}
-            FROM '{PARQUET_FILE}'
-            {where_sql}
-            {order_sql}
-            LIMIT ? OFFSET ?
-        """
-        rows = self.con.execute(
-            data_query, params + [limit, offset]
-        ).fetchall()
+        keyset = None
+        if cursor:
+            keyset = _keyset_clause(cursor, sort_col, direction, sort_expr, "CUP")
 
-        results = []
-        for row in rows:
-            results.append(dict(zip(DEFAULT_COLUMNS, row)))
+        cols = ", ".join(f'"{c}"' for c in DEFAULT_COLUMNS)
 
-        return results, total
+        results = None
+        # Result set in cache: pagine e riordini non rivalutano il filtro
+        # (mai con il conteggio "capped": non serve il totale esatto)
+        cacheable = (
+            where_sql and count_mode != "capped"
+            and (sort_col is None or sort_col in DEFAULT_COLUMNS)
+        )
+        if cacheable:
+            table = self._cached_result(flt, self.src_progetti, cols, "CUP")
+            if table is not None:
+                results = self._page_from_result(
+                    table, order_sql, "CUP", limit, offset, keyset
+                )
+                total, capped = table.num_rows, False
+
+        if results is None:
+            # Il valore di ordinamento serve al cursore anche se la colonna
+            # non e' tra quelle mostrate
+            row_cols = list(DEFAULT_COLUMNS)
+            if sort_col and sort_col not in row_cols:
+                row_cols.append(sort_col)
+            rows, total, capped = self._paged_query(
+                source, ", ".join(f'"{c}"' for c in row_cols),
+                where_sql, order_sql, params,
+                limit, offset, count_mode, keyset,
+            )
+            if cacheable:
+                self._remember_total(flt, total, capped)
+            results = []
+            for row in rows:
+                results.append(dict(zip(row_cols, row)))
+
+        next_cursor = None
+        if results and len(results) == limit:
+            last = results[-1]
+            value = _sort_value(last, sort_col, sort_col in NUMERIC_COLUMNS)
+            next_cursor = encode_cursor(sort_col, direction, value, last["CUP"])
+        if sort_col and sort_col not in DEFAULT_COLUMNS:
+            for row in results:
+                row.pop(sort_col, None)
+
+        return results, total, capped, next_cursor
 
     def get_project_detail(self, cup):
         """Ritorna tutti i dettagli di un singolo progetto per CUP."""
-        cols = ", ".join(f'"{c}"' for c in ALL_COLUMNS)
-        rows = self.con.execute(f"""
-            SELECT {cols}
-            FROM '{PARQUET_FILE}'
-            WHERE CUP = ?
-            LIMIT 10
-        """, [cup]).fetchall()
+        self._check_data_version()
+        cols = ", ".join(f'"{c}"' for c in self.all_columns)
+        with self.cursor() as cur:
+            rows = cur.execute(f"""
+                SELECT {cols}
+                FROM {self.src_progetti}
+                WHERE CUP = ?
+                LIMIT 10
+            """, [cup]).fetchall()
 
         results = []
         for row in rows:
-            results.append(dict(zip(ALL_COLUMNS, row)))
+            results.append(dict(zip(self.all_columns, row)))
         return results
 
-    def get_aggregation(self, field, filters=None, q=""):
-        """Aggregazione dinamica per un campo specifico."""
-        if field not in ALL_COLUMNS:
-            return []
-
-        where_clauses = [f'"{field}" IS NOT NULL', f'"{field}" != \'\'']
-        params = []
-
-        if q:
-            search_parts = []
-            for col in SEARCH_COLUMNS:
-                search_parts.append(f'LOWER("{col}") LIKE ?')
-                params.append(f"%{q.lower()}%")
-            where_clauses.append(f"({' OR '.join(search_parts)})")
-
-        if filters:
-            for col, val in filters.items():
-                if col in FILTER_COLUMNS and val:
-                    if isinstance(val, list):
-                        placeholders = ", ".join(["?"] * len(val))
-                        where_clauses.append(f'"{col}" IN ({placeholders})')
-                        params.extend(val)
-                    else:
-                        where_clauses.append(f'"{col}" = ?')
-                        params.append(val)
-
-            if filters.get("HAS_CIG") == "SI":
-                where_clauses.append(
-                    f"CUP IN (SELECT DISTINCT CUP FROM '{CIG_PARQUET}')"
-                )
-            elif filters.get("HAS_CIG") == "NO":
-                where_clauses.append(
-                    f"CUP NOT IN (SELECT DISTINCT CUP FROM '{CIG_PARQUET}')"
-                )
-
-        where_sql = "WHERE " + " AND ".join(where_clauses)
+    def _aggregation_plan(self, flt, fields):
+        """
+        Sorgente di un'aggregazione di progetti sui campi fields.
+        Campi e filtri tutti dimensioni del cubo: i filtri di colonna valgono
+        tali e quali sulle sue righe. Ritorna (percorso, sorgente, conteggio, costo).
+        """
+        if (self.src_cube and flt.text is None
+                and all(f in CUBE_DIMENSIONS for f in fields)
+                and all(name in CUBE_DIMENSIONS for name in flt.filters)):
+            return "cube", self.src_cube, "SUM(n)", "SUM(costo)"
+        return (
+            "scan", self.src_progetti, "COUNT(*)",
+            f'SUM({self._num("COSTO_PROGETTO")})',
+        )
 
-        rows = self.con.execute(f"""
-            SELECT "{field}", COUNT(*) as n,
-                   SUM(TRY_CAST(COSTO_PROGETTO AS BIGINT)) as costo
-            FROM '{PARQUET_FILE}'
-            {where_sql}
-            GROUP BY "{field}"
-            ORDER BY n DESC
-            LIMIT 30
-        """, params).fetchall()
+    def get_aggregation(self, field, filters=None, q=""):
+        """
+        Aggregazione dinamica per un campo specifico.
+        Ritorna (righe, sorgente): "cache" se calcolata dal result set in
+        cache, "cube" dal cubo pre-aggregato, "scan" dalla tabella progetti.
+        """
+        if field not in self.all_columns:
+            return [], "scan"
+
+        # Stesso filtro gia' calcolato dalla tabella: aggrego dal result set in cache
+        self._check_data_version()
+        flt = self.compile_filters("progetti", q, filters)
+        table = self._result_cache.get(flt.key)
+        if table is not None:
+            return self._aggregate_cached(table, field), "cache"
+
+        path, source, count_sql, costo_sql = self._aggregation_plan(flt, [field])
+        where_sql, params = flt.where(self._not_empty(field))
+
+        with self.cursor() as cur:
+            rows = cur.execute(f"""
+                SELECT "{field}", {count_sql} as n, {costo_sql} as costo
+                FROM {source}
+                {where_sql}
+                GROUP BY "{field}"
+                ORDER BY n DESC, "{field}"
+                LIMIT {AGGREGATION_LIMIT}
+            """, params).fetchall()
 
         return [
             {"value": r[0], "count": r[1], "costo": r[2]}
             for r in rows
-        ]
+        ], path
 
-    def export_query(self, q="", filters=None, limit=100000):
-        """Ritorna dati per export CSV (max 100k righe)."""
-        where_clauses = []
-        params = []
-
-        if q:
-            search_parts = []
-            for col in SEARCH_COLUMNS:
-                search_parts.append(f'LOWER("{col}") LIKE ?')
-                params.append(f"%{q.lower()}%")
-            where_clauses.append(f"({' OR '.join(search_parts)})")
-
-        if filters:
-            for col, val in filters.items():
-                if col in FILTER_COLUMNS and val:
-                    if isinstance(val, list):
-                        placeholders = ", ".join(["?"] * len(val))
-                        where_clauses.append(f'"{col}" IN ({placeholders})')
-                        params.extend(val)
-                    else:
-                        where_clauses.append(f'"{col}" = ?')
-                        params.append(val)
-
-            if filters.get("HAS_CIG") == "SI":
-                where_clauses.append(
-                    f"CUP IN (SELECT DISTINCT CUP FROM '{CIG_PARQUET}')"
-                )
-            elif filters.get("HAS_CIG") == "NO":
-                where_clauses.append(
-                    f"CUP NOT IN (SELECT DISTINCT CUP FROM '{CIG_PARQUET}')"
+    def get_aggregations(self, fields, filters=None, q="", totals=False):
+        """
+        Aggregazioni su piu' campi con un'unica query (GROUPING SETS): una
+        sola lettura dell'insieme filtrato invece di una per campo.
+        Con totals=True aggiunge i totali filtrati (stesse chiavi di stats.json).
+        Ritorna ({"aggregations": {campo: righe}[, "totals": {...}]}, sorgente).
+        """
+        fields = [f for f in dict.fromkeys(fields) if f in self.all_columns]
+        self._check_data_version()
+        flt = self.compile_filters("progetti", q, filters)
+
+        # Result set in cache: basta se contiene tutti i campi richiesti
+        table = self._result_cache.get(flt.key)
+        if table is not None and all(f in DEFAULT_COLUMNS for f in fields):
+            path, source = "cache", "_rs"
+            count_sql, costo_sql = "COUNT(*)", f'SUM({self._num("COSTO_PROGETTO")})'
+            where_sql, params = "", []
+        else:
+            table = None
+            path, source, count_sql, costo_sql = self._aggregation_plan(flt, fields)
+            where_sql, params = flt.where()
+
+        result = {"aggregations": {f: [] for f in fields}}
+        if fields:
+            sql = self._grouping_sets_sql(fields, source, where_sql, count_sql, costo_sql)
+            with self.cursor() as cur:
+                if table is not None:
+                    cur.register("_rs", table)
+                try:
+                    rows = cur.execute(sql, params).fetchall()
+                finally:
+                    if table is not None:
+                        cur.unregister("_rs")
+            for r in rows:
+                result["aggregations"][fields[r[0]]].append(
+                    {"value": r[1 + r[0]], "count": r[-2], "costo": r[-1]}
                 )
+        if totals:
+            # CUP distinti e finanziamento non stanno nel cubo: totali memorizzati
+            result["totals"] = self._stats_for(flt)[0]
+        return result, path
 
-            if filters.get("SEARCH_CUP"):
-                where_clauses.append("CUP LIKE ?")
-                params.append(f"{filters['SEARCH_CUP'].upper()}%")
+    def _grouping_sets_sql(self, fields, source, where_sql, count_sql, costo_sql):
+        """
+        Query con un grouping set per campo. Righe: (indice campo, valori dei
+        campi, n, costo), le prime AGGREGATION_LIMIT per campo con valore presente.
+        """
+        cols = ", ".join(f'"{f}"' for f in fields)
+        sets = ", ".join(f'("{f}")' for f in fields)
+        set_id = " ".join(
+            f'WHEN GROUPING("{f}") = 0 THEN {i}' for i, f in enumerate(fields)
+        )
+        present = " OR ".join(
+            f"(_set = {i} AND {self._not_empty(f)})" for i, f in enumerate(fields)
+        )
+        return f"""
+            SELECT _set, {cols}, n, costo
+            FROM (
+                SELECT CASE {set_id} END AS _set, {cols},
+                       {count_sql} AS n, {costo_sql} AS costo
+                FROM {source}
+                {where_sql}
+                GROUP BY GROUPING SETS ({sets})
+            )
+            WHERE {present}
+            QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY _set ORDER BY n DESC, {cols}
+            ) <= {AGGREGATION_LIMIT}
+            ORDER BY _set, n DESC, {cols}
+        """
 
-            if filters.get("SEARCH_CIG"):
-                where_clauses.append(
-                    f"CUP IN (SELECT DISTINCT CUP FROM '{CIG_PARQUET}' WHERE CIG LIKE ?)"
-                )
-                params.append(f"{filters['SEARCH_CIG'].upper()}%")
+    def _totals(self, cur, source, where_sql, params):
+        """Totali di progetti su una sorgente filtrata (chiavi di stats.json)."""
+        row = cur.execute(f"""
+            SELECT COUNT(*), COUNT(DISTINCT CUP),
+                   SUM({self._num("COSTO_PROGETTO")}),
+                   SUM({self._num("FINANZIAMENTO_PROGETTO")})
+            FROM {source}
+            {where_sql}
+        """, params).fetchone()
+        return {
+            "progetti": row[0],
+            "cup_unici": row[1],
+            "costo_totale": row[2],
+            "finanziamento_totale": row[3],
+        }
 
-            if "costo_min" in filters and filters["costo_min"]:
-                where_clauses.append(
-                    "TRY_CAST(COSTO_PROGETTO AS BIGINT) >= ?"
-                )
-                params.append(int(filters["costo_min"]))
-            if "costo_max" in filters and filters["costo_max"]:
-                where_clauses.append(
-                    "TRY_CAST(COSTO_PROGETTO AS BIGINT) <= ?"
-                )
-                params.append(int(filters["costo_max"]))
+    def _aggregate_cached(self, table, field):
+        """Aggregazione per campo su un result set in cache."""
+        if field in DEFAULT_COLUMNS:
+            source = "_rs"
+            extra = ""
+        else:
+            # Colonna non in cache: semi-join sui CUP del result set
+            source = self.src_progetti
+            extra = "AND CUP IN (SELECT CUP FROM _rs)"
+
+        with self.cursor() as cur:
+            cur.register("_rs", table)
+            try:
+                rows = cur.execute(f"""
+                    SELECT "{field}", COUNT(*) as n,
+                           SUM({self._num("COSTO_PROGETTO")}) as costo
+                    FROM {source}
+                    WHERE {self._not_empty(field)} {extra}
+                    GROUP BY "{field}"
+                    ORDER BY n DESC, "{field}"
+                    LIMIT {AGGREGATION_LIMIT}
+                """).fetchall()
+            finally:
+                cur.unregister("_rs")
 
-        where_sql = ""
-        if where_clauses:
-            where_sql = "WHERE " + " AND ".join(where_clauses)
+        return [
+            {"value": r[0], "count": r[1], "costo": r[2]}
+            for r in rows
+        ]
 
+    def _stream_query(self, sql, params):
+        """
+        RecordBatchReader su una query, letto a blocchi di EXPORT_BATCH_ROWS.
+        Usa un cursore dedicato (non del pool), chiuso a fine lettura: un
+        export lungo non sottrae cursori alle altre richieste.
+        """
+        cur = self._new_cursor()
+        try:
+            reader = cur.execute(sql, params).fetch_record_batch(EXPORT_BATCH_ROWS)
+        except Exception:
+            cur.close()
+            raise
+
+        def batches():
+            try:
+                yield from reader
+            finally:
+                cur.close()
+
+        return pa.RecordBatchReader.from_batches(reader.schema, batches())
+
+    def _stream_cached(self, table, limit):
+        """RecordBatchReader su un result set in cache."""
+        if limit:
+            table = table.slice(0, limit)
+        return pa.RecordBatchReader.from_batches(
+            table.schema, table.to_batches(max_chunksize=EXPORT_BATCH_ROWS)
+        )
+
+    def count_filtered(self, table, q="", filters=None):
+        """
+        Numero di righe filtrate di "progetti" o "cig" (per i job di export):
+        un COUNT(*) sul filtro compilato, senza pagina e senza riempire la
+        cache dei result set.
+        """
+        flt = self.compile_filters(table, q, filters)
+        cached = self._result_cache.get(flt.key)
+        if cached is not None:
+            return cached.num_rows
+
+        source = self.src_cig if table == "cig" else self.src_progetti
+        where_sql, params = flt.where()
+        with self.cursor() as cur:
+            return cur.execute(
+                f"SELECT COUNT(*) FROM {source} {where_sql}", params
+            ).fetchone()[0]
+
+    def export_query(self, q="", filters=None, limit=0):
+        """Export dei progetti filtrati: RecordBatchReader in streaming (limit 0 = tutti)."""
+        flt = self.compile_filters("progetti", q, filters)
+        table = self._result_cache.get(flt.key)
+        if table is not None:
+            return self._stream_cached(table, limit)
+
+        where_sql, params = flt.where()
         cols = ", ".join(f'"{c}"' for c in DEFAULT_COLUMNS)
-        rows = self.con.execute(f"""
+        limit_sql = "LIMIT ?" if limit else ""
+        return self._stream_query(f"""
             SELECT {cols}
-            FROM '{PARQUET_FILE}'
+            FROM {self.src_progetti}
             {where_sql}
             ORDER BY CUP
-            LIMIT ?
-        """, params + [limit]).fetchall()
-
-        return DEFAULT_COLUMNS, rows
-
-    def export_cigs(self, q="", filters=None, limit=100000):
-        """Ritorna dati CIG per export CSV (max 100k righe)."""
-        where_clauses = []
-        params = []
-
-        if q:
-            search_parts = []
-            for col in CIG_SEARCH_COLUMNS:
-                search_parts.append(f'LOWER(CAST("{col}" AS VARCHAR)) LIKE ?')
-                params.append(f"%{q.lower()}%")
-            where_clauses.append(f"({' OR '.join(search_parts)})")
-
-        if filters:
-            for col, val in filters.items():
-                if col in CIG_FILTER_COLUMNS and val:
-                    if isinstance(val, list):
-                        placeholders = ", ".join(["?"] * len(val))
-                        where_clauses.append(f'CAST("{col}" AS VARCHAR) IN ({placeholders})')
-                        params.extend([str(v) for v in val])
-                    else:
-                        where_clauses.append(f'CAST("{col}" AS VARCHAR) = ?')
-                        params.append(str(val))
-
-            if filters.get("ONLY_PNRR") == "SI":
-                where_clauses.append("flag_pnrr_pnc = 1")
-
-            if filters.get("FLAG_SUBAPPALTO") == "SI":
-                where_clauses.append("flag_subappalto = true")
-            elif filters.get("FLAG_SUBAPPALTO") == "NO":
-                where_clauses.append("flag_subappalto = false")
-
-            if filters.get("HAS_DETAIL") == "SI":
-                where_clauses.append("oggetto_gara IS NOT NULL")
-
-            if filters.get("importo_min"):
-                where_clauses.append("importo_complessivo_gara >= ?")
-                params.append(float(filters["importo_min"]))
-            if filters.get("importo_max"):
-                where_clauses.append("importo_complessivo_gara <= ?")
-                params.append(float(filters["importo_max"]))
-
-        where_sql = ""
-        if where_clauses:
-            where_sql = "WHERE " + " AND ".join(where_clauses)
+            {limit_sql}
+        """, params + ([limit] if limit else []))
+
+    def export_cigs(self, q="", filters=None, limit=0):
+        """Export dei CIG filtrati: RecordBatchReader in streaming (limit 0 = tutti)."""
+        flt = self.compile_filters("cig", q, filters)
+        table = self._result_cache.get(flt.key)
+        if table is not None:
+            return self._stream_cached(table, limit)
 
+        where_sql, params = flt.where()
         cols = ", ".join(f'"{c}"' for c in CIG_DEFAULT_COLUMNS)
-        rows = self.con.execute(f"""
+        limit_sql = "LIMIT ?" if limit else ""
+        return self._stream_query(f"""
             SELECT {cols}
-            FROM '{CIG_PARQUET}'
+            FROM {self.src_cig}
             {where_sql}
             ORDER BY CIG
-            LIMIT ?
-        """, params + [limit]).fetchall()
-
-        return CIG_DEFAULT_COLUMNS, rows
+            {limit_sql}
+        """, params + ([limit] if limit else []))
 
     def get_cig_filter_options(self):
         """Ritorna i valori distinti per ogni filtro CIG."""
-        options = {}
-        for col in CIG_FILTER_COLUMNS:
-            rows = self.con.execute(f"""
-                SELECT DISTINCT "{col}"
-                FROM '{CIG_PARQUET}'
-                WHERE "{col}" IS NOT NULL AND CAST("{col}" AS VARCHAR) != ''
-                ORDER BY "{col}"
-            """).fetchall()
-            options[col] = [r[0] for r in rows]
-        return options
+        return {
+            col: [f["value"] for f in values]
+            for col, values in self.get_facets("cig").items()
+        }
 
     def search_cigs(self, q="", filters=None, sort_col=None,
-                    sort_dir="ASC", limit=50, offset=0):
-        """Ricerca CIG con filtri, ordinamento e paginazione."""
-        where_clauses = []
-        params = []
-
-        # Ricerca testuale
-        if q:
-            search_parts = []
-            for col in CIG_SEARCH_COLUMNS:
-                search_parts.append(f'LOWER(CAST("{col}" AS VARCHAR)) LIKE ?')
-                params.append(f"%{q.lower()}%")
-            where_clauses.append(f"({' OR '.join(search_parts)})")
-
-        # Filtri
-        if filters:
-            for col, val in filters.items():
-                if col in CIG_FILTER_COLUMNS and val:
-                    if isinstance(val, list):
-                        placeholders = ", ".join(["?"] * len(val))
-                        where_clauses.append(f'CAST("{col}" AS VARCHAR) IN ({placeholders})')
-                        params.extend([str(v) for v in val])
-                    else:
-                        where_clauses.append(f'CAST("{col}" AS VARCHAR) = ?')
-                        params.append(str(val))
-
-            # Flag PNRR
-            if filters.get("ONLY_PNRR") == "SI":
-                where_clauses.append("flag_pnrr_pnc = 1")
-
-            # Flag subappalto
-            if filters.get("FLAG_SUBAPPALTO") == "SI":
-                where_clauses.append("flag_subappalto = true")
-            elif filters.get("FLAG_SUBAPPALTO") == "NO":
-                where_clauses.append("flag_subappalto = false")
-
-            # Solo con dettaglio
-            if filters.get("HAS_DETAIL") == "SI":
-                where_clauses.append("oggetto_gara IS NOT NULL")
-
-            # Ricerca aggiudicatario per denominazione
-            if filters.get("SEARCH_AGGIUDICATARIO"):
-                where_clauses.append(
-                    f"CIG IN (SELECT DISTINCT CIG FROM '{AGGIUDICATARI_PARQUET}' "
-                    f"WHERE LOWER(denominazione) LIKE ?)"
-                )
-                params.append(f"%{filters['SEARCH_AGGIUDICATARIO'].lower()}%")
-
-            # Ricerca aggiudicatario per codice fiscale
-            if filters.get("SEARCH_CF_AGGIUDICATARIO"):
-                where_clauses.append(
-                    f"CIG IN (SELECT DISTINCT CIG FROM '{AGGIUDICATARI_PARQUET}' "
-                    f"WHERE LOWER(codice_fiscale) LIKE ?)"
-                )
-                params.append(f"%{filters['SEARCH_CF_AGGIUDICATARIO'].lower()}%")
-
-            # Range importo
-            if filters.get("importo_min"):
-                where_clauses.append("importo_complessivo_gara >= ?")
-                params.append(float(filters["importo_min"]))
-            if filters.get("importo_max"):
-                where_clauses.append("importo_complessivo_gara <= ?")
-                params.append(float(filters["importo_max"]))
-
-        where_sql = ""
-        if where_clauses:
-            where_sql = "WHERE " + " AND ".join(where_clauses)
-
-        # Ordinamento
+                    sort_dir="ASC", limit=50, offset=0, count_mode="exact",
+                    cursor=None):
+        """Ricerca CIG con filtri, ordinamento e paginazione (offset o cursore)."""
+        flt = self.compile_filters("cig", q, filters)
+
+        # Ricerca testuale: senza ordinamento esplicito i risultati seguono
+        # la rilevanza BM25
+        source = self.src_cig
+        ranked = bool(flt.score_sql) and not (sort_col and sort_col in CIG_ALL_COLUMNS)
+        if ranked:
+            source = f"(SELECT *, {flt.score_sql} AS _score FROM {self.src_cig})"
+        where_sql, params = flt.where(ranked=ranked)
+
+        # Ordinamento (CIG come chiave secondaria per il cursore keyset)
         order_sql = ""
+        sort_expr = None
+        direction = "ASC"
         if sort_col and sort_col in CIG_ALL_COLUMNS:
             direction = "DESC" if sort_dir.upper() == "DESC" else "ASC"
-            if sort_col in CIG_NUMERIC_COLUMNS:
-                order_sql = f'ORDER BY "{sort_col}" {direction} NULLS LAST'
-            else:
-                order_sql = f'ORDER BY "{sort_col}" {direction} NULLS LAST'
+            sort_expr = f'"{sort_col}"'
+            order_sql = f"ORDER BY {sort_expr} {direction} NULLS LAST, CIG"
+        elif ranked:
+            sort_col, sort_expr, direction = "_score", "_score", "DESC"
+            order_sql = "ORDER BY _score DESC, CIG"
         else:
+            sort_col = None
             order_sql = "ORDER BY CIG"
 
+        keyset = None
+        if cursor:
+            keyset = _keyset_clause(cursor, sort_col, direction, sort_expr, "CIG")
+
         cols = ", ".join(f'"{c}"' for c in CIG_DEFAULT_COLUMNS)
 
-        # Count
-        count_query = f"SELECT COUNT(*) FROM '{CIG_PARQUET}' {where_sql}"
-        total = self.con.execute(count_query, params).fetchone()[0]
+        results = None
+        # Result set in cache: pagine e riordini non rivalutano il filtro
+        # (mai con il conteggio "capped": non serve il totale esatto)
+        cacheable = (
+            where_sql and count_mode != "capped"
+            and (sort_col is None or sort_col in CIG_DEFAULT_COLUMNS)
+        )
+        if cacheable:
+            table = self._cached_result(flt, self.src_cig, cols, "CIG")
+            if table is not None:
+                results = self._page_from_result(
+                    table, order_sql, "CIG", limit, offset, keyset
+                )
+                total, capped = table.num_rows, False
+
+        if results is None:
+            # Il valore di ordinamento serve al cursore anche se la colonna
+            # non e' tra quelle mostrate
+            row_cols = list(CIG_DEFAULT_COLUMNS)
+            if sort_col and sort_col not in row_cols:
+                row_cols.append(sort_col)
+            rows, total, capped = self._paged_query(
+                source, ", ".join(f'"{c}"' for c in row_cols),
+                where_sql, order_sql, params,
+                limit, offset, count_mode, keyset,
+            )
+            if cacheable:
+                self._remember_total(flt, total, capped)
+            results = [dict(zip(row_cols, row)) for row in rows]
 
-        # Dati paginati
-        data_query = f"""
-            SELECT {cols}
-            FROM '{CIG_PARQUET}'
-            {where_sql}
-            {order_sql}
-            LIMIT ? OFFSET ?
-        """
-        rows = self.con.execute(data_query, params + [limit, offset]).fetchall()
+        next_cursor = None
+        if results and len(results) == limit:
+            last = results[-1]
+            value = _sort_value(last, sort_col, False)
+            next_cursor = encode_cursor(sort_col, direction, value, last["CIG"])
+        if sort_col and sort_col not in CIG_DEFAULT_COLUMNS:
+            for row in results:
+                row.pop(sort_col, None)
 
-        results = [dict(zip(CIG_DEFAULT_COLUMNS, row)) for row in rows]
-        return results, total
+        return results, total, capped, next_cursor
 
     def get_cig_detail(self, cig):
         """Ritorna tutti i dettagli di un singolo CIG."""
+        self._check_data_version()
         cols = ", ".join(f'"{c}"' for c in CIG_ALL_COLUMNS)
-        rows = self.con.execute(f"""
-            SELECT {cols}
-            FROM '{CIG_PARQUET}'
-            WHERE CIG = ?
-            LIMIT 10
-        """, [cig]).fetchall()
+        with self.cursor() as cur:
+            rows = cur.execute(f"""
+                SELECT {cols}
+                FROM {self.src_cig}
+                WHERE CIG = ?
+                LIMIT 10
+            """, [cig]).fetchall()
         return [dict(zip(CIG_ALL_COLUMNS, row)) for row in rows]
 
     def get_cigs_for_cup(self, cup):
         """Ritorna i CIG associati a un CUP."""
-        try:
-            rows = self.con.execute(f"""
-                SELECT *
-                FROM '{CIG_PARQUET}'
-                WHERE CUP = ?
-                ORDER BY CIG
-            """, [cup]).fetchall()
-        except Exception:
-            return []
-
-        if not rows:
+        self._check_data_version()
+        # La maggior parte dei CUP non ha CIG: l'indice evita la query
+        if self.cup_cigs is not None and cup not in self.cup_cigs:
             return []
-
-        # Get column names from the query
-        cols = [desc[0] for desc in self.con.description]
+        with self.cursor() as cur:
+            try:
+                rows = cur.execute(f"""
+                    SELECT *
+                    FROM {self.src_cig}
+                    WHERE CUP = ?
+                    ORDER BY CIG
+                """, [cup]).fetchall()
+            except Exception:
+                return []
+
+            if not rows:
+                return []
+
+            # Get column names from the query
+            cols = [desc[0] for desc in cur.description]
         return [dict(zip(cols, row)) for row in rows]
 
     def search_by_cig(self, cig):
         """Cerca un CIG e ritorna i CUP associati."""
-        try:
-            rows = self.con.execute(f"""
-                SELECT DISTINCT CUP
-                FROM '{CIG_PARQUET}'
-                WHERE CIG = ?
-            """, [cig]).fetchall()
-        except Exception:
-            return []
+        self._check_data_version()
+        if self.cig_cups is not None:
+            return self.cig_cups.lookup(cig).column("CUP").to_pylist()
+        with self.cursor() as cur:
+            try:
+                rows = cur.execute(f"""
+                    SELECT DISTINCT CUP
+                    FROM {self.src_cig}
+                    WHERE CIG = ?
+                """, [cig]).fetchall()
+            except Exception:
+                return []
 
         return [r[0] for r in rows]
 
     def get_aggiudicatari_for_cig(self, cig):
         """Ritorna gli aggiudicatari associati a un CIG."""
-        try:
-            rows = self.con.execute(f"""
-                SELECT *
-                FROM '{AGGIUDICATARI_PARQUET}'
-                WHERE CIG = ?
-                ORDER BY ruolo NULLS LAST, denominazione
-            """, [cig]).fetchall()
-        except Exception:
-            return []
-
-        if not rows:
-            return []
-        cols = [desc[0] for desc in self.con.description]
+        self._check_data_version()
+        if self.cig_aggiudicatari is not None:
+            return self.cig_aggiudicatari.lookup(cig).to_pylist()
+        with self.cursor() as cur:
+            try:
+                rows = cur.execute(f"""
+                    SELECT *
+                    FROM {self.src_aggiudicatari}
+                    WHERE CIG = ?
+                    ORDER BY ruolo NULLS LAST, denominazione
+                """, [cig]).fetchall()
+            except Exception:
+                return []
+
+            if not rows:
+                return []
+            cols = [desc[0] for desc in cur.description]
         return [dict(zip(cols, row)) for row in rows]
 
     def get_aggiudicatari_for_cup(self, cup):
         """Ritorna gli aggiudicatari di tutti i CIG associati a un CUP."""
-        try:
-            rows = self.con.execute(f"""
-                SELECT a.*
-                FROM '{AGGIUDICATARI_PARQUET}' a
-                INNER JOIN '{CIG_PARQUET}' c ON a.CIG = c.CIG
-                WHERE c.CUP = ?
-                ORDER BY a.CIG, a.ruolo NULLS LAST, a.denominazione
-            """, [cup]).fetchall()
-        except Exception:
-            return []
+        self._check_data_version()
+        if self.cup_cigs is not None and self.cig_aggiudicatari is not None:
+            codes = self.cup_cigs.lookup(cup).column("CIG").to_pylist()
+            return self._aggiudicatari_for_cigs(codes)
+        with self.cursor() as cur:
+            try:
+                rows = cur.execute(f"""
+                    SELECT a.*
+                    FROM {self.src_aggiudicatari} a
+                    INNER JOIN {self.src_cig} c ON a.CIG = c.CIG
+                    WHERE c.CUP = ?
+                    ORDER BY a.CIG, a.ruolo NULLS LAST, a.denominazione
+                """, [cup]).fetchall()
+            except Exception:
+                return []
+
+            if not rows:
+                return []
+            cols = [desc[0] for desc in cur.description]
+        return [dict(zip(cols, row)) for row in rows]
 
-        if not rows:
+    def _rows_by_keys(self, cur, source, cols, key_col, keys, order_sql):
+        """
+        Righe di source con key_col in keys, come dict. Con gli indici ART un
+        lookup per chiave (prepared statement); sui Parquet, o con molte
+        chiavi, una sola scansione con le chiavi in un unico parametro.
+        """
+        if not keys:
             return []
-        cols = [desc[0] for desc in self.con.description]
-        return [dict(zip(cols, row)) for row in rows]
+        col_sql = ", ".join(f'"{c}"' for c in cols) if cols else "*"
+        if self.indexed and len(keys) <= POINT_LOOKUP_MAX:
+            rows = []
+            for key in keys:
+                rows.extend(cur.execute(f"""
+                    SELECT {col_sql} FROM {source} WHERE {key_col} = ? {order_sql}
+                """, [key]).fetchall())
+        else:
+            rows = cur.execute(f"""
+                SELECT {col_sql} FROM {source}
+                WHERE {key_col} IN (SELECT UNNEST(string_split(?, chr(31))))
+                {order_sql}
+            """, [VALUE_SEP.join(keys)]).fetchall()
+        names = [desc[0] for desc in cur.description]
+        return [dict(zip(names, row)) for row in rows]
+
+    def get_projects_full(self, cups):
+        """
+        Dettaglio, CIG e aggiudicatari di piu' CUP in un solo passaggio: il
+        set di CIG dei CUP viene risolto una volta e usato per gli aggiudicatari.
+        Ritorna {cup: {"data", "cig", "aggiudicatari"}} per i CUP trovati.
+        """
+        self._check_data_version()
+        cups = sorted(set(cups))
+        with self.cursor() as cur:
+            projects = self._rows_by_keys(
+                cur, self.src_progetti, self.all_columns, "CUP", cups, ""
+            )
+            found = sorted({p["CUP"] for p in projects})
+            if self.cup_cigs is not None:
+                found = [c for c in found if c in self.cup_cigs]
+            try:
+                cigs = self._rows_by_keys(
+                    cur, self.src_cig, None, "CUP", found, "ORDER BY CUP, CIG"
+                )
+                cig_codes = sorted({c["CIG"] for c in cigs})
+                if self.cig_aggiudicatari is not None:
+                    aggiudicatari = self._aggiudicatari_for_cigs(cig_codes)
+                else:
+                    aggiudicatari = self._rows_by_keys(
+                        cur, self.src_aggiudicatari, None, "CIG", cig_codes,
+                        "ORDER BY CIG, ruolo NULLS LAST, denominazione",
+                    )
+            except Exception:
+                cigs, aggiudicatari = [], []
+
+        by_cig = {}
+        for a in aggiudicatari:
+            by_cig.setdefault(a["CIG"], []).append(a)
+
+        results = {}
+        for p in projects:
+            entry = results.setdefault(p["CUP"], {
+                "data": [], "cig": {"data": [], "total": 0},
+                "aggiudicatari": {"data": [], "total": 0},
+            })
+            entry["data"].append(p)
+        for cup, group in groupby(cigs, key=lambda c: c["CUP"]):
+            entry = results[cup]
+            entry["cig"]["data"] = list(group)
+            entry["cig"]["total"] = len(entry["cig"]["data"])
+            codes = sorted({c["CIG"] for c in entry["cig"]["data"]})
+            entry["aggiudicatari"]["data"] = [a for code in codes for a in by_cig.get(code, [])]
+            entry["aggiudicatari"]["total"] = len(entry["aggiudicatari"]["data"])
+        return results
+
+    def _aggiudicatari_for_cigs(self, codes):
+        """Aggiudicatari dei CIG (in ordine) dall'indice di adiacenza."""
+        rows = []
+        for code in codes:
+            rows.extend(self.cig_aggiudicatari.lookup(code).to_pylist())
+        return rows
+
+    def get_project_full(self, cup):
+        """Dettaglio, CIG e aggiudicatari di un CUP, o None se non trovato."""
+        return self.get_projects_full([cup]).get(cup)
@@ -0,0 +1,177 @@
+"""
+Cache di prepared statement per le forme di query ricorrenti.
+La forma e' il testo SQL con i segnaposto (colonne, filtri e ordinamento
+sono gia' nel testo): ogni cursore del pool la prepara una volta
+(PREPARE) e poi la esegue con EXECUTE, senza rifare parse, bind e plan.
+I parametri arrivano a EXECUTE come letterali: il binding dal client Python
+ripreparerebbe la query a ogni chiamata.
+"""
+
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+import duckdb
+
+# Statement preparati per cursore (LRU)
+STATEMENT_CACHE_SIZE = int(os.environ.get("STATEMENT_CACHE_SIZE", "64"))
+# Forme di query tenute nelle statistiche
+STATEMENT_STATS_SIZE = 256
+
+
+def to_literal(value):
+    """Letterale SQL per un parametro. TypeError se il tipo non e' gestito."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if math.isfinite(value):
+            return repr(value)
+        return f"'{value}'::DOUBLE"
+    if isinstance(value, str):
+        if "\x00" in value:
+            raise TypeError("carattere NUL nel parametro")
+        return "'" + value.replace("'", "''") + "'"
+    if isinstance(value, datetime):
+        return f"TIMESTAMP '{value.isoformat(sep=' ')}'"
+    if isinstance(value, date):
+        return f"DATE '{value.isoformat()}'"
+    raise TypeError(f"tipo di parametro non gestito: {type(value).__name__}")
+
+
+def numbered_placeholders(sql):
+    """Sostituisce i ? posizionali con $1..$n, fuori da stringhe e identificatori."""
+    out = []
+    quote = None
+    n = 0
+    for ch in sql:
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+        elif ch == "?":
+            n += 1
+            ch = f"${n}"
+        out.append(ch)
+    return "".join(out)
+
+
+class StatementCache:
+    def __init__(self, size=STATEMENT_CACHE_SIZE):
+        self.size = size
+        self._prepared = {}  # id(cursore) -> OrderedDict(sql -> nome statement)
+        self._unpreparable = set()
+        self._stats = OrderedDict()  # sql -> contatori per forma
+        self._lock = threading.Lock()
+
+    def execute(self, cur, sql, params):
+        """
+        Esegue sql con params su cur tramite prepared statement. Ricade
+        sull'esecuzione diretta se la forma non e' preparabile o un
+        parametro non ha un letterale.
+        """
+        if sql in self._unpreparable:
+            return cur.execute(sql, params)
+        try:
+            args = ", ".join(to_literal(p) for p in params)
+        except TypeError:
+            return cur.execute(sql, params)
+
+        start = time.perf_counter()
+        prepared = self._prepared.setdefault(id(cur), OrderedDict())
+        name = prepared.get(sql)
+        if name is None:
+            name = "q_" + hashlib.md5(sql.encode()).hexdigest()[:16]
+            try:
+                cur.execute(f"PREPARE {name} AS {numbered_placeholders(sql)}")
+            except duckdb.Error:
+                self._unpreparable.add(sql)
+                return cur.execute(sql, params)
+            prepared[sql] = name
+            if len(prepared) > self.size:
+                _, evicted = prepared.popitem(last=False)
+                cur.execute(f"DEALLOCATE {evicted}")
+            prepare_ms = (time.perf_counter() - start) * 1000
+        else:
+            prepared.move_to_end(sql)
+            prepare_ms = None
+
+        result = cur.execute(f"EXECUTE {name}({args})")
+        self._record(sql, prepare_ms, (time.perf_counter() - start) * 1000)
+        return result
+
+    def _record(self, sql, prepare_ms, total_ms):
+        with self._lock:
+            stats = self._stats.get(sql)
+            if stats is None:
+                stats = self._stats[sql] = {
+                    "calls": 0, "prepares": 0, "prepare_ms": 0.0, "total_ms": 0.0,
+                }
+                if len(self._stats) > STATEMENT_STATS_SIZE:
+                    self._stats.popitem(last=False)
+            else:
+                self._stats.move_to_end(sql)
+            stats["calls"] += 1
+            stats["total_ms"] += total_ms
+            if prepare_ms is not None:
+                stats["prepares"] += 1
+                stats["prepare_ms"] += prepare_ms
+
+    def stats(self):
+        """Contatori per forma di query, dalla piu' eseguita."""
+        with self._lock:
+            items = [(sql, dict(s)) for sql, s in self._stats.items()]
+        shapes = []
+        for sql, s in sorted(items, key=lambda x: -x[1]["calls"]):
+            shapes.append({
+                "sql": " ".join(sql.split())[:200],
+                "calls": s["calls"],
+                "prepares": s["prepares"],
+                "prepare_ms": round(s["prepare_ms"], 3),
+                "avg_ms": round(s["total_ms"] / s["calls"], 3),
+            })
+        return {
+            "size": self.size,
+            "unpreparable": len(self._unpreparable),
+            "shapes": shapes,
+        }
+
+
+class PreparedCursor:
+    """
+    Cursore del pool: le query con parametri passano dalla StatementCache.
+    Con viste registrate (register) l'esecuzione resta diretta, perche' la
+    vista cambia a ogni registrazione.
+    """
+
+    def __init__(self, cur, cache):
+        self._cur = cur
+        self._cache = cache
+        self._views = set()
+
+    def execute(self, sql, params=None):
+        if params and not self._views:
+            return self._cache.execute(self._cur, sql, params)
+        if params is None:
+            return self._cur.execute(sql)
+        return self._cur.execute(sql, params)
+
+    def register(self, name, obj):
+        self._views.add(name)
+        return self._cur.register(name, obj)
+
+    def unregister(self, name):
+        self._views.discard(name)
+        return self._cur.unregister(name)
+
+    def __getattr__(self, name):
+        # description, fetch* ecc. dal cursore DuckDB
+        return getattr(self._cur, name)
@@ -18,6 +18,17 @@ let cigGridApi = null;
 let cigSort = { col: null, dir: "ASC" };
 let cigFiltersLoaded = false;
 
+// Ultimo cursore keyset ricevuto per ciascuna tabella
+let projectsCursor = { page: -1, cursor: null, key: "" };
+let cigCursor = { page: -1, cursor: null, key: "" };
+
+// Filtri per cui sono mostrati i conteggi delle faccette
+let projectsFacetsKey = "";
+let cigFacetsKey = "";
+
+// Dettagli (progetto + CIG + aggiudicatari) precaricati per la pagina visibile
+let detailCache = new Map();
+
 // Registry of SearchableSelect instances, keyed by element id
 const ssInstances = {};
 
@@ -31,6 +42,7 @@ class SearchableSelect {
         this.id = container.id;
         this.placeholder = container.dataset.placeholder || "Tutti";
         this.options = [];
+        this.counts = null;
         this.selectedValue = "";
         this.highlightIdx = -1;
         this.build();
@@ -61,6 +73,11 @@ class SearchableSelect {
         this.options = values.map(v => String(v));
     }
 
+    // Conteggi delle faccette (Map valore -> conteggio), o null
+    setCounts(counts) {
+        this.counts = counts;
+    }
+
     get value() { return this.selectedValue; }
 
     set value(v) {
@@ -104,7 +121,10 @@ class SearchableSelect {
 
         const show = filtered.slice(0, 200);
         for (const val of show) {
-            html += `<div class="ss-option" data-val="${escapeAttr(val)}">${highlight(val, q)}</div>`;
+            const count = this.counts
+                ? `<span class="ss-facet">${formatNumber(this.counts.get(val) || 0)}</span>`
+                : "";
+            html += `<div class="ss-option" data-val="${escapeAttr(val)}">${highlight(val, q)}${count}</div>`;
         }
         if (filtered.length > 200) {
             html += `<div class="ss-count">...e altri ${filtered.length - 200}. Digita per filtrare.</div>`;
@@ -403,41 +423,97 @@ const FILTER_MAPPING = {
 };
 
 async function loadFilterOptions() {
-    const options = await fetchApi("/api/filters/options");
-    if (!options) return;
+    // Faccette senza filtri: valori dei dropdown con i conteggi totali
+    const facets = await fetchApi("/api/filters/facets");
+    if (!facets) return;
+    setFacetOptions(facets, FILTER_MAPPING);
+}
 
-    for (const [col, elId] of Object.entries(FILTER_MAPPING)) {
-        if (!options[col]) continue;
+// Popola i dropdown con i valori delle faccette e ne mostra i conteggi
+function setFacetOptions(facets, mapping) {
+    for (const [col, elId] of Object.entries(mapping)) {
+        if (!facets[col]) continue;
+        const values = facets[col].map(f => f.value);
         if (ssInstances[elId]) {
-            ssInstances[elId].setOptions(options[col]);
+            ssInstances[elId].setOptions(values);
             continue;
         }
         const select = document.getElementById(elId);
         if (!select) continue;
-        for (const val of options[col]) {
+        for (const val of values) {
             const opt = document.createElement("option");
             opt.value = val;
             opt.textContent = val;
             select.appendChild(opt);
         }
     }
+    applyFacetCounts(facets, mapping);
+}
+
+// Aggiorna i conteggi dei dropdown: i valori restano quelli iniziali,
+// quelli esclusi dagli altri filtri mostrano 0
+function applyFacetCounts(facets, mapping) {
+    for (const [col, elId] of Object.entries(mapping)) {
+        if (!facets[col]) continue;
+        const counts = new Map(facets[col].map(f => [String(f.value), f.count]));
+        if (ssInstances[elId]) {
+            ssInstances[elId].setCounts(counts);
+            continue;
+        }
+        const select = document.getElementById(elId);
+        if (!select) continue;
+        for (const opt of select.options) {
+            if (!opt.value) continue;
+            opt.textContent = `${opt.value} (${formatNumber(counts.get(opt.value) || 0)})`;
+        }
+    }
+}
+
+// Ricalcola le faccette solo quando cambiano ricerca o filtri (non pagina
+// o ordinamento). Ritorna la chiave dei filtri mostrati.
+async function refreshFacets(url, params, mapping, shownKey) {
+    const facetParams = new URLSearchParams(params);
+    for (const key of ["sort", "order", "limit", "offset", "cursor"]) facetParams.delete(key);
+    const key = facetParams.toString();
+    if (key === shownKey) return shownKey;
+    const facets = await fetchApi(`${url}?${facetParams}`);
+    if (facets) applyFacetCounts(facets, mapping);
+    return key;
+}
+
+// Pagina successiva con il cursore dell'API (costo costante anche su
+// pagine profonde); salti a pagine arbitrarie con l'offset
+function setPageParams(params, page, state) {
+    const key = params.toString();
+    if (state.cursor && state.key === key && page === state.page + 1) {
+        params.set("cursor", state.cursor);
+    } else {
+        params.set("offset", page * PAGE_SIZE);
+    }
+    return key;
 }
 
 async function loadProjects() {
     showLoading(true);
     const params = buildQueryParams();
     params.set("limit", PAGE_SIZE);
-    params.set("offset", currentPage * PAGE_SIZE);
+    const page = currentPage;
+    const key = setPageParams(params, page, projectsCursor);
 
     try {
         const result = await fetchApi(`/api/projects?${params}`);
         if (!result || !gridApi) return;
 
         totalResults = result.total;
+        projectsCursor = { page, cursor: result.next_cursor, key };
         gridApi.setGridOption("rowData", result.data);
+        prefetchDetails(result.data.map(r => r.CUP));
 
-        document.getElementById("results-info").textContent = `${formatNumber(totalResults)} risultati`;
-        document.getElementById("header-info").textContent = `${formatNumber(totalResults)} progetti trovati`;
+        const totalLabel = formatTotal(totalResults, result.total_capped);
+        document.getElementById("results-info").textContent = `${totalLabel} risultati`;
+        document.getElementById("header-info").textContent = `${totalLabel} progetti trovati`;
+        refreshFacets("/api/filters/facets", params, FILTER_MAPPING, projectsFacetsKey)
+            .then(key => { projectsFacetsKey = key; });
         renderPagination(currentPage, totalResults, (p) => { currentPage = p; loadProjects(); });
     } finally {
         showLoading(false);
@@ -463,24 +539,9 @@ const CIG_FILTER_MAPPING = {
 };
 
 async function loadCigFilterOptions() {
-    const options = await fetchApi("/api/cig/filters/options");
-    if (!options) return;
-
-    for (const [col, elId] of Object.entries(CIG_FILTER_MAPPING)) {
-        if (!options[col]) continue;
-        if (ssInstances[elId]) {
-            ssInstances[elId].setOptions(options[col]);
-            continue;
-        }
-        const select = document.getElementById(elId);
-        if (!select) continue;
-        for (const val of options[col]) {
-            const opt = document.createElement("option");
-            opt.value = val;
-            opt.textContent = val;
-            select.appendChild(opt);
-        }
-    }
+    const facets = await fetchApi("/api/cig/filters/facets");
+    if (!facets) return;
+    setFacetOptions(facets, CIG_FILTER_MAPPING);
     cigFiltersLoaded = true;
 }
 
@@ -488,17 +549,22 @@ async function loadCigs() {
     showLoading(true);
     const params = buildCigQueryParams();
     params.set("limit", PAGE_SIZE);
-    params.set("offset", cigPage * PAGE_SIZE);
+    const page = cigPage;
+    const key = setPageParams(params, page, cigCursor);
 
     try {
         const result = await fetchApi(`/api/cig/search?${params}`);
         if (!result || !cigGridApi) return;
 
         cigTotal = result.total;
+        cigCursor = { page, cursor: result.next_cursor, key };
         cigGridApi.setGridOption("rowData", result.data);
 
-        document.getElementById("results-info").textContent = `${formatNumber(cigTotal)} risultati`;
-        document.getElementById("header-info").textContent = `${formatNumber(cigTotal)} CIG trovati`;
+        const totalLabel = formatTotal(cigTotal, result.total_capped);
+        document.getElementById("results-info").textContent = `${totalLabel} risultati`;
+        document.getElementById("header-info").textContent = `${totalLabel} CIG trovati`;
+        refreshFacets("/api/cig/filters/facets", params, CIG_FILTER_MAPPING, cigFacetsKey)
+            .then(key => { cigFacetsKey = key; });
         renderPagination(cigPage, cigTotal, (p) => { cigPage = p; loadCigs(); });
     } finally {
         showLoading(false);
@@ -648,6 +714,57 @@ function resetCigFilters() {
     loadCigs();
 }
 
+// ============================================
+// SUGGERIMENTI
+// ============================================
+
+// Campi di ricerca con suggerimenti per prefisso (id input -> campo di /api/suggest)
+const SUGGEST_INPUTS = {
+    "f-cup": "CUP",
+    "f-cig": "CIG",
+    "f-soggetto": "SOGGETTO_TITOLARE",
+    "fc-cig": "CIG",
+    "fc-cup": "CUP",
+    "fc-aggiudicatario": "denominazione",
+};
+const SUGGEST_DELAY_MS = 150;
+const SUGGEST_MIN_CHARS = 2;
+
+// I suggerimenti arrivano in una datalist nativa collegata all'input
+function bindSuggestions() {
+    for (const [elId, field] of Object.entries(SUGGEST_INPUTS)) {
+        const input = document.getElementById(elId);
+        if (!input) continue;
+        const list = document.createElement("datalist");
+        list.id = `${elId}-suggest`;
+        input.after(list);
+        input.setAttribute("list", list.id);
+        input.setAttribute("autocomplete", "off");
+
+        let timer = null;
+        input.addEventListener("input", () => {
+            clearTimeout(timer);
+            const prefix = input.value.trim();
+            if (prefix.length < SUGGEST_MIN_CHARS) {
+                list.innerHTML = "";
+                return;
+            }
+            timer = setTimeout(async () => {
+                const params = new URLSearchParams({ field, prefix, limit: 10 });
+                const result = await fetchApi(`/api/suggest?${params}`);
+                // Risposta superata da un input successivo
+                if (!result || input.value.trim() !== prefix) return;
+                list.innerHTML = "";
+                for (const item of result.data) {
+                    const opt = document.createElement("option");
+                    opt.value = item.value;
+                    list.appendChild(opt);
+                }
+            }, SUGGEST_DELAY_MS);
+        });
+    }
+}
+
 // ============================================
 // PAGINATION (shared)
 // ============================================
@@ -709,11 +826,24 @@ function renderPagination(page, total, onPageChange) {
 // DETAIL MODAL - PROGETTO
 // ============================================
 
+// Precarica in background i dettagli dei CUP della pagina (una sola richiesta)
+async function prefetchDetails(cups) {
+    detailCache = new Map();
+    if (cups.length === 0) return;
+    const cache = detailCache;
+    const result = await fetchApi(`/api/projects/full?cups=${encodeURIComponent(cups.join(","))}`);
+    if (!result || !result.data) return;
+    for (const [cup, detail] of Object.entries(result.data)) {
+        cache.set(cup, detail);
+    }
+}
+
 async function openDetail(cup) {
     if (!cup) return;
     showLoading(true);
     try {
-        const result = await fetchApi(`/api/projects/${encodeURIComponent(cup)}`);
+        const result = detailCache.get(cup)
+            || await fetchApi(`/api/projects/${encodeURIComponent(cup)}/full`);
         if (!result || !result.data || result.data.length === 0) return;
 
         const project = result.data[0];
@@ -748,22 +878,20 @@ async function openDetail(cup) {
             if (!val || val === "DATO NON PRESENTE") continue;
             const item = document.createElement("div");
             item.className = "detail-item";
-            const formatted = (key === "COSTO_PROGETTO" || key === "FINANZIAMENTO_PROGETTO") ? formatCurrency(val) : val;
+            const formatted = (key === "COSTO_PROGETTO" || key === "FINANZIAMENTO_PROGETTO") ? formatCurrency(val)
+                : key.startsWith("DATA_") ? formatDate(val) : val;
             item.innerHTML = `<div class="dl">${label}</div><div class="dv">${escapeHtml(String(formatted))}</div>`;
             grid.appendChild(item);
         }
         body.appendChild(grid);
 
-        // Load CIG data + aggiudicatari
-        const cigResult = await fetchApi(`/api/projects/${encodeURIComponent(cup)}/cig`);
+        // CIG + aggiudicatari (gia' nella risposta /full)
+        const cigResult = result.cig;
         if (cigResult && cigResult.data && cigResult.data.length > 0) {
-            const aggResult = await fetchApi(`/api/projects/${encodeURIComponent(cup)}/aggiudicatari`);
             const aggiudicatariMap = {};
-            if (aggResult && aggResult.data) {
-                for (const a of aggResult.data) {
-                    if (!aggiudicatariMap[a.CIG]) aggiudicatariMap[a.CIG] = [];
-                    aggiudicatariMap[a.CIG].push(a);
-                }
+            for (const a of result.aggiudicatari.data) {
+                if (!aggiudicatariMap[a.CIG]) aggiudicatariMap[a.CIG] = [];
+                aggiudicatariMap[a.CIG].push(a);
             }
             body.appendChild(buildCigTable(cigResult.data, cigResult.total, aggiudicatariMap));
         }
@@ -1044,13 +1172,40 @@ function closeDetail() {
 // EXPORT
 // ============================================
 
-function exportCsv() {
-    if (currentTab === "cig") {
-        const params = buildCigQueryParams();
-        window.open(`${API}/api/cig/export?${params}`, "_blank");
-    } else {
-        const params = buildQueryParams();
-        window.open(`${API}/api/export?${params}`, "_blank");
+const EXPORT_POLL_MS = 1000;
+
+// L'export gira come job in background: avanzamento sul bottone, poi download
+async function exportData() {
+    const btn = document.getElementById("btn-export");
+    const params = currentTab === "cig" ? buildCigQueryParams() : buildQueryParams();
+    params.set("dataset", currentTab === "cig" ? "cig" : "progetti");
+    params.set("format", document.getElementById("export-format").value);
+
+    btn.disabled = true;
+    try {
+        const res = await fetch(`${API}/api/exports?${params}`, { method: "POST" });
+        if (res.status === 401) {
+            window.location.href = '/login.html';
+            return;
+        }
+        let job = await res.json();
+        if (!res.ok) throw new Error(job.error || `HTTP ${res.status}`);
+
+        while (job.status === "queued" || job.status === "running") {
+            const pct = job.total ? Math.floor(100 * job.rows / job.total) : 0;
+            btn.textContent = `Esportazione ${pct}%`;
+            await new Promise(resolve => setTimeout(resolve, EXPORT_POLL_MS));
+            job = await fetchApi(`/api/exports/${job.id}`);
+            if (!job) throw new Error("Export non trovato");
+        }
+        if (job.status !== "done") throw new Error(job.error || "Export non riuscito");
+        window.location.href = `${API}${job.download_url}`;
+    } catch (err) {
+        console.error("Export Error:", err);
+        alert(`Export non riuscito: ${err.message}`);
+    } finally {
+        btn.disabled = false;
+        btn.textContent = "Esporta";
     }
 }
 
@@ -1072,7 +1227,8 @@ function bindEvents() {
     document.getElementById("btn-cig-apply").addEventListener("click", applyCigFilters);
     document.getElementById("btn-cig-reset").addEventListener("click", resetCigFilters);
 
-    document.getElementById("btn-export").addEventListener("click", exportCsv);
+    document.getElementById("btn-export").addEventListener("click", exportData);
+    bindSuggestions();
     document.getElementById("modal-close").addEventListener("click", closeDetail);
     document.getElementById("modal-overlay").addEventListener("click", (e) => {
         if (e.target === e.currentTarget) closeDetail();
@@ -1131,6 +1287,11 @@ function formatNumber(n) {
     return Number(n).toLocaleString("it-IT");
 }
 
+function formatTotal(n, capped) {
+    // Totale troncato dal backend (count=capped): "10.000+"
+    return capped ? `${formatNumber(n)}+` : formatNumber(n);
+}
+
 function formatCurrency(n) {
     if (n == null || n === "" || n === "DATO NON PRESENTE") return "-";
     const num = Number(n);
@@ -1138,6 +1299,12 @@ function formatCurrency(n) {
     return num.toLocaleString("it-IT") + " \u20AC";
 }
 
+function formatDate(s) {
+    // Le date tipizzate arrivano in ISO (AAAA-MM-GG)
+    const m = /^(\d{4})-(\d{2})-(\d{2})/.exec(s);
+    return m ? `${m[3]}/${m[2]}/${m[1]}` : s;
+}
+
 function numComp(a, b) {
     return (Number(a) || 0) - (Number(b) || 0);
 }
@@ -0,0 +1,91 @@
+"""
+Benchmark di concorrenza per /api/projects.
+Lancia N chiamate parallele e misura la latenza p50/p99 confrontando
+il pool di cursori DuckDB con un singolo cursore condiviso (pool_size=1,
+equivalente alla vecchia connessione unica).
+
+Uso: python scripts/bench_concurrency.py [--requests 200] [--workers 16] [--pool N]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from backend import main  # noqa: E402
+from backend.queries import POOL_SIZE, Database  # noqa: E402
+
+# Mix di richieste tipiche della dashboard (pagine, filtri, ricerca, ordinamento)
+QUERIES = [
+    "/api/projects?limit=50&offset=0",
+    "/api/projects?limit=50&offset=500",
+    "/api/projects?REGIONE=LAZIO&limit=50",
+    "/api/projects?q=scuola&limit=50",
+    "/api/projects?STATO_PROGETTO=ATTIVO&sort=COSTO_PROGETTO&order=DESC&limit=50",
+    "/api/projects?HAS_CIG=SI&limit=50",
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def run(client, n_requests, workers):
+    def call(i):
+        url = QUERIES[i % len(QUERIES)]
+        t0 = time.perf_counter()
+        resp = client.get(url)
+        resp.raise_for_status()
+        return (time.perf_counter() - t0) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        latencies = list(ex.map(call, range(n_requests)))
+    wall = time.perf_counter() - start
+    return latencies, wall
+
+
+def bench(pool_size, n_requests, workers):
+    main.db = Database(pool_size=pool_size)
+    try:
+        with TestClient(main.app) as client:
+            client.cookies.set(
+                main.SESSION_COOKIE, main.serializer.dumps({"nome": "bench"})
+            )
+            # Warm-up: metadati Parquet e cache del sistema operativo
+            run(client, len(QUERIES), 1)
+            latencies, wall = run(client, n_requests, workers)
+    finally:
+        main.db.close()
+
+    print(f"  pool_size={pool_size:<3} "
+          f"p50={statistics.median(latencies):8.1f} ms  "
+          f"p99={percentile(latencies, 99):8.1f} ms  "
+          f"throughput={n_requests / wall:6.1f} req/s")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--pool", type=int, default=max(POOL_SIZE, 2))
+    args = parser.parse_args()
+
+    print(f"{args.requests} richieste /api/projects, {args.workers} client paralleli")
+    print("Prima (connessione condivisa):")
+    bench(1, args.requests, args.workers)
+    print("Dopo (pool di cursori):")
+    bench(args.pool, args.requests, args.workers)
+
+
+if __name__ == "__main__":
+    main_cli()
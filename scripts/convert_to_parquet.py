@@ -2,16 +2,27 @@
 Converte i 7 file CSV OpenCUP + Localizzazione in un unico file Parquet.
 Genera anche file JSON pre-aggregati per la dashboard.
 
-Uso: python scripts/convert_to_parquet.py
+Uso: python scripts/convert_to_parquet.py [--duckdb] [--sorted] [--trigrams] [--incremental]
+           [--workers N]
+  --duckdb  crea anche data/opencup.duckdb con tabelle native, indici su CUP/CIG
+            e indici full-text (se l'estensione fts e' disponibile)
+  --sorted  Parquet ordinati per CUP/CIG con row group piccoli (lookup puntuali)
+  --trigrams  indici trigrammi in data/trigrams/ per le ricerche "contiene"
+  --incremental  legge solo le sorgenti non ancora ingerite (data/ingest/manifest.json)
+  --workers N  archivi zip letti in parallelo
 """
 
+import argparse
 import duckdb
+import hashlib
 import json
 import os
 import time
 import zipfile
 import tempfile
+import threading
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 CSV_DIR = BASE_DIR
@@ -24,32 +35,340 @@ CIG_CUP_JSON = os.path.join(CSV_DIR, "cup_json", "cup_json.json").replace(os.sep
 CIG_DETAIL_DIR = os.path.join(CSV_DIR, "cup_json").replace(os.sep, "/")
 CIG_PARQUET = os.path.join(DATA_DIR, "cig.parquet")
 AGGIUDICATARI_PARQUET = os.path.join(DATA_DIR, "aggiudicatari.parquet")
+CUBE_PARQUET = os.path.join(DATA_DIR, "aggregazioni.parquet")
+DUCKDB_FILE = os.path.join(DATA_DIR, "opencup.duckdb")
+TRIGRAM_DIR = os.path.join(DATA_DIR, "trigrams")
+
+# Ingestione incrementale: manifest delle sorgenti gia' lette e staging dei
+# dettagli ANAC deduplicati, a cui vengono accodati solo gli zip nuovi
+INGEST_DIR = os.path.join(DATA_DIR, "ingest")
+MANIFEST_FILE = os.path.join(INGEST_DIR, "manifest.json")
+STAGING_PARQUETS = {
+    "cig_det": os.path.join(INGEST_DIR, "cig_dettaglio.parquet"),
+    "aggiudicazioni": os.path.join(INGEST_DIR, "aggiudicazioni.parquet"),
+    "aggiudicatari": os.path.join(INGEST_DIR, "aggiudicatari.parquet"),
+}
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Lettura degli zip: archivi letti in parallelo e blocco di decompressione
+INGEST_WORKERS = min(4, os.cpu_count() or 1)
+ZIP_STREAM_BLOCK = 1024 * 1024
+
+# Dedup dei dettagli ANAC: tabella -> (chiave DISTINCT ON, record da tenere)
+DEDUP_RULES = {
+    # il record piu recente
+    "cig_det": ("cig", "anno_pubblicazione DESC NULLS LAST, data_pubblicazione DESC NULLS LAST"),
+    # id_aggiudicazione piu alto
+    "aggiudicazioni": ("cig", "id_aggiudicazione DESC NULLS LAST"),
+    "aggiudicatari": ("cig, codice_fiscale", "id_aggiudicazione DESC NULLS LAST"),
+}
+
+# Layout Parquet: standard oppure "sorted", con righe ordinate per chiave e
+# row group piccoli, cosi le statistiche min/max su CUP/CIG di ogni row group
+# coprono un intervallo stretto e i lookup puntuali saltano quasi tutto il file
+DEFAULT_ROW_GROUP_SIZE = 100000
+SORTED_ROW_GROUP_SIZE = 20000
+BLOOM_FILTER_FPR = 0.01
+
+# Schema tipizzato di progetti.parquet (i CSV sono letti tutti come VARCHAR):
+# importi interi, anni, date. Valori non convertibili diventano NULL
+TYPED_COLUMNS = {
+    "COSTO_PROGETTO": "BIGINT",
+    "FINANZIAMENTO_PROGETTO": "BIGINT",
+    "ANNO_DECISIONE": "SMALLINT",
+    "ANNO_DELIBERA": "SMALLINT",
+    "DATA_ULTIMA_MODIFICA_SSC": "DATE",
+    "DATA_ULTIMA_MODIFICA_UTENTE": "DATE",
+    "DATA_CHIUSURA_REVOCA": "DATE",
+    "DATA_GENERAZIONE_CUP": "DATE",
+}
+DATE_FORMATS = ["%d/%m/%Y", "%d/%m/%Y %H:%M:%S", "%Y-%m-%d", "%Y-%m-%d %H:%M:%S"]
+
+# Colonne categoriche a bassa cardinalita': ENUM nel database persistente
+# (nel Parquet ci pensa il dictionary encoding)
+ENUM_COLUMNS = [
+    "STATO_PROGETTO", "NATURA_INTERVENTO", "NATURA_DIPE", "TIPOLOGIA_INTERVENTO",
+    "AREA_INTERVENTO", "SETTORE_INTERVENTO", "SOTTOSETTORE_INTERVENTO",
+    "CATEGORIA_INTERVENTO", "TIPOLOGIA_CUP", "STRUMENTO_PROGRAMMAZIONE",
+    "AREA_GEOGRAFICA", "REGIONE", "SIGLA_PROVINCIA", "PROVINCIA", "COMUNE",
+    "CATEGORIA_SOGGETTO", "SOTTOCATEGORIA_SOGGETTO",
+    "HAS_CIG", "HAS_AGGIUDICATARI",
+]
+ENUM_MAX_VALUES = 10000
+
+# Colonne di sintesi dei CIG collegati, denormalizzate in progetti.parquet
+CIG_SUMMARY_COLUMNS = ["HAS_CIG", "HAS_AGGIUDICATARI", "N_CIG", "IMPORTO_CIG_TOTALE"]
+
+# Colonne delle aggiudicazioni riportate in cig.parquet: (sorgente, nome)
+AGGIUDICAZIONI_COLUMNS = [
+    ("importo_aggiudicazione", "importo_aggiudicazione"),
+    ("criterio_aggiudicazione", "criterio_aggiudicazione"),
+    ("ribasso_aggiudicazione", "ribasso_aggiudicazione"),
+    ("data_aggiudicazione_definitiva", "data_aggiudicazione_definitiva"),
+    ("numero_offerte_ammesse", "numero_offerte_ammesse"),
+    ("numero_offerte_escluse", "numero_offerte_escluse"),
+    ("num_imprese_offerenti", "num_imprese_offerenti"),
+    ("flag_subappalto", "flag_subappalto"),
+    ("asta_elettronica", "asta_elettronica"),
+    ("PRESTAZIONI_COMPRESE", "prestazioni_comprese"),
+    ("FLAG_PROC_ACCELERATA", "flag_proc_accelerata"),
+    ("num_imprese_invitate", "num_imprese_invitate"),
+    ("massimo_ribasso", "massimo_ribasso"),
+    ("minimo_ribasso", "minimo_ribasso"),
+]
+
+# Dimensioni del cubo di aggregazione (conteggio e somma costo per combinazione)
+CUBE_DIMENSIONS = [
+    "REGIONE", "ANNO_DECISIONE", "STATO_PROGETTO",
+    "SETTORE_INTERVENTO", "NATURA_INTERVENTO", "AREA_INTERVENTO",
+]
+
+# Indici trigrammi per le ricerche "contiene": nome -> (parquet, colonna).
+# Per ogni indice: <nome>.values.parquet (value_id, value) con i valori
+# distinti e <nome>.postings.parquet (trigram, value_ids) sul testo minuscolo
+TRIGRAM_INDEXES = {
+    "soggetto": (PARQUET_FILE, "SOGGETTO_TITOLARE"),
+    "descrizione": (PARQUET_FILE, "DESCRIZIONE_SINTETICA_CUP"),
+    "aggiudicatario": (AGGIUDICATARI_PARQUET, "denominazione"),
+    "cf_aggiudicatario": (AGGIUDICATARI_PARQUET, "codice_fiscale"),
+}
+
+# Indici full-text nel database persistente (estensione fts di DuckDB):
+# tabella -> (colonna identificativa, colonne testuali indicizzate)
+FTS_INDEXES = {
+    "progetti": ("CUP", [
+        "DESCRIZIONE_SINTETICA_CUP", "SOGGETTO_TITOLARE", "DENOMINAZIONE_BENEFICIARIO",
+    ]),
+    "cig": ("CIG", ["oggetto_gara", "amm_appaltante"]),
+}
+FTS_STOPWORDS_IT = [
+    "a", "ad", "al", "alla", "alle", "ai", "agli", "all", "c", "che", "con",
+    "d", "da", "dal", "dalla", "dalle", "dai", "dagli", "degli", "dei", "del",
+    "della", "delle", "dell", "di", "e", "ed", "gli", "i", "il", "in", "l",
+    "la", "le", "lo", "nel", "nella", "nelle", "nei", "negli", "o", "per",
+    "sul", "sulla", "sulle", "sui", "su", "tra", "fra", "un", "una", "uno",
+]
 
 os.makedirs(DATA_DIR, exist_ok=True)
 
 
-def extract_zips_by_pattern(directory, pattern_prefix, pattern_suffix=".zip"):
-    """Trova e estrae file zip che matchano un pattern. Ritorna lista di path JSON estratti."""
+def find_zips(directory, pattern_prefix, pattern_suffix=".zip", anchored=False):
+    """Zip in directory il cui nome contiene pattern_prefix (o inizia con, se anchored)."""
     native_dir = directory.replace("/", os.sep)
-    zip_files = sorted([
+    return sorted([
         os.path.join(directory, f)
         for f in os.listdir(native_dir)
-        if f.endswith(pattern_suffix) and pattern_prefix in f
+        if f.endswith(pattern_suffix)
+        and (f.startswith(pattern_prefix) if anchored else pattern_prefix in f)
     ])
-    if not zip_files:
-        return [], None
 
-    tmp_dir = tempfile.mkdtemp(prefix=f"{pattern_prefix}_extract_")
-    tmp_dir_fwd = tmp_dir.replace(os.sep, "/")
-    json_paths = []
-    for zpath in zip_files:
-        zf = zipfile.ZipFile(zpath.replace("/", os.sep))
-        inner = zf.namelist()[0]
-        zf.extract(inner, tmp_dir)
-        json_paths.append(f"{tmp_dir_fwd}/{inner}")
-        zf.close()
 
-    return json_paths, tmp_dir
+def _pipe_zip_member(zf, inner, fifo):
+    """Decomprime inner nella FIFO, a blocchi di ZIP_STREAM_BLOCK byte."""
+    try:
+        with zf.open(inner) as src, open(fifo, "wb") as dst:
+            shutil.copyfileobj(src, dst, ZIP_STREAM_BLOCK)
+    except BrokenPipeError:
+        # Il lettore ha chiuso prima della fine (errore nella query)
+        pass
+
+
+def read_zip_json(con, zpath, table):
+    """
+    Crea table con i record NDJSON del primo file dello zip. Il file viene
+    decompresso al volo in una FIFO letta da read_json: niente copia su
+    disco e in memoria solo i blocchi in transito. Dove le FIFO non esistono
+    (Windows) viene estratto in una cartella temporanea.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix=f"{table}_")
+    path = os.path.join(tmp_dir, "data.json")
+    writer = None
+    try:
+        with zipfile.ZipFile(zpath.replace("/", os.sep)) as zf:
+            inner = zf.namelist()[0]
+            if hasattr(os, "mkfifo"):
+                os.mkfifo(path)
+                writer = threading.Thread(target=_pipe_zip_member, args=(zf, inner, path))
+                writer.start()
+            else:
+                path = zf.extract(inner, tmp_dir)
+            try:
+                con.execute(f"""
+                    CREATE TABLE {table} AS
+                    SELECT *
+                    FROM read_json('{path.replace(os.sep, "/")}',
+                        format = 'newline_delimited',
+                        union_by_name = true,
+                        ignore_errors = true
+                    )
+                """)
+            finally:
+                if writer is not None:
+                    if writer.is_alive():
+                        # Sblocca il writer se la query e' fallita prima di aprire la FIFO
+                        os.close(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+                    writer.join()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_zips_parallel(con, table, zip_files, workers=INGEST_WORKERS):
+    """
+    Legge gli zip in parallelo, un cursore per archivio, nelle tabelle
+    <table>_part_<n> (tabelle normali: le temporanee sono per cursore).
+    Ritorna i nomi delle tabelle.
+    """
+    parts = [f"{table}_part_{i}" for i in range(len(zip_files))]
+
+    def read(job):
+        zpath, part = job
+        cur = con.cursor()
+        try:
+            read_zip_json(cur, zpath, part)
+        finally:
+            cur.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(read, zip(zip_files, parts)))
+    return parts
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path.replace("/", os.sep), "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class IngestManifest:
+    """
+    Sorgenti gia' ingerite per gruppo (nome -> dimensione, mtime, sha256).
+    Con enabled=False ogni gruppo viene ricostruito da zero. L'hash viene
+    ricalcolato solo se dimensione o mtime sono cambiati.
+    """
+
+    def __init__(self, path=MANIFEST_FILE, enabled=False):
+        self.path = path
+        self.enabled = enabled
+        self.entries = {}
+        self._pending = {}
+        if enabled and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def _describe(self, kind, path):
+        st = os.stat(path.replace("/", os.sep))
+        old = self.entries.get(kind, {}).get(os.path.basename(path))
+        if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+            return old
+        return {"size": st.st_size, "mtime": st.st_mtime, "sha256": file_sha256(path)}
+
+    def plan(self, kind, paths, outputs=()):
+        """
+        Ritorna (modo, sorgenti da leggere): "full" con tutte le sorgenti,
+        "append" con le sole nuove, "skip" se non ci sono sorgenti nuove.
+        Si ricostruisce da zero se il gruppo non ha ancora sorgenti ingerite,
+        se una di queste e' cambiata o sparita, o se manca uno dei file in
+        outputs (output finale e parquet di staging del gruppo).
+        """
+        if not self.enabled:
+            return "full", list(paths)
+        current = {os.path.basename(p): self._describe(kind, p) for p in paths}
+        self._pending[kind] = current
+        old = self.entries.get(kind)
+        if old == {} and not current:
+            # Ancora nessuna sorgente: niente da leggere e nessuno staging
+            return "skip", []
+        if not old or not all(os.path.exists(o) for o in outputs):
+            return "full", list(paths)
+        for name, entry in old.items():
+            if name not in current or current[name]["sha256"] != entry["sha256"]:
+                print(f"  {kind}: sorgente {name} cambiata o rimossa, ricostruzione completa")
+                return "full", list(paths)
+        new = [p for p in paths if os.path.basename(p) not in old]
+        return ("append", new) if new else ("skip", [])
+
+    def commit(self, kind):
+        """Registra come ingerite le sorgenti pianificate per kind e salva il manifest."""
+        if not self.enabled or kind not in self._pending:
+            return
+        self.entries[kind] = self._pending.pop(kind)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def load_deduplicated(con, table, zip_files, staged=None, workers=INGEST_WORKERS):
+    """
+    Crea la tabella temporanea table con i record JSON dei zip_files, uniti a
+    quelli gia' deduplicati nel parquet di staging (se indicato), tenendo un
+    record per chiave secondo DEDUP_RULES. Ritorna (record letti, record unici).
+    """
+    key, order = DEDUP_RULES[table]
+    parts = read_zips_parallel(con, table, zip_files, workers)
+    # Schema di ogni archivio inferito a parte e unito per nome, come
+    # read_json([...], union_by_name = true)
+    sources = [f"SELECT * FROM {part}" for part in parts]
+    if staged:
+        sources.append(f"SELECT * FROM '{staged.replace(os.sep, '/')}'")
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE {table}_raw AS
+        {" UNION ALL BY NAME ".join(sources)}
+    """)
+    for part in parts:
+        con.execute(f"DROP TABLE {part}")
+    raw_count = con.execute(f"SELECT COUNT(*) FROM {table}_raw").fetchone()[0]
+
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE {table} AS
+        SELECT DISTINCT ON ({key}) *
+        FROM {table}_raw
+        ORDER BY {key}, {order}
+    """)
+    dedup_count = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    con.execute(f"DROP TABLE {table}_raw")
+    return raw_count, dedup_count
+
+
+def save_staging(con, table):
+    """Salva la tabella deduplicata nel suo parquet di staging (scrittura atomica)."""
+    os.makedirs(INGEST_DIR, exist_ok=True)
+    staged = STAGING_PARQUETS[table]
+    con.execute(f"""
+        COPY {table} TO '{staged.replace(os.sep, "/")}.tmp'
+        (FORMAT PARQUET, COMPRESSION ZSTD)
+    """)
+    os.replace(staged + ".tmp", staged)
+
+
+def supports_bloom_filters(con):
+    """Verifica se questa versione di DuckDB scrive bloom filter nei Parquet (>= 1.2)."""
+    probe = os.path.join(tempfile.gettempdir(), "opencup_bloom_probe.parquet")
+    try:
+        con.execute(f"""
+            COPY (SELECT 1 AS x) TO '{probe.replace(os.sep, "/")}'
+            (FORMAT PARQUET, BLOOM_FILTER_FALSE_POSITIVE_RATIO {BLOOM_FILTER_FPR})
+        """)
+        return True
+    except duckdb.Error:
+        return False
+    finally:
+        if os.path.exists(probe):
+            os.remove(probe)
+
+
+def parquet_options(con, sorted_layout=False):
+    """Opzioni per COPY ... TO in base al layout scelto."""
+    if not sorted_layout:
+        return f"FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE {DEFAULT_ROW_GROUP_SIZE}"
+    options = f"FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE {SORTED_ROW_GROUP_SIZE}"
+    # I bloom filter vengono scritti per le colonne con dictionary encoding
+    if supports_bloom_filters(con):
+        options += f", BLOOM_FILTER_FALSE_POSITIVE_RATIO {BLOOM_FILTER_FPR}"
+    return options
 
 
 def get_csv_files():
@@ -65,12 +384,20 @@ def get_csv_files():
     return files
 
 
-def convert_csv_to_parquet(con, csv_files):
+def convert_csv_to_parquet(con, csv_files, sorted_layout=False, append=False):
+    """
+    Scrive progetti.parquet da csv_files (con Localizzazione e Soggetti),
+    con le colonne di TYPED_COLUMNS gia' convertite. Con append=True le
+    righe vengono accodate al parquet esistente (una riga per CUP, vince
+    quella nuova), convertendo solo le colonne che in quel file sono gia'
+    tipizzate.
+    """
     print("\n--- Conversione CSV -> Parquet (con Localizzazione) ---")
     start = time.time()
 
     csv_list = ", ".join(f"'{f.replace(os.sep, '/')}'" for f in csv_files)
     pq_path = PARQUET_FILE.replace(os.sep, "/")
+    tmp_path = pq_path + ".tmp"
 
     # Deduplica localizzazioni: prendi la prima per CUP
     print("  Preparazione localizzazioni (dedup per CUP)...")
@@ -111,26 +438,56 @@ def convert_csv_to_parquet(con, csv_files):
 
     # JOIN Progetti + Localizzazione + Soggetti
     print("  Join e scrittura Parquet...")
+    rows_sql = f"""
+        SELECT p.*, l.AREA_GEOGRAFICA, l.REGIONE,
+               l.SIGLA_PROVINCIA, l.PROVINCIA, l.COMUNE,
+               s.CATEGORIA_SOGGETTO, s.SOTTOCATEGORIA_SOGGETTO
+        FROM read_csv(
+            [{csv_list}],
+            delim = ';', header = true, quote = '"',
+            all_varchar = true, ignore_errors = true,
+            filename = false
+        ) p
+        LEFT JOIN loc l ON p.CUP = l.LOC_CUP
+        LEFT JOIN sogg s ON p.PIVA_CODFISCALE_SOG_TITOLARE = s.SOGG_PIVA
+    """
+    # Conversione dei tipi nella stessa COPY: niente passata in piu' di
+    # apply_typed_schema su tutto il file
+    if append:
+        schema = {
+            r[0]: r[1] for r in con.execute(f"DESCRIBE SELECT * FROM '{pq_path}'").fetchall()
+        }
+        todo = [c for c in TYPED_COLUMNS if schema.get(c, "VARCHAR") != "VARCHAR"]
+    else:
+        csv_cols = {r[0] for r in con.execute(f"DESCRIBE {rows_sql}").fetchall()}
+        todo = [c for c in TYPED_COLUMNS if c in csv_cols]
+    typed = [f'{typed_column_sql(col, TYPED_COLUMNS[col])} AS "{col}"' for col in todo]
+    if typed:
+        rows_sql = f"SELECT * REPLACE ({', '.join(typed)}) FROM ({rows_sql})"
+    if append:
+        # Un CUP gia' presente (CSV ripubblicato o sovrapposto) resta una
+        # riga sola: vince quella dei CSV nuovi
+        rows_sql = f"""
+            SELECT DISTINCT ON (CUP) * EXCLUDE (_new)
+            FROM (
+                SELECT *, false AS _new FROM '{pq_path}'
+                UNION ALL BY NAME
+                SELECT *, true AS _new FROM ({rows_sql})
+            )
+            ORDER BY CUP, _new DESC
+        """
     con.execute(f"""
         COPY (
-            SELECT p.*, l.AREA_GEOGRAFICA, l.REGIONE,
-                   l.SIGLA_PROVINCIA, l.PROVINCIA, l.COMUNE,
-                   s.CATEGORIA_SOGGETTO, s.SOTTOCATEGORIA_SOGGETTO
-            FROM read_csv(
-                [{csv_list}],
-                delim = ';', header = true, quote = '"',
-                all_varchar = true, ignore_errors = true,
-                filename = false
-            ) p
-            LEFT JOIN loc l ON p.CUP = l.LOC_CUP
-            LEFT JOIN sogg s ON p.PIVA_CODFISCALE_SOG_TITOLARE = s.SOGG_PIVA
-        ) TO '{pq_path}'
-        (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 100000)
+            SELECT * FROM ({rows_sql})
+            {"ORDER BY CUP" if sorted_layout else ""}
+        ) TO '{tmp_path}'
+        ({parquet_options(con, sorted_layout)})
     """)
+    os.replace(tmp_path.replace("/", os.sep), PARQUET_FILE)
 
     elapsed = time.time() - start
     size_gb = os.path.getsize(PARQUET_FILE) / (1024**3)
-    print(f"  Parquet creato: {PARQUET_FILE}")
+    print(f"  Parquet {'aggiornato' if append else 'creato'}: {PARQUET_FILE}")
     print(f"  Dimensione: {size_gb:.2f} GB")
     print(f"  Tempo: {elapsed:.1f}s")
 
@@ -165,108 +522,123 @@ def generate_stats(con):
     print(f"  Tempo: {elapsed:.1f}s")
 
 
-def load_aggiudicazioni(con, detail_dir):
-    """Carica e deduplica i dati aggiudicazioni da zip in cup_json/."""
+def aggiudicazioni_select(alias):
+    """Colonne di AGGIUDICAZIONI_COLUMNS dalla tabella aggiudicazioni (alias)."""
+    return ",\n".join(
+        f"{alias}.{src} as {name}" if src != name else f"{alias}.{src}"
+        for src, name in AGGIUDICAZIONI_COLUMNS
+    )
+
+
+def load_aggiudicazioni(con, zip_files, staged=None, workers=INGEST_WORKERS):
+    """Carica e deduplica nella tabella temporanea aggiudicazioni i dati da zip_files (+ staging)."""
     print("\n  --- Caricamento Aggiudicazioni ---")
-    json_paths, tmp_dir = extract_zips_by_pattern(detail_dir, "-aggiudicazioni_json")
-    if not json_paths:
+    if not zip_files and not staged:
         print("  Nessun file aggiudicazioni trovato")
         return False
 
-    print(f"  Estratti {len(json_paths)} file JSON aggiudicazioni")
-
-    json_list = ", ".join(f"'{p}'" for p in json_paths)
-    con.execute(f"""
-        CREATE OR REPLACE TEMP TABLE agg_raw AS
-        SELECT *
-        FROM read_json([{json_list}],
-            format = 'newline_delimited',
-            union_by_name = true,
-            ignore_errors = true
-        )
-    """)
-    raw_count = con.execute("SELECT COUNT(*) FROM agg_raw").fetchone()[0]
+    print(f"  File aggiudicazioni da leggere: {len(zip_files)}")
+    raw_count, dedup_count = load_deduplicated(
+        con, "aggiudicazioni", zip_files, staged, workers
+    )
     print(f"  Aggiudicazioni totali (con duplicati): {raw_count:,}")
-
-    # Dedup per CIG: tieni il record con id_aggiudicazione piu alto
-    con.execute("""
-        CREATE OR REPLACE TEMP TABLE aggiudicazioni AS
-        SELECT DISTINCT ON (cig) *
-        FROM agg_raw
-        ORDER BY cig, id_aggiudicazione DESC NULLS LAST
-    """)
-    dedup_count = con.execute("SELECT COUNT(*) FROM aggiudicazioni").fetchone()[0]
     print(f"  Aggiudicazioni uniche per CIG: {dedup_count:,}")
-
-    con.execute("DROP TABLE agg_raw")
-    if tmp_dir:
-        shutil.rmtree(tmp_dir, ignore_errors=True)
     return True
 
 
-def convert_cig_to_parquet(con):
-    """Converte la mappatura CIG-CUP + dettagli CIG + aggiudicazioni in un Parquet."""
+def staged_input(table, mode):
+    """
+    Parquet di staging da unire alle sorgenti nuove: None se si ricostruisce
+    da zero o se il gruppo non ha sorgenti (plan lo garantisce negli altri casi).
+    """
+    staged = STAGING_PARQUETS[table]
+    if mode == "full" or not os.path.exists(staged):
+        return None
+    return staged
+
+
+def convert_cig_to_parquet(con, sorted_layout=False, manifest=None, workers=INGEST_WORKERS):
+    """
+    Converte la mappatura CIG-CUP + dettagli CIG + aggiudicazioni in un Parquet.
+    Ritorna True se cig.parquet e' stato riscritto.
+    """
     print("\n--- Conversione CIG -> Parquet ---")
     start = time.time()
+    manifest = manifest or IngestManifest()
+
+    pq_options = parquet_options(con, sorted_layout)
 
     cig_cup_path = CIG_CUP_JSON.replace(os.sep, "/")
     cig_pq = CIG_PARQUET.replace(os.sep, "/")
+    tmp_path = cig_pq + ".tmp"
     detail_dir = CIG_DETAIL_DIR.replace(os.sep, "/")
 
     has_mapping = os.path.exists(CIG_CUP_JSON.replace("/", os.sep))
     has_existing_pq = os.path.exists(CIG_PARQUET)
 
+    agg_zips = find_zips(detail_dir, "-aggiudicazioni_json")
+    agg_mode, agg_new = manifest.plan(
+        "aggiudicazioni", agg_zips, [CIG_PARQUET, STAGING_PARQUETS["aggiudicazioni"]]
+    )
+
     # Se mancano i file sorgente originali ma esiste il parquet, arricchisci con aggiudicazioni
     if not has_mapping and has_existing_pq:
         print("  Mappatura CIG-CUP non trovata, uso cig.parquet esistente come base")
-        has_agg = load_aggiudicazioni(con, detail_dir)
+        if agg_mode == "skip":
+            print("  Nessuna aggiudicazione nuova, skip")
+            return False
+        has_agg = load_aggiudicazioni(
+            con, agg_new, staged_input("aggiudicazioni", agg_mode), workers
+        )
         if not has_agg:
             print("  Nessuna aggiudicazione da aggiungere, skip")
-            return
+            return False
 
-        # Backup e ricostruisci con JOIN aggiudicazioni
-        backup_pq = cig_pq.replace(".parquet", "_backup.parquet")
-        import shutil as sh
-        sh.copy2(CIG_PARQUET, CIG_PARQUET.replace(".parquet", "_backup.parquet"))
+        # Le colonne di un arricchimento precedente vengono ricalcolate
+        existing = {
+            r[0] for r in con.execute(f"DESCRIBE SELECT * FROM '{cig_pq}'").fetchall()
+        }
+        drop = [name for _, name in AGGIUDICAZIONI_COLUMNS if name in existing]
+        exclude_sql = f"EXCLUDE ({', '.join(drop)})" if drop else ""
 
         print("  Join CIG esistente + aggiudicazioni...")
         con.execute(f"""
             COPY (
                 SELECT
-                    c.*,
-                    a.importo_aggiudicazione,
-                    a.criterio_aggiudicazione,
-                    a.ribasso_aggiudicazione,
-                    a.data_aggiudicazione_definitiva,
-                    a.numero_offerte_ammesse,
-                    a.numero_offerte_escluse,
-                    a.num_imprese_offerenti,
-                    a.flag_subappalto,
-                    a.asta_elettronica,
-                    a.PRESTAZIONI_COMPRESE as prestazioni_comprese,
-                    a.FLAG_PROC_ACCELERATA as flag_proc_accelerata,
-                    a.num_imprese_invitate,
-                    a.massimo_ribasso,
-                    a.minimo_ribasso
-                FROM '{backup_pq}' c
+                    c.* {exclude_sql},
+                    {aggiudicazioni_select("a")}
+                FROM '{cig_pq}' c
                 LEFT JOIN aggiudicazioni a ON c.CIG = a.cig
-            ) TO '{cig_pq}'
-            (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 100000)
+                {"ORDER BY c.CUP, c.CIG" if sorted_layout else ""}
+            ) TO '{tmp_path}'
+            ({pq_options})
         """)
-
-        # Rimuovi backup
-        os.remove(CIG_PARQUET.replace(".parquet", "_backup.parquet"))
+        os.replace(tmp_path.replace("/", os.sep), CIG_PARQUET)
+        if manifest.enabled:
+            save_staging(con, "aggiudicazioni")
+        manifest.commit("aggiudicazioni")
 
         elapsed = time.time() - start
         size_mb = os.path.getsize(CIG_PARQUET) / (1024**2)
         print(f"  CIG Parquet aggiornato: {CIG_PARQUET}")
         print(f"  Dimensione: {size_mb:.1f} MB")
         print(f"  Tempo: {elapsed:.1f}s")
-        return
+        return True
 
     if not has_mapping:
         print("  Mappatura CIG-CUP non trovata e nessun parquet esistente, skip")
-        return
+        return False
+
+    # Trova tutti i file zip CIG
+    det_zips = find_zips(detail_dir, "cig_json_", anchored=True)
+    print(f"  Trovati {len(det_zips)} file zip CIG dettaglio")
+    map_mode, _ = manifest.plan("cig_cup", [CIG_CUP_JSON], [CIG_PARQUET])
+    det_mode, det_new = manifest.plan(
+        "cig_det", det_zips, [CIG_PARQUET, STAGING_PARQUETS["cig_det"]]
+    )
+    if map_mode == det_mode == agg_mode == "skip":
+        print("  Nessuna sorgente CIG nuova, skip")
+        return False
 
     # Percorso completo da sorgenti originali
     print("  Caricamento mappatura CIG-CUP...")
@@ -281,85 +653,27 @@ def convert_cig_to_parquet(con):
     mapping_count = con.execute("SELECT COUNT(*) FROM cig_cup").fetchone()[0]
     print(f"  Mappature CIG-CUP: {mapping_count:,}")
 
-    # Trova tutti i file zip CIG
-    zip_files = sorted([
-        os.path.join(detail_dir, f)
-        for f in os.listdir(detail_dir.replace("/", os.sep))
-        if f.startswith("cig_json_") and f.endswith(".zip")
-    ])
-    print(f"  Trovati {len(zip_files)} file zip CIG dettaglio")
-
-    has_detail = False
-    if zip_files:
-        # Estrai tutti i JSON in una cartella temporanea
-        tmp_dir = tempfile.mkdtemp(prefix="cig_extract_")
-        tmp_dir_fwd = tmp_dir.replace(os.sep, "/")
-        print(f"  Estrazione zip in cartella temporanea...")
-
-        json_paths = []
-        for zpath in zip_files:
-            zf = zipfile.ZipFile(zpath.replace("/", os.sep))
-            inner = zf.namelist()[0]
-            zf.extract(inner, tmp_dir)
-            json_paths.append(f"{tmp_dir_fwd}/{inner}")
-            zf.close()
-
-        print(f"  Estratti {len(json_paths)} file JSON")
-
-        # Carica tutti i dettagli con UNION ALL
-        json_list = ", ".join(f"'{p}'" for p in json_paths)
-        print("  Caricamento dettagli CIG (tutti i mesi)...")
-        con.execute(f"""
-            CREATE OR REPLACE TEMP TABLE cig_det_raw AS
-            SELECT *
-            FROM read_json([{json_list}],
-                format = 'newline_delimited',
-                union_by_name = true,
-                ignore_errors = true
-            )
-        """)
-        raw_count = con.execute("SELECT COUNT(*) FROM cig_det_raw").fetchone()[0]
+    has_detail = bool(det_zips)
+    if has_detail:
+        # Dettagli dei mesi nuovi (tutti, se si ricostruisce) + staging deduplicato
+        print(f"  Caricamento dettagli CIG ({len(det_new)} file zip da leggere)...")
+        raw_count, det_count = load_deduplicated(
+            con, "cig_det", det_new, staged_input("cig_det", det_mode), workers
+        )
         print(f"  Record CIG totali (con duplicati): {raw_count:,}")
-
-        # Dedup per CIG: tieni il record piu recente (anno_pubblicazione DESC, data_pubblicazione DESC)
-        print("  Deduplicazione per CIG...")
-        con.execute("""
-            CREATE OR REPLACE TEMP TABLE cig_det AS
-            SELECT DISTINCT ON (cig) *
-            FROM cig_det_raw
-            ORDER BY cig, anno_pubblicazione DESC NULLS LAST, data_pubblicazione DESC NULLS LAST
-        """)
-        det_count = con.execute("SELECT COUNT(*) FROM cig_det").fetchone()[0]
         print(f"  CIG unici con dettaglio: {det_count:,}")
 
-        # Pulizia temp
-        con.execute("DROP TABLE cig_det_raw")
-        shutil.rmtree(tmp_dir, ignore_errors=True)
-        has_detail = True
-
     # Carica aggiudicazioni (se disponibili)
-    has_agg = load_aggiudicazioni(con, detail_dir)
+    has_agg = load_aggiudicazioni(
+        con, agg_new, staged_input("aggiudicazioni", agg_mode), workers
+    )
 
     # Join mappatura + dettagli + aggiudicazioni
     if has_detail:
         agg_cols = ""
         agg_join = ""
         if has_agg:
-            agg_cols = """,
-                    a.importo_aggiudicazione,
-                    a.criterio_aggiudicazione,
-                    a.ribasso_aggiudicazione,
-                    a.data_aggiudicazione_definitiva,
-                    a.numero_offerte_ammesse,
-                    a.numero_offerte_escluse,
-                    a.num_imprese_offerenti,
-                    a.flag_subappalto,
-                    a.asta_elettronica,
-                    a.PRESTAZIONI_COMPRESE as prestazioni_comprese,
-                    a.FLAG_PROC_ACCELERATA as flag_proc_accelerata,
-                    a.num_imprese_invitate,
-                    a.massimo_ribasso,
-                    a.minimo_ribasso"""
+            agg_cols = ",\n" + aggiudicazioni_select("a")
             agg_join = "LEFT JOIN aggiudicazioni a ON m.CIG = a.cig"
 
         print("  Join e scrittura Parquet CIG...")
@@ -395,59 +709,70 @@ def convert_cig_to_parquet(con):
                 FROM cig_cup m
                 LEFT JOIN cig_det d ON m.CIG = d.cig
                 {agg_join}
-            ) TO '{cig_pq}'
-            (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 100000)
+                {"ORDER BY m.CUP, m.CIG" if sorted_layout else ""}
+            ) TO '{tmp_path}'
+            ({pq_options})
         """)
     else:
         print("  Nessun file zip CIG trovato, solo mappatura...")
         con.execute(f"""
-            COPY (SELECT * FROM cig_cup) TO '{cig_pq}'
-            (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 100000)
+            COPY (
+                SELECT * FROM cig_cup
+                {"ORDER BY CUP, CIG" if sorted_layout else ""}
+            ) TO '{tmp_path}'
+            ({pq_options})
         """)
+    os.replace(tmp_path.replace("/", os.sep), CIG_PARQUET)
+
+    # Lo staging si aggiorna dopo l'output: rileggere gli stessi zip e' idempotente
+    if manifest.enabled:
+        if has_detail:
+            save_staging(con, "cig_det")
+        if has_agg:
+            save_staging(con, "aggiudicazioni")
+    for kind in ("cig_cup", "cig_det", "aggiudicazioni"):
+        manifest.commit(kind)
 
     elapsed = time.time() - start
     size_mb = os.path.getsize(CIG_PARQUET) / (1024**2)
     print(f"  CIG Parquet creato: {CIG_PARQUET}")
     print(f"  Dimensione: {size_mb:.1f} MB")
     print(f"  Tempo: {elapsed:.1f}s")
+    return True
 
 
-def convert_aggiudicatari_to_parquet(con):
-    """Converte i file aggiudicatari da zip JSON in Parquet."""
+def convert_aggiudicatari_to_parquet(con, sorted_layout=False, manifest=None,
+                                     workers=INGEST_WORKERS):
+    """
+    Converte i file aggiudicatari da zip JSON in Parquet.
+    Ritorna True se aggiudicatari.parquet e' stato riscritto.
+    """
     print("\n--- Conversione Aggiudicatari -> Parquet ---")
     start = time.time()
+    manifest = manifest or IngestManifest()
 
     detail_dir = CIG_DETAIL_DIR.replace(os.sep, "/")
     agg_pq = AGGIUDICATARI_PARQUET.replace(os.sep, "/")
-
-    json_paths, tmp_dir = extract_zips_by_pattern(detail_dir, "-aggiudicatari_json")
-    if not json_paths:
+    tmp_path = agg_pq + ".tmp"
+
+    zip_files = find_zips(detail_dir, "-aggiudicatari_json")
+    mode, new_zips = manifest.plan(
+        "aggiudicatari", zip_files, [AGGIUDICATARI_PARQUET, STAGING_PARQUETS["aggiudicatari"]]
+    )
+    if mode == "skip":
+        print("  Nessun file aggiudicatari nuovo, skip")
+        return False
+    if not zip_files:
         print("  Nessun file aggiudicatari trovato, skip")
-        return
-
-    print(f"  Estratti {len(json_paths)} file JSON aggiudicatari")
-
-    json_list = ", ".join(f"'{p}'" for p in json_paths)
-    con.execute(f"""
-        CREATE OR REPLACE TEMP TABLE aggt_raw AS
-        SELECT *
-        FROM read_json([{json_list}],
-            format = 'newline_delimited',
-            union_by_name = true,
-            ignore_errors = true
-        )
-    """)
-    raw_count = con.execute("SELECT COUNT(*) FROM aggt_raw").fetchone()[0]
-    print(f"  Aggiudicatari totali (con duplicati): {raw_count:,}")
+        manifest.commit("aggiudicatari")
+        return False
 
+    print(f"  File aggiudicatari da leggere: {len(new_zips)}")
     # Dedup per (CIG + codice_fiscale): tieni il record con id_aggiudicazione piu alto
-    con.execute("""
-        CREATE OR REPLACE TEMP TABLE aggt_dedup AS
-        SELECT DISTINCT ON (cig, codice_fiscale) *
-        FROM aggt_raw
-        ORDER BY cig, codice_fiscale, id_aggiudicazione DESC NULLS LAST
-    """)
-    dedup_count = con.execute("SELECT COUNT(*) FROM aggt_dedup").fetchone()[0]
+    raw_count, dedup_count = load_deduplicated(
+        con, "aggiudicatari", new_zips, staged_input("aggiudicatari", mode), workers
+    )
+    print(f"  Aggiudicatari totali (con duplicati): {raw_count:,}")
     print(f"  Aggiudicatari unici (CIG + CF): {dedup_count:,}")
 
     con.execute(f"""
@@ -459,36 +784,475 @@ def convert_aggiudicatari_to_parquet(con):
                 ruolo,
                 tipo_soggetto,
                 id_aggiudicazione
-            FROM aggt_dedup
+            FROM aggiudicatari
             ORDER BY cig, ruolo NULLS LAST, denominazione
-        ) TO '{agg_pq}'
-        (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 100000)
+        ) TO '{tmp_path}'
+        ({parquet_options(con, sorted_layout)})
     """)
-
-    con.execute("DROP TABLE aggt_raw")
-    con.execute("DROP TABLE aggt_dedup")
-    if tmp_dir:
-        shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.replace(tmp_path.replace("/", os.sep), AGGIUDICATARI_PARQUET)
+    if manifest.enabled:
+        save_staging(con, "aggiudicatari")
+    manifest.commit("aggiudicatari")
+    con.execute("DROP TABLE aggiudicatari")
 
     elapsed = time.time() - start
     size_mb = os.path.getsize(AGGIUDICATARI_PARQUET) / (1024**2)
     print(f"  Aggiudicatari Parquet creato: {AGGIUDICATARI_PARQUET}")
     print(f"  Dimensione: {size_mb:.1f} MB")
     print(f"  Tempo: {elapsed:.1f}s")
+    return True
+
+
+def typed_column_sql(col, type_):
+    """Espressione di conversione VARCHAR -> tipo per una colonna di progetti."""
+    value = f'NULLIF(TRIM("{col}"), \'\')'
+    if type_ == "DATE":
+        formats = ", ".join(f"'{f}'" for f in DATE_FORMATS)
+        return f"TRY_STRPTIME({value}, [{formats}])::DATE"
+    return f"TRY_CAST({value} AS {type_})"
+
+
+def apply_typed_schema(con, sorted_layout=False):
+    """
+    Converte in progetti.parquet importi, anni e date dai VARCHAR del CSV ai
+    tipi nativi: le query non devono piu' fare TRY_CAST e le statistiche
+    min/max dei row group valgono anche per i filtri su range. I file scritti
+    da convert_csv_to_parquet sono gia' tipizzati: resta come migrazione dei
+    parquet VARCHAR esistenti.
+    """
+    if not os.path.exists(PARQUET_FILE):
+        return
+    pq_path = PARQUET_FILE.replace(os.sep, "/")
+    schema = {
+        r[0]: r[1] for r in con.execute(f"DESCRIBE SELECT * FROM '{pq_path}'").fetchall()
+    }
+    todo = {
+        col: type_ for col, type_ in TYPED_COLUMNS.items()
+        if schema.get(col) == "VARCHAR"
+    }
+    if not todo:
+        return
+
+    print("\n--- Schema tipizzato progetti.parquet ---")
+    start = time.time()
+    replace_sql = ", ".join(
+        f'{typed_column_sql(col, type_)} AS "{col}"' for col, type_ in todo.items()
+    )
+    tmp_path = pq_path + ".tmp"
+    con.execute(f"""
+        COPY (
+            SELECT * REPLACE ({replace_sql})
+            FROM '{pq_path}'
+            {"ORDER BY CUP" if sorted_layout else ""}
+        ) TO '{tmp_path}'
+        ({parquet_options(con, sorted_layout)})
+    """)
+    os.replace(tmp_path.replace("/", os.sep), PARQUET_FILE)
+    for col, type_ in todo.items():
+        print(f"  {col}: {type_}")
+    print(f"  Tempo: {time.time() - start:.1f}s")
+
+
+def add_cig_summary_columns(con, sorted_layout=False):
+    """
+    Denormalizza in progetti.parquet la sintesi dei CIG collegati a ogni CUP:
+    HAS_CIG e HAS_AGGIUDICATARI (SI/NO), N_CIG, IMPORTO_CIG_TOTALE (somma
+    degli importi dei lotti). I filtri relativi diventano predicati di colonna.
+    """
+    if not os.path.exists(PARQUET_FILE) or not os.path.exists(CIG_PARQUET):
+        print("  progetti.parquet o cig.parquet mancante, skip colonne di sintesi CIG")
+        return
+
+    print("\n--- Colonne di sintesi CIG in progetti.parquet ---")
+    start = time.time()
+    pq_path = PARQUET_FILE.replace(os.sep, "/")
+    cig_pq = CIG_PARQUET.replace(os.sep, "/")
+    tmp_path = pq_path + ".tmp"
+
+    # Riesecuzione su un parquet che ha gia' le colonne: le ricalcolo
+    existing = {
+        r[0] for r in con.execute(f"DESCRIBE SELECT * FROM '{pq_path}'").fetchall()
+    }
+    drop = [c for c in CIG_SUMMARY_COLUMNS if c in existing]
+    exclude_sql = f"EXCLUDE ({', '.join(drop)})" if drop else ""
+
+    if os.path.exists(AGGIUDICATARI_PARQUET):
+        agg_pq = AGGIUDICATARI_PARQUET.replace(os.sep, "/")
+        agg_sql = f"c.CIG IN (SELECT CIG FROM '{agg_pq}')"
+    else:
+        agg_sql = "FALSE"
+
+    # Senza dettagli CIG (solo mappatura CIG-CUP) l'importo non e' disponibile
+    cig_cols = {
+        r[0] for r in con.execute(f"DESCRIBE SELECT * FROM '{cig_pq}'").fetchall()
+    }
+    importo_sql = "importo_lotto" if "importo_lotto" in cig_cols else "NULL::DOUBLE AS importo_lotto"
+
+    order_sql = "ORDER BY p.CUP" if sorted_layout else ""
+    con.execute(f"""
+        COPY (
+            WITH cig_cup AS (
+                SELECT c.CUP,
+                       COUNT(*) AS n_cig,
+                       SUM(c.importo_lotto) AS importo,
+                       bool_or({agg_sql}) AS con_agg
+                FROM (
+                    SELECT DISTINCT ON (CUP, CIG) CUP, CIG, {importo_sql}
+                    FROM '{cig_pq}'
+                    WHERE CUP IS NOT NULL
+                ) c
+                GROUP BY c.CUP
+            )
+            SELECT p.* {exclude_sql},
+                   CASE WHEN s.CUP IS NULL THEN 'NO' ELSE 'SI' END AS HAS_CIG,
+                   CASE WHEN s.con_agg THEN 'SI' ELSE 'NO' END AS HAS_AGGIUDICATARI,
+                   COALESCE(s.n_cig, 0)::INTEGER AS N_CIG,
+                   s.importo AS IMPORTO_CIG_TOTALE
+            FROM '{pq_path}' p
+            LEFT JOIN cig_cup s ON p.CUP = s.CUP
+            {order_sql}
+        ) TO '{tmp_path}'
+        ({parquet_options(con, sorted_layout)})
+    """)
+    os.replace(tmp_path.replace("/", os.sep), PARQUET_FILE)
+
+    r = con.execute(f"""
+        SELECT COUNT(*) FILTER (WHERE HAS_CIG = 'SI'),
+               COUNT(*) FILTER (WHERE HAS_AGGIUDICATARI = 'SI')
+        FROM '{pq_path}'
+    """).fetchone()
+    print(f"  CUP con CIG: {r[0]:,} | con aggiudicatari: {r[1]:,} "
+          f"({time.time() - start:.1f}s)")
+
+
+def cube_sql(source, schema):
+    """SELECT del cubo di aggregazione su source (schema: colonna -> tipo)."""
+    dims = ", ".join(f'"{c}"' for c in CUBE_DIMENSIONS)
+    if schema.get("COSTO_PROGETTO", "VARCHAR") == "VARCHAR":
+        costo = 'TRY_CAST("COSTO_PROGETTO" AS BIGINT)'
+    else:
+        costo = '"COSTO_PROGETTO"'
+    # Somma in BIGINT: una colonna HUGEINT rallenta la riaggregazione
+    return f"""
+        SELECT {dims}, COUNT(*) AS n, SUM({costo})::BIGINT AS costo
+        FROM {source}
+        GROUP BY {dims}
+        ORDER BY {dims}
+    """
+
+
+def build_aggregation_cube(con):
+    """
+    Pre-aggrega progetti sulle dimensioni di CUBE_DIMENSIONS in
+    aggregazioni.parquet: le aggregazioni con soli filtri su queste
+    dimensioni non scansionano piu' progetti.
+    """
+    if not os.path.exists(PARQUET_FILE):
+        return
+    print("\n--- Cubo di aggregazione ---")
+    start = time.time()
+    pq_path = PARQUET_FILE.replace(os.sep, "/")
+    cube_path = CUBE_PARQUET.replace(os.sep, "/")
+    schema = {
+        r[0]: r[1] for r in con.execute(f"DESCRIBE SELECT * FROM '{pq_path}'").fetchall()
+    }
+    missing = [c for c in CUBE_DIMENSIONS if c not in schema]
+    if missing:
+        print(f"  Colonne mancanti ({', '.join(missing)}), skip cubo")
+        return
+    con.execute(f"""
+        COPY ({cube_sql(f"'{pq_path}'", schema)})
+        TO '{cube_path}.tmp' (FORMAT PARQUET, COMPRESSION ZSTD)
+    """)
+    os.replace(CUBE_PARQUET + ".tmp", CUBE_PARQUET)
+    n = con.execute(f"SELECT COUNT(*) FROM '{cube_path}'").fetchone()[0]
+    print(f"  {n:,} combinazioni ({time.time() - start:.1f}s)")
+
+
+def verify_point_lookups(con, pq_file, column, sample=20):
+    """Stima quanti row group legge un campione di lookup puntuali su una colonna."""
+    if not os.path.exists(pq_file):
+        return
+    pq = pq_file.replace(os.sep, "/")
+    total_rg = con.execute(f"""
+        SELECT COUNT(DISTINCT row_group_id) FROM parquet_metadata('{pq}')
+    """).fetchone()[0]
+    keys = [r[0] for r in con.execute(f"""
+        SELECT "{column}" FROM '{pq}'
+        WHERE "{column}" IS NOT NULL
+        USING SAMPLE {sample} ROWS
+    """).fetchall()]
+    if not keys or not total_rg:
+        return
+
+    has_bloom_probe = con.execute("""
+        SELECT COUNT(*) FROM duckdb_functions()
+        WHERE function_name = 'parquet_bloom_probe'
+    """).fetchone()[0] > 0
+
+    read = []
+    for key in keys:
+        # Row group non esclusi dalle statistiche min/max
+        candidates = {r[0] for r in con.execute(f"""
+            SELECT row_group_id FROM parquet_metadata('{pq}')
+            WHERE path_in_schema = ? AND stats_min <= ? AND stats_max >= ?
+        """, [column, key, key]).fetchall()}
+        # ...ne dai bloom filter, se DuckDB sa interrogarli
+        if has_bloom_probe and candidates:
+            excluded = {r[0] for r in con.execute(f"""
+                SELECT row_group_id FROM parquet_bloom_probe('{pq}', '{column}', ?)
+                WHERE bloom_filter_excludes
+            """, [key]).fetchall()}
+            candidates -= excluded
+        read.append(len(candidates))
+
+    avg = sum(read) / len(read)
+    print(f"  {os.path.basename(pq_file)} [{column}]: {len(keys)} lookup, "
+          f"row group letti media {avg:.1f} / max {max(read)} su {total_rg} "
+          f"({avg / total_rg:.1%})")
+
+
+def build_trigram_indexes(con):
+    """Costruisce le posting list dei trigrammi sui valori distinti delle colonne testuali."""
+    print("\n--- Indici trigrammi ---")
+    os.makedirs(TRIGRAM_DIR, exist_ok=True)
+    for name, (pq_file, col) in TRIGRAM_INDEXES.items():
+        if not os.path.exists(pq_file):
+            print(f"  {os.path.basename(pq_file)} non trovato, skip indice {name}")
+            continue
+        start = time.time()
+        pq = pq_file.replace(os.sep, "/")
+        con.execute(f"""
+            CREATE OR REPLACE TEMP TABLE trigram_values AS
+            SELECT (ROW_NUMBER() OVER (ORDER BY value) - 1)::INTEGER AS value_id, value
+            FROM (
+                SELECT DISTINCT "{col}" AS value FROM '{pq}'
+                WHERE "{col}" IS NOT NULL AND "{col}" != ''
+            )
+        """)
+        base = os.path.join(TRIGRAM_DIR, name).replace(os.sep, "/")
+        # Scrittura su .tmp e rename: il backend ricarica gli indici quando
+        # cambia la cartella e non legge mai file a meta'
+        con.execute(f"""
+            COPY (SELECT value_id, value FROM trigram_values ORDER BY value_id)
+            TO '{base}.values.parquet.tmp' (FORMAT PARQUET, COMPRESSION ZSTD)
+        """)
+        con.execute(f"""
+            COPY (
+                SELECT trigram, list(value_id ORDER BY value_id) AS value_ids
+                FROM (
+                    SELECT DISTINCT substr(l, i, 3) AS trigram, value_id
+                    FROM (
+                        SELECT value_id, lower(value) AS l,
+                               unnest(range(1, length(value) - 1)) AS i
+                        FROM trigram_values
+                    )
+                )
+                GROUP BY trigram
+                ORDER BY trigram
+            ) TO '{base}.postings.parquet.tmp' (FORMAT PARQUET, COMPRESSION ZSTD)
+        """)
+        n_values, n_trigrams = con.execute(f"""
+            SELECT (SELECT COUNT(*) FROM trigram_values),
+                   (SELECT COUNT(*) FROM read_parquet('{base}.postings.parquet.tmp'))
+        """).fetchone()
+        for kind in ("values", "postings"):
+            path = os.path.join(TRIGRAM_DIR, f"{name}.{kind}.parquet")
+            os.replace(path + ".tmp", path)
+        print(f"  {name} ({col}): {n_values:,} valori, {n_trigrams:,} trigrammi "
+              f"({time.time() - start:.1f}s)")
+    con.execute("DROP TABLE IF EXISTS trigram_values")
+
+
+def build_fts_indexes(dcon):
+    """
+    Crea gli indici full-text (BM25, stemming italiano, accenti rimossi)
+    per la ricerca libera. Senza estensione fts il backend usa LIKE.
+    """
+    try:
+        dcon.execute("INSTALL fts")
+        dcon.execute("LOAD fts")
+    except duckdb.Error as e:
+        print(f"  Estensione fts non disponibile, indici full-text non creati: {e}")
+        return
+
+    dcon.execute("CREATE TABLE fts_stopwords_it (sw VARCHAR)")
+    dcon.executemany(
+        "INSERT INTO fts_stopwords_it VALUES (?)", [[w] for w in FTS_STOPWORDS_IT]
+    )
+    tables = {r[0] for r in dcon.execute("SHOW TABLES").fetchall()}
+    for table, (id_col, text_cols) in FTS_INDEXES.items():
+        if table not in tables:
+            continue
+        start = time.time()
+        cols = ", ".join(f"'{c}'" for c in text_cols)
+        dcon.execute(f"""
+            PRAGMA create_fts_index(
+                '{table}', '{id_col}', {cols},
+                stemmer = 'italian', stopwords = 'fts_stopwords_it',
+                ignore = '(\\.|[^a-z0-9])+', strip_accents = 1, lower = 1,
+                overwrite = 1
+            )
+        """)
+        print(f"  Indice full-text {table}: {', '.join(text_cols)} "
+              f"({time.time() - start:.1f}s)")
+
+
+def create_enum_types(dcon, pq):
+    """
+    Crea un tipo ENUM (valori in ordine alfabetico) per ogni colonna
+    categorica di progetti sotto ENUM_MAX_VALUES valori distinti.
+    Ritorna {colonna: nome tipo}.
+    """
+    schema = {
+        r[0]: r[1] for r in dcon.execute(f"DESCRIBE SELECT * FROM '{pq}'").fetchall()
+    }
+    enums = {}
+    for col in ENUM_COLUMNS:
+        if schema.get(col) != "VARCHAR":
+            continue
+        n = dcon.execute(f"""
+            SELECT COUNT(DISTINCT "{col}") FROM '{pq}' WHERE "{col}" != ''
+        """).fetchone()[0]
+        if not n or n > ENUM_MAX_VALUES:
+            continue
+        type_name = f"enum_{col.lower()}"
+        dcon.execute(f"""
+            CREATE TYPE {type_name} AS ENUM (
+                SELECT DISTINCT "{col}" FROM '{pq}'
+                WHERE "{col}" IS NOT NULL AND "{col}" != ''
+                ORDER BY 1
+            )
+        """)
+        enums[col] = type_name
+    return enums
+
+
+def build_duckdb():
+    """Crea il database DuckDB persistente con tabelle native e indici ART su CUP/CIG."""
+    print("\n--- Creazione database DuckDB persistente ---")
+    start = time.time()
+
+    # Scrivo su un file temporaneo e poi lo sostituisco in modo atomico
+    tmp_file = DUCKDB_FILE + ".tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    tables = [
+        # (tabella, parquet, ordinamento, colonne indicizzate)
+        ("progetti", PARQUET_FILE, "CUP", ["CUP"]),
+        ("cig", CIG_PARQUET, "CUP, CIG", ["CUP", "CIG"]),
+        ("aggiudicatari", AGGIUDICATARI_PARQUET, "CIG", ["CIG"]),
+    ]
+
+    dcon = duckdb.connect(tmp_file)
+    dcon.execute("SET memory_limit = '8GB'")
+    for table, pq_file, order_by, index_cols in tables:
+        if not os.path.exists(pq_file):
+            print(f"  {os.path.basename(pq_file)} non trovato, skip tabella {table}")
+            continue
+        pq = pq_file.replace(os.sep, "/")
+        replace_sql = ""
+        if table == "progetti":
+            schema = {
+                r[0]: r[1] for r in
+                dcon.execute(f"DESCRIBE SELECT * FROM '{pq}'").fetchall()
+            }
+            enums = create_enum_types(dcon, pq)
+            if enums:
+                replace_sql = "REPLACE (" + ", ".join(
+                    f'NULLIF("{col}", \'\')::{type_name} AS "{col}"'
+                    for col, type_name in enums.items()
+                ) + ")"
+        dcon.execute(f"""
+            CREATE TABLE {table} AS
+            SELECT * {replace_sql} FROM '{pq}'
+            ORDER BY {order_by}
+        """)
+        for col in index_cols:
+            dcon.execute(
+                f'CREATE INDEX idx_{table}_{col.lower()} ON {table} ("{col}")'
+            )
+        count = dcon.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        print(f"  Tabella {table}: {count:,} righe, indici su {', '.join(index_cols)}")
+        if table == "progetti" and all(c in schema for c in CUBE_DIMENSIONS):
+            # Cubo dalla tabella nativa: stessi tipi (ENUM) di progetti
+            dcon.execute(f"CREATE TABLE aggregazioni AS {cube_sql('progetti', schema)}")
+    build_fts_indexes(dcon)
+    dcon.execute("CHECKPOINT")
+    dcon.close()
+
+    os.replace(tmp_file, DUCKDB_FILE)
+
+    elapsed = time.time() - start
+    size_gb = os.path.getsize(DUCKDB_FILE) / (1024**3)
+    print(f"  Database creato: {DUCKDB_FILE}")
+    print(f"  Dimensione: {size_gb:.2f} GB")
+    print(f"  Tempo: {elapsed:.1f}s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Converte i dati OpenCUP/ANAC in Parquet per la dashboard."
+    )
+    parser.add_argument(
+        "--duckdb", action="store_true",
+        help="crea anche data/opencup.duckdb (tabelle native + indici su CUP/CIG)",
+    )
+    parser.add_argument(
+        "--sorted", action="store_true",
+        help="scrive i Parquet ordinati per CUP/CIG con row group piccoli",
+    )
+    parser.add_argument(
+        "--trigrams", action="store_true",
+        help="crea gli indici trigrammi per le ricerche 'contiene' (data/trigrams/)",
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="legge solo le sorgenti nuove rispetto a data/ingest/manifest.json",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=INGEST_WORKERS,
+        help=f"archivi zip letti in parallelo (default {INGEST_WORKERS})",
+    )
+    return parser.parse_args()
 
 
 def main():
+    args = parse_args()
+
     con = duckdb.connect()
     con.execute("SET memory_limit = '8GB'")
     con.execute("SET threads TO 4")
 
+    # Una conversione completa non aggiorna manifest e staging: li elimino,
+    # cosi' la prossima incrementale riparte da zero invece di accodare
+    # sorgenti gia' presenti nei parquet
+    if not args.incremental and os.path.isdir(INGEST_DIR):
+        shutil.rmtree(INGEST_DIR)
+    manifest = IngestManifest(enabled=args.incremental)
+    progetti_changed = False
     csv_files = get_csv_files()
     if csv_files:
         has_loc = os.path.exists(LOC_CSV.replace("/", os.sep))
         print(f"File Localizzazione: {'trovato' if has_loc else 'NON trovato'}")
         if not has_loc:
             print("ATTENZIONE: senza Localizzazione non ci saranno dati geografici")
-        convert_csv_to_parquet(con, csv_files)
+        sources = csv_files + [p for p in (LOC_CSV, SOGG_CSV) if os.path.exists(p)]
+        mode, new_files = manifest.plan("progetti", sources, [PARQUET_FILE])
+        # Accodo solo CSV Progetti nuovi: se cambiano Localizzazione o Soggetti
+        # cambiano i join di tutte le righe
+        if mode == "append" and not all(f in csv_files for f in new_files):
+            mode, new_files = "full", csv_files
+        if mode == "skip":
+            print("Nessun CSV nuovo, skip conversione progetti.")
+        else:
+            convert_csv_to_parquet(
+                con, [f for f in new_files if f in csv_files],
+                sorted_layout=args.sorted, append=(mode == "append"),
+            )
+            manifest.commit("progetti")
+            progetti_changed = True
     elif os.path.exists(PARQUET_FILE):
         print("Nessun CSV trovato, ma progetti.parquet esiste gia. Skip conversione progetti.")
     else:
@@ -496,10 +1260,24 @@ def main():
         con.close()
         return
 
-    convert_cig_to_parquet(con)
-    convert_aggiudicatari_to_parquet(con)
-    if csv_files:
-        generate_stats(con)
+    apply_typed_schema(con, sorted_layout=args.sorted)
+    cig_changed = convert_cig_to_parquet(
+        con, sorted_layout=args.sorted, manifest=manifest, workers=args.workers
+    )
+    aggt_changed = convert_aggiudicatari_to_parquet(
+        con, sorted_layout=args.sorted, manifest=manifest, workers=args.workers
+    )
+    if manifest.enabled and not (progetti_changed or cig_changed or aggt_changed):
+        print("\nNessuna sorgente nuova, Parquet gia' aggiornati")
+        con.close()
+        if args.duckdb and not os.path.exists(DUCKDB_FILE):
+            build_duckdb()
+        return
+
+    add_cig_summary_columns(con, sorted_layout=args.sorted)
+    build_aggregation_cube(con)
+    # Sempre: i passi precedenti possono aver riscritto progetti.parquet
+    generate_stats(con)
 
     # Verifica
     pq = PARQUET_FILE.replace(os.sep, '/')
@@ -540,7 +1318,30 @@ def main():
     except Exception:
         pass
 
+    # Verifica pruning dei row group sui lookup puntuali
+    print("\nRow group letti da lookup puntuali (statistiche min/max + bloom filter):")
+    verify_point_lookups(con, PARQUET_FILE, "CUP")
+    verify_point_lookups(con, CIG_PARQUET, "CUP")
+    verify_point_lookups(con, CIG_PARQUET, "CIG")
+    verify_point_lookups(con, AGGIUDICATARI_PARQUET, "CIG")
+
+    if args.trigrams:
+        build_trigram_indexes(con)
+    elif os.path.isdir(TRIGRAM_DIR):
+        # Indici calcolati sui parquet precedenti: ricerche "contiene" incomplete
+        shutil.rmtree(TRIGRAM_DIR)
+        print(f"\nRimossi gli indici trigrammi in {TRIGRAM_DIR} (usa --trigrams per ricrearli)")
+
     con.close()
+
+    if args.duckdb:
+        build_duckdb()
+    elif os.path.exists(DUCKDB_FILE):
+        # Il database non rispecchia piu' i parquet appena riscritti: senza
+        # rimuoverlo il backend continuerebbe a leggere le vecchie tabelle
+        os.remove(DUCKDB_FILE)
+        print(f"\nRimosso {DUCKDB_FILE} (non aggiornato, usa --duckdb per ricrearlo)")
+
     print("\nConversione completata!")
 
 